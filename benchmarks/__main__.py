@@ -0,0 +1,43 @@
+# Micro-benchmarks of the hot path, run from the repository root with:
+#   python -m benchmarks                 run all benchmarks and compare them to the baseline (if there is one)
+#   python -m benchmarks --save          run all benchmarks and store the results as the new baseline
+#   python -m benchmarks -k filters      only run the benchmarks with "filters" in their name
+# The exit code is 1 when a benchmark got more than --threshold (default 20%) slower than the baseline.
+# Baselines depend on the computer, so they should be created on the machine they're compared on.
+import argparse
+import os
+import sys
+
+# The utils modules load their files (eg. models/anchors.npy) relative to the repository root
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from . import harness
+from . import bench_inference, bench_filters, bench_triangulation
+
+parser = argparse.ArgumentParser(prog="python -m benchmarks")
+parser.add_argument("-k", dest="selection", action="append", help="only run benchmarks containing this text")
+parser.add_argument("--baseline", default="benchmarks/baseline.json", help="baseline file to compare to or save to")
+parser.add_argument("--save", action="store_true", help="save the results as the baseline")
+parser.add_argument("--output", help="also write the results to this file")
+parser.add_argument("--threshold", type=float, default=0.2, help="slowdown (relative to the baseline) reported as a regression")
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--min-time", type=float, default=0.05, help="minimum time of each repeat, in seconds")
+args = parser.parse_args()
+
+results = harness.run(args.selection, args.repeat, args.min_time)
+if args.output:
+    harness.save(args.output, results)
+
+if args.save:
+    if os.path.exists(args.baseline):
+        # Benchmarks which weren't selected keep their old baseline
+        results = {**harness.load(args.baseline)["results"], **results}
+    harness.save(args.baseline, results)
+    print("Baseline saved to {}".format(args.baseline))
+elif os.path.exists(args.baseline):
+    regressions = harness.compare(results, harness.load(args.baseline), args.threshold)
+    for name, ratio in regressions.items():
+        print("REGRESSION {}: {:.0f}% slower than the baseline".format(name, (ratio - 1) * 100))
+    if regressions:
+        sys.exit(1)
+    print("No regressions (threshold {:.0f}%)".format(args.threshold * 100))
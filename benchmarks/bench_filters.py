@@ -0,0 +1,29 @@
+# Every filter of utils/filters.py, for a single 2D and 3D point
+import numpy as np
+
+from utils import filters
+from .harness import benchmark
+
+filter_settings = {
+    "RawFilter": {"type": "raw"},
+    "MovingAverageFilter": {"type": "movingaverage", "window_size": 5},
+    "OneEuroFilter": {"type": "oneeuro"},
+    "KalmanFilter": {"type": "kalman"},
+}
+
+def _setup(settings, d):
+    def setup():
+        f = filters.get_filter(settings, 30, d)
+        points = np.random.default_rng(0).normal(0, 1, (1000, d))
+        state = {"i": 0}
+
+        def step():
+            # Timestamps in ms, like the stages pass them
+            i = state["i"] = state["i"] + 1
+            return f.filter(points[i % 1000], i * 33.3)
+        return step
+    return setup
+
+for name, settings in filter_settings.items():
+    for d in (2, 3):
+        benchmark("filters.{}[d={}]".format(name, d))(_setup(settings, d))
@@ -0,0 +1,71 @@
+# Pre and post processing of the pose detection and landmark models
+import numpy as np
+
+from utils import inference, pose
+from .harness import benchmark
+from . import synthetic
+
+cams = 2
+joints = pose.get_required_joints()
+
+
+@benchmark("inference.resize_pad")
+def resize_pad():
+    img = np.random.default_rng(0).integers(0, 255, (640, 480, 3), dtype=np.uint8)
+    return lambda: inference.resize_pad(img)
+
+
+@benchmark("inference.detector_postprocess")
+def detector_postprocess():
+    preds = synthetic.detector_outputs(np.random.default_rng(0))
+    return lambda: inference.detector_postprocess(preds)
+
+
+@benchmark("inference.extract_roi")
+def extract_roi():
+    img = np.random.default_rng(0).integers(0, 255, (640, 480, 3), dtype=np.uint8)
+    xc, yc, theta, scale = np.array([240.]), np.array([320.]), np.array([0.1]), np.array([400.])
+    return lambda: inference.extract_roi(img, xc, yc, theta, scale)
+
+
+@benchmark("inference.landmark_postprocess")
+def landmark_postprocess():
+    lms, _, _ = synthetic.landmark_outputs(cams, np.random.default_rng(0))
+    return lambda: inference.landmark_postprocess(lms, True)
+
+
+@benchmark("inference.landmark_postprocess[joints]")
+def landmark_postprocess_joints():
+    lms, _, _ = synthetic.landmark_outputs(cams, np.random.default_rng(0))
+    return lambda: inference.landmark_postprocess(lms, True, joints)
+
+
+@benchmark("inference.refine_landmarks")
+def refine_landmarks():
+    lms, _, heatmap = synthetic.landmark_outputs(cams, np.random.default_rng(0))
+    normalized = inference.landmark_postprocess(lms, True)
+    return lambda: inference.refine_landmarks(normalized.copy(), heatmap)
+
+
+@benchmark("inference.refine_landmarks[joints]")
+def refine_landmarks_joints():
+    lms, _, heatmap = synthetic.landmark_outputs(cams, np.random.default_rng(0))
+    normalized = inference.landmark_postprocess(lms, True)
+    return lambda: inference.refine_landmarks(normalized.copy(), heatmap, joints=joints)
+
+
+@benchmark("inference.denormalize_landmarks")
+def denormalize_landmarks():
+    lms, _, _ = synthetic.landmark_outputs(cams, np.random.default_rng(0))
+    normalized = inference.landmark_postprocess(lms, True)
+    affines = np.tile(np.array([[1.5, 0.1, 40], [-0.1, 1.5, 80]], dtype="float32"), (cams, 1, 1))
+    return lambda: inference.denormalize_landmarks(normalized.copy(), affines)
+
+
+@benchmark("inference.autoflip")
+def autoflip():
+    rng = np.random.default_rng(0)
+    oncm = synthetic.oncm(synthetic.calibration(cams))
+    prev = synthetic.landmarks(oncm, synthetic.skeleton(), rng)
+    cur = synthetic.landmarks(oncm, synthetic.skeleton(), rng)
+    return lambda: inference.autoflip(prev, cur.copy(), 10)
@@ -0,0 +1,63 @@
+# Triangulation for different camera counts, and the tracker calculation
+import numpy as np
+
+from utils import vision, pose, skeleton
+from .harness import benchmark
+from . import synthetic
+
+joints = pose.get_required_joints()
+
+class StubClient:
+    def send_pos(self, tracker, pos):
+        pass
+
+    def send_rot(self, tracker, rot=None):
+        pass
+
+    def flush(self):
+        pass
+
+
+def _values(cams):
+    oncm = synthetic.oncm(synthetic.calibration(cams))
+    return oncm, synthetic.triangulation_values(oncm, synthetic.skeleton(), np.random.default_rng(0))
+
+for cams in (2, 4, 8):
+    @benchmark("vision.get_depth[cams={}]".format(cams))
+    def get_depth(cams=cams):
+        oncm, values = _values(cams)
+        return lambda: vision.get_depth(oncm, values)
+
+    @benchmark("vision.get_depth[cams={},joints]".format(cams))
+    def get_depth_joints(cams=cams):
+        oncm, values = _values(cams)
+        return lambda: vision.get_depth(oncm, values, joints=joints)
+
+    @benchmark("vision.Triangulator.get_depth[cams={},joints]".format(cams))
+    def triangulator(cams=cams):
+        oncm, values = _values(cams)
+        triangulator = vision.Triangulator(oncm)
+        return lambda: triangulator.get_depth(values, joints)
+
+
+@benchmark("pose.calc_pose")
+def calc_pose():
+    points = synthetic.skeleton() / 100
+    client = StubClient()
+    return lambda: pose.calc_pose(points, client)
+
+
+@benchmark("pose.calc_pose[send_rot,extra_trackers]")
+def calc_pose_all():
+    points = synthetic.skeleton() / 100
+    client = StubClient()
+    return lambda: pose.calc_pose(points, client, True, True)
+
+
+@benchmark("skeleton.SkeletonFitter.filter")
+def skeleton_fitter():
+    points = synthetic.skeleton() / 100
+    fitter = skeleton.SkeletonFitter(learn_time=0)
+    fitter.filter(points, 0)
+    fitter.filter(points, 1)
+    return lambda: fitter.filter(points, 2)
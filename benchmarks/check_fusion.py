@@ -0,0 +1,80 @@
+# Checks the hip fusion of utils/fusion.py against solver.solve, run from the repository root with:
+#   python -m benchmarks.check_fusion
+# A synthetic body turns and leans in front of the cameras, with a phone strapped to its hips in a tilted orientation
+# whose heading drifts. The fused hip rotation gets compared with the one solver.solve calculates from the true points,
+# also in a mirrored tracking space (flip_y). The exit code is 1 when the error gets larger than --max-error.
+import argparse
+import sys
+
+import numpy as np
+import cv2
+
+from utils import fusion, solver
+from . import synthetic
+
+def rotation(axis, degrees):
+    return cv2.Rodrigues(np.asarray(axis, dtype=float) * np.radians(degrees))[0]
+
+
+def to_quat(m):
+    # (x, y, z, w) like owoTrack sends
+    rotvec = solver.matrix_to_rotvec(m[None])[0]
+    angle = np.linalg.norm(rotvec)
+    axis = rotvec / angle if angle > 0 else rotvec
+    return np.append(axis * np.sin(angle / 2), np.cos(angle / 2))
+
+
+def angle_between(a, b):
+    # Angle (degrees) between two rotation vectors in degrees
+    m = rotation(a, 1) @ rotation(b, 1).T
+    return np.degrees(np.arccos(np.clip((np.trace(m) - 1) / 2, -1, 1)))
+
+
+def body_rotation(t):
+    # Stands still, turns by 30 degrees, then by 90 degrees, while leaning forward a bit
+    heading = 30 * np.clip(t - 4, 0, 1) + 90 * np.clip((t - 8) / 0.5, 0, 1)
+    return rotation([0, 1, 0], heading) @ rotation([1, 0, 0], 10 * np.sin(t))
+
+
+def simulate(mirrored, duration=12, camera_rate=30, imu_rate=100, latency=0.05, noise=0.3):
+    rng = np.random.default_rng(0)
+    points = synthetic.skeleton() / 100
+    mount = rotation([0.3, 0.8, -0.5], 70) # the phone on the hips
+    world = rotation([1, 0, 0], 90) # y up of the tracking space to z up of the phone
+    flip = np.diag([1, -1, 1]) if mirrored else np.eye(3)
+    hip_fusion = fusion.HipFusion(2.0, mirrored=mirrored)
+
+    errors, camera_errors = [], []
+    camera = None
+    next_frame = 0
+    for t in np.arange(0, duration, 1 / imu_rate):
+        body = body_rotation(t)
+        drift = rotation([0, 0, 1], 40 + 0.5 * t) # the phone doesn't know where the cameras are, and drifts
+        quat = to_quat(drift @ world @ body @ mount)
+
+        if t >= next_frame + latency:
+            # The frame set captured latency seconds ago, with noisy points
+            seen = (points @ body_rotation(next_frame).T + rng.normal(0, noise / 100, points.shape)) @ flip
+            hip_fusion.update_vision(next_frame, seen)
+            camera = solver.solve(seen)[solver.HIP]
+            next_frame += 1 / camera_rate
+
+        fused = hip_fusion.update_imu(t, quat)
+        if fused is not None and t > 2:
+            expected = solver.solve(points @ body.T @ flip)[solver.HIP]
+            errors.append(angle_between(fused, expected))
+            camera_errors.append(angle_between(camera, expected))
+    return np.array(errors), np.array(camera_errors)
+
+
+parser = argparse.ArgumentParser(prog="python -m benchmarks.check_fusion")
+parser.add_argument("--max-error", type=float, default=5, help="largest allowed error in degrees")
+args = parser.parse_args()
+
+failed = False
+for mirrored in (False, True):
+    errors, camera_errors = simulate(mirrored)
+    print("{:<9} mean error {:.2f} deg, max {:.2f} deg (cameras alone: mean {:.2f} deg, max {:.2f} deg)".format(
+        "mirrored" if mirrored else "normal", errors.mean(), errors.max(), camera_errors.mean(), camera_errors.max()))
+    failed |= errors.max() > args.max_error
+sys.exit(1 if failed else 0)
@@ -0,0 +1,253 @@
+# Headless end-to-end benchmark of the tracker, run with:
+#   python main.py --benchmark                         2, 4 and 8 synthetic cameras, with tiny stand-in models
+#   python main.py --benchmark --cameras 2 --models real --video recording.mp4
+# The cameras are replaced by synthetic frames (a stick figure) or video files, the calibration is generated for the
+# virtual cameras, and the trackers are sent to a local OSC sink which counts the packets.
+# The settings of settings.json are used, except for the ones which need hardware, a headset or a window.
+import threading
+import tempfile
+import argparse
+import socket
+import json
+import time
+import os
+
+import numpy as np
+import pyjson5
+import cv2
+
+from utils import tracing, vision, skeleton, config
+from . import synthetic
+
+#region Frame Sources
+class SyntheticCamera:
+    # Renders a swaying stick figure as seen by one of the cameras of the calibration
+    # Frames are delivered at the frame rate of the camera (0 = as fast as possible), like read() of a real camera
+    def __init__(self, oncm, fps=50, frames=30, res=(640, 480)):
+        self.fps = fps
+        self.next = time.monotonic()
+        self.frames = []
+        self.index = 0
+
+        rng = np.random.default_rng(0)
+        background = rng.integers(60, 120, (res[0], res[1], 3), dtype=np.uint8) # Rotated frame, (height, width)
+        for i in range(frames):
+            points = synthetic.skeleton()
+            points[:, 0] += 15 * np.sin(2 * np.pi * i / frames)
+            projected = synthetic.landmarks([oncm], points, rng, noise=0)[0, :, :2].astype(int)
+
+            frame = background.copy()
+            for a, b in skeleton.bones:
+                cv2.line(frame, tuple(projected[a]), tuple(projected[b]), (200, 170, 150), 12)
+            cv2.circle(frame, tuple(projected[0]), 25, (200, 170, 150), -1)
+            # Cameras give unrotated frames, which get rotated by the camera stage
+            self.frames.append(cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE))
+
+    def wait(self):
+        if self.fps:
+            self.next += 1 / self.fps
+            delay = self.next - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.next = time.monotonic() # Too slow, frames get dropped like with a real camera
+
+    def read(self):
+        self.wait()
+        self.index = (self.index + 1) % len(self.frames)
+        return True, self.frames[self.index]
+
+
+class VideoCamera(SyntheticCamera):
+    # Plays a video file in a loop, resized to the resolution of the cameras
+    def __init__(self, path, fps=50, res=(640, 480)):
+        self.fps = fps
+        self.next = time.monotonic()
+        self.res = res
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise ValueError("Could not open video {}".format(path))
+
+    def read(self):
+        self.wait()
+        ok, frame = self.capture.read()
+        if not ok:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read()
+        if frame.shape[:2] != (self.res[1], self.res[0]):
+            frame = cv2.resize(frame, self.res)
+        return ok, frame
+#endregion
+
+
+class OSCSink:
+    # Receives the OSC packets of the tracker on 127.0.0.1, and only counts them
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.5)
+        self.port = self.sock.getsockname()[1]
+        self.packets = 0
+        self.bytes = 0
+        self.running = True
+        threading.Thread(target=self._receive, name="osc_sink", daemon=True).start()
+
+    def _receive(self):
+        while self.running:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            self.packets += 1
+            self.bytes += len(data)
+
+    def reset(self):
+        self.packets = 0
+        self.bytes = 0
+
+    def close(self):
+        self.running = False
+
+
+#region Stand-in Models
+# The stand-in models always return the outputs of synthetic.py, so a person is always found.
+# "onnx" models go through onnxruntime like the real ones (the input is reduced to get the batch size),
+# "replay" models are .npz files which inference.create_session replays without onnxruntime.
+def model_outputs():
+    rng = np.random.default_rng(0)
+    raw_box, raw_score = synthetic.detector_outputs(rng)
+    landmarks, flags, heatmap = synthetic.landmark_outputs(1, rng)
+    detection = {"Identity": raw_box, "Identity_1": raw_score}
+    landmark = {"Identity": landmarks, "Identity_1": flags, "Identity_3": heatmap}
+    return detection, landmark
+
+def _write_onnx(path, input_shape, outputs):
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    nodes = [
+        helper.make_node("ReduceMean", ["input_1"], ["mean"], axes=[1, 2, 3], keepdims=0), # (batch,)
+        helper.make_node("Mul", ["mean", "zero"], ["zeros"]),
+    ]
+    initializers = [numpy_helper.from_array(np.zeros((), dtype="float32"), "zero")]
+    for name, value in outputs.items():
+        # (batch,) zeros get unsqueezed to (batch, 1, ...) and added to the (1, ...) output
+        nodes.append(helper.make_node("Unsqueeze", ["zeros", name + "_axes"], [name + "_zeros"]))
+        nodes.append(helper.make_node("Add", [name + "_zeros", name + "_value"], [name]))
+        initializers.append(numpy_helper.from_array(np.arange(1, value.ndim, dtype="int64"), name + "_axes"))
+        initializers.append(numpy_helper.from_array(value.astype("float32"), name + "_value"))
+
+    graph = helper.make_graph(nodes, "stand_in",
+        [helper.make_tensor_value_info("input_1", TensorProto.FLOAT, ["batch", *input_shape])],
+        [helper.make_tensor_value_info(name, TensorProto.FLOAT, ["batch", *value.shape[1:]]) for name, value in outputs.items()],
+        initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8) # Loadable by older onnxruntime versions
+    onnx.checker.check_model(model)
+    onnx.save(model, path)
+
+def write_models(directory, kind):
+    # Returns the settings for using the stand-in models
+    detection, landmark = model_outputs()
+    if kind == "onnx":
+        _write_onnx(os.path.join(directory, "pose_detection.onnx"), (224, 224, 3), detection)
+        _write_onnx(os.path.join(directory, "pose_landmark.onnx"), (3, 256, 256), landmark)
+        return {"pose_det_model": os.path.join(directory, "pose_detection.onnx"), "pose_landmark_model": os.path.join(directory, "pose_landmark.onnx")}
+
+    np.savez(os.path.join(directory, "pose_detection.npz"), **detection)
+    np.savez(os.path.join(directory, "pose_landmark.npz"), **landmark)
+    return {"pose_det_model": os.path.join(directory, "pose_detection.npz"), "pose_landmark_model": os.path.join(directory, "pose_landmark.npz")}
+#endregion
+
+
+def run(create_tracker, settings, cam_count, args):
+    # Runs the tracker with cam_count virtual cameras, and returns the measurements
+    width, height = args.resolution
+    vision.calib = synthetic.calibration(cam_count, res=(height, width))
+    oncm = synthetic.oncm(vision.calib, res=(height, width))
+    if args.video:
+        cameras = [VideoCamera(args.video[i % len(args.video)], args.camera_fps, (width, height)) for i in range(cam_count)]
+    else:
+        cameras = [SyntheticCamera(oncm[i], args.camera_fps, res=(width, height)) for i in range(cam_count)]
+
+    sink = OSCSink()
+    settings = config.from_dict({**settings, "ip": "127.0.0.1", "port": sink.port})
+    monitor = tracing.LatencyMonitor(window=1 << 20)
+    tracker = create_tracker(settings, cameras, monitor)
+    # Time until the first frame set reaches the trackers, which includes loading the models
+    first_frame = []
+    tracker.listeners.append(lambda trace, completed: completed and not first_frame and first_frame.append(time.monotonic()))
+    started = time.monotonic()
+    tracker.start()
+
+    time.sleep(args.warmup)
+    monitor.reset()
+    sink.reset()
+    start, cpu_start = time.monotonic(), time.process_time()
+    time.sleep(args.duration)
+    elapsed, cpu = time.monotonic() - start, time.process_time() - cpu_start
+    frames, packets, summary = monitor.frames, sink.packets, monitor.summary()
+
+    tracker.stop()
+    tracker.join(5)
+    sink.close()
+
+    # CPU time of each stage per frame, from the traces (this includes the stages running in worker processes)
+    stage_cpu = {name: float(np.mean(samples)) * 1000 for (kind, name), samples in monitor.samples.items() if kind == "cpu" and len(samples)}
+    return {
+        "cameras": cam_count,
+        "first_frame_seconds": first_frame[0] - started if first_frame else None,
+        "fps": frames / elapsed,
+        "osc_packets_per_second": packets / elapsed,
+        "cpu_percent": cpu / elapsed * 100, # Of one core, main process only
+        "latency": summary["latency"],
+        "stage": summary["stage"],
+        "stage_cpu_ms": stage_cpu,
+        "wait": summary["wait"],
+        "dropped": summary.get("dropped", {}),
+    }
+
+
+def report(result):
+    latency = result["latency"].get("glass_to_osc", {})
+    print("\n{} camera(s): {:.1f} fps, {:.1f} OSC packets/s, {:.0f}% CPU, glass to OSC p50 {} ms p95 {} ms p99 {} ms".format(
+        result["cameras"], result["fps"], result["osc_packets_per_second"], result["cpu_percent"],
+        latency.get("p50", "-"), latency.get("p95", "-"), latency.get("p99", "-")))
+    if result["first_frame_seconds"] is not None:
+        print("    first frame after {:.2f} s".format(result["first_frame_seconds"]))
+    print("    {:24} {:>10} {:>10} {:>10}".format("stage", "p50 ms", "p95 ms", "cpu ms"))
+    for name, values in result["stage"].items():
+        print("    {:24} {:>10} {:>10} {:>10.3f}".format(name, values["p50"], values["p95"], result["stage_cpu_ms"].get(name, 0)))
+
+
+def main(argv, create_tracker):
+    parser = argparse.ArgumentParser(prog="main.py --benchmark", description="Headless end-to-end benchmark of the tracker")
+    parser.add_argument("--cameras", default="2,4,8", help="camera counts to benchmark, comma separated (at least 2, for triangulation)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to measure for each camera count")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds to run before measuring")
+    parser.add_argument("--camera-fps", type=float, default=50, help="frame rate of the virtual cameras (0 = unlimited)")
+    parser.add_argument("--resolution", type=lambda value: tuple(int(x) for x in value.split("x")), default=(640, 480), help="resolution of the virtual cameras, eg. 320x240")
+    parser.add_argument("--video", action="append", help="video file to use instead of synthetic frames (can be repeated, one per camera)")
+    parser.add_argument("--models", choices=["onnx", "replay", "real"], default="onnx", help="tiny stand-in onnx models, stand-ins without onnxruntime, or the models of the settings")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+    cam_counts = [int(c) for c in args.cameras.split(",")]
+    if min(cam_counts) < 2:
+        parser.error("triangulation needs at least 2 cameras")
+
+    settings = pyjson5.decode_io(open("settings.json", "r"))
+    # Nothing which needs a window, a headset or a user
+    settings.update({"debug": False, "draw_pose": False, "owotrack": False, "profile": False})
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        if args.models != "real":
+            settings.update(write_models(directory, args.models))
+
+        for cam_count in cam_counts:
+            result = run(create_tracker, settings, cam_count, args)
+            report(result)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"time": time.time(), "args": vars(args), "results": results}, f, indent=4)
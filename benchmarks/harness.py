@@ -0,0 +1,69 @@
+# Minimal benchmark harness
+# A benchmark is a setup function registered with @benchmark, which prepares the inputs and returns the function to time.
+# Results are the median time per call (in seconds) over a few repeats.
+import platform
+import timeit
+import json
+import time
+
+import numpy as np
+
+benchmarks = {} # name: setup function
+
+def benchmark(name):
+    def decorator(setup):
+        benchmarks[name] = setup
+        return setup
+    return decorator
+
+
+def measure(fn, repeat=5, min_time=0.05):
+    # The number of calls per repeat is picked so that each repeat takes at least min_time
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2 if number < 8 else 4
+    times = np.array(timer.repeat(repeat, number)) / number
+    return {"median": float(np.median(times)), "min": float(np.min(times)), "calls": number * repeat}
+
+
+def run(selection=None, repeat=5, min_time=0.05):
+    results = {}
+    for name, setup in benchmarks.items():
+        if selection and not any(s in name for s in selection):
+            continue
+        results[name] = measure(setup(), repeat, min_time)
+        print("{:48} {:>12}".format(name, format_time(results[name]["median"])))
+    return results
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return "{:.2f} us".format(seconds * 1e6)
+    return "{:.3f} ms".format(seconds * 1e3)
+
+
+def machine():
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(), "processor": platform.processor()}
+
+
+def save(path, results):
+    with open(path, "w") as f:
+        json.dump({"time": time.time(), "machine": machine(), "results": results}, f, indent=4)
+
+
+def load(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compare(results, baseline, threshold=0.2):
+    # Returns the benchmarks which got more than threshold slower than the baseline, as {name: ratio}
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        ratio = result["median"] / baseline["results"][name]["median"]
+        if ratio > 1 + threshold:
+            regressions[name] = ratio
+    return regressions
@@ -0,0 +1,132 @@
+# Synthetic but realistically shaped inputs for the benchmarks
+# A standing person gets placed in the middle of a generated camera rig, and everything else
+# (model outputs, 2D landmarks, 3D points) is derived from it, so no cameras or models are needed.
+import numpy as np
+import cv2
+
+from utils import inference
+
+# BlazePose keypoints of a standing person of 170cm, in cm, with y pointing up and the person facing +z
+# 33 and 34 are the auxiliary keypoints used for the ROI (hip center and a point above the head)
+_skeleton = np.array([
+    [0, 160, 8],                                # 0: nose
+    [2, 165, 7], [3.5, 165, 6], [5, 165, 5],    # 1-3: left eye
+    [-2, 165, 7], [-3.5, 165, 6], [-5, 165, 5], # 4-6: right eye
+    [7, 162, 0], [-7, 162, 0],                  # 7-8: ears
+    [2, 154, 7], [-2, 154, 7],                  # 9-10: mouth
+    [18, 142, 0], [-18, 142, 0],                # 11-12: shoulders
+    [22, 115, 2], [-22, 115, 2],                # 13-14: elbows
+    [24, 90, 6], [-24, 90, 6],                  # 15-16: wrists
+    [25, 82, 6], [-25, 82, 6],                  # 17-18: pinkies
+    [23, 81, 8], [-23, 81, 8],                  # 19-20: index fingers
+    [21, 85, 9], [-21, 85, 9],                  # 21-22: thumbs
+    [10, 95, 0], [-10, 95, 0],                  # 23-24: hips
+    [11, 52, 3], [-11, 52, 3],                  # 25-26: knees
+    [11, 9, 0], [-11, 9, 0],                    # 27-28: ankles
+    [11, 3, -5], [-11, 3, -5],                  # 29-30: heels
+    [12, 1, 12], [-12, 1, 12],                  # 31-32: foot index
+    [0, 95, 0], [0, 180, 0],                    # 33-34: hip center, above head
+    [0, 142, 0], [0, 175, 0],                   # 35-36: upper body
+    [0, 95, 0], [0, 142, 0],                    # 37-38
+], dtype=float)
+
+
+def skeleton(height=170):
+    return _skeleton * (height / 170)
+
+
+def calibration(count, res=(480, 640), distance=300, camera_height=120, spread=None):
+    # calib.json style calibration of count cameras on a circle around the origin, all looking at the person
+    # res is (width, height) of the rotated frames, spread is the angle (in degrees) between the outer cameras
+    if spread is None:
+        spread = min(60 * (count - 1), 180)
+    fx = res[1] * 0.8
+    cmtx = [[fx, 0, res[0] / 2], [0, fx, res[1] / 2], [0, 0, 1]]
+    angles = np.radians(np.linspace(-spread / 2, spread / 2, count) if count > 1 else [0])
+    target = np.array([0, 100, 0])
+
+    cameras = []
+    for i, angle in enumerate(angles):
+        position = np.array([distance * np.sin(angle), camera_height, distance * np.cos(angle)])
+        forward = (target - position) / np.linalg.norm(target - position)
+        right = np.cross(forward, [0, 1, 0])
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+        R = np.stack([right, down, forward]) # world to camera
+        tvec = -R @ position
+
+        cameras.append({
+            "type": "Synthetic",
+            "id": i,
+            "resolution": [res[1], res[0]], # of the raw frames, before rotating
+            "intrinsics": {"cmtx": cmtx, "dist": [[0, 0, 0, 0, 0]], "size": list(res)},
+            "extrinsics": {"rvec": R.tolist(), "tvec": tvec.reshape(3, 1).tolist()},
+        })
+    return {"cameras": cameras}
+
+
+def oncm(calib, res=(480, 640)):
+    # Same tuples as main builds with vision.read_camera_parameters, without needing calib.json
+    result = []
+    for camera in calib["cameras"]:
+        cmtx = np.array(camera["intrinsics"]["cmtx"], dtype=float)
+        dist = np.array(camera["intrinsics"]["dist"], dtype=float)
+        R = np.array(camera["extrinsics"]["rvec"], dtype=float)
+        tvec = np.array(camera["extrinsics"]["tvec"], dtype=float)
+        optimal_cmtx, _ = cv2.getOptimalNewCameraMatrix(cmtx, dist, res, 1, res)
+        proj = cmtx @ np.hstack([R, tvec.reshape(3, 1)])
+        result.append((cmtx, dist, optimal_cmtx, R, tvec, proj))
+    return result
+
+
+def landmarks(oncm, points, rng, noise=1.0):
+    # Projects the 3D points onto every camera, as (x, y, z, visibility) landmarks in pixels
+    result = []
+    for camera in oncm:
+        projected = np.hstack([points, np.ones((len(points), 1))]) @ camera[5].T
+        lm = np.zeros((len(points), 4))
+        lm[:, :2] = projected[:, :2] / projected[:, 2:] + rng.normal(0, noise, (len(points), 2))
+        lm[:, 2] = projected[:, 2]
+        lm[:, 3] = rng.uniform(0.6, 1.0, len(points))
+        result.append(lm)
+    return np.stack(result)
+
+
+def triangulation_values(oncm, points, rng, noise=1.0):
+    # Input of the triangulation stage, (frame, landmarks, flags) for each camera
+    lms = landmarks(oncm, points, rng, noise)
+    return [(None, lms[i], np.array([0.99])) for i in range(len(oncm))]
+
+
+def detector_outputs(rng, center=(0.5, 0.5), size=0.4):
+    # Raw output of the pose detection model for one image with one person in it
+    # Anchors close to the person have a high score and point at it, the others are background
+    anchors = inference.get_anchors()
+    raw_box = np.zeros((1, len(anchors), 12), dtype="float32")
+    raw_score = rng.normal(-8, 1.5, (1, len(anchors), 1)).astype("float32")
+
+    near = np.linalg.norm(anchors[:, :2] - center, axis=1) < 0.08
+    jitter = rng.normal(0, 0.01, (near.sum(), 2))
+    # Offsets are in pixels of the 224x224 input, relative to the anchor
+    raw_box[0, near, 0:2] = (np.array(center) + jitter - anchors[near, :2]) * 224
+    raw_box[0, near, 2:4] = size * 224
+    # Keypoints: hip center, point above the head, and two others
+    for k, offset in enumerate([(0, 0), (0, -size / 2), (-size / 4, 0), (size / 4, 0)]):
+        raw_box[0, near, 4 + k * 2:6 + k * 2] = (np.array(center) + offset + jitter - anchors[near, :2]) * 224
+    raw_score[0, near, 0] = rng.normal(3, 1, near.sum())
+    return [raw_box, raw_score]
+
+
+def landmark_outputs(count, rng):
+    # Raw outputs of the batched pose landmark model: landmarks (count, 195), flags (count, 1), heatmap (count, 64, 64, 39)
+    points = skeleton()
+    crop = np.zeros((39, 5))
+    crop[:, 0] = 128 + points[:, 0] * 1.2
+    crop[:, 1] = 128 + (95 - points[:, 1]) * 1.2
+    crop[:, 2] = points[:, 2]
+    crop[:, 3:] = 3
+
+    lms = np.stack([crop + rng.normal(0, 1, crop.shape) for _ in range(count)]).reshape(count, -1).astype("float32")
+    flags = np.full((count, 1), 0.99, dtype="float32")
+    heatmap = rng.normal(-3, 1, (count, 64, 64, 39)).astype("float32")
+    return lms, flags, heatmap
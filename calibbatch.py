@@ -0,0 +1,211 @@
+# Calibrates the cameras of calib.json from recorded frames, without the GUI of calibtool.py
+# The frames can be a video, a directory of images, or a recording of the tracker (see record in settings.json).
+# The patterns are searched on a pool of processes, which is a lot faster than doing it live.
+#
+#   python calibbatch.py intrinsics 0 checkerboard_cam0.mp4
+#   python calibbatch.py extrinsics recordings/20240101_120000
+#   python calibbatch.py extrinsics marker_cam0.mp4 marker_cam1.mp4
+#
+# Intrinsics: out of all frames with the checkerboard, --views frames get picked which together cover the whole frame,
+# with the checkerboard at as many distances and angles as possible (see calibration.select_views).
+# Extrinsics: one source per camera (or a single recording for all of them), showing the aruco marker on the floor.
+# The frames in the largest cluster of rotations get averaged and solved together (see calibration.marker_pose).
+# Frames are turned sideways like in the tracker, unless they already are (--no-rotate).
+import multiprocessing
+import argparse
+import glob
+import time
+import os
+
+import numpy as np
+import pyjson5
+import cv2
+
+from utils import calibration, calibcache
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+#region Sources
+def _images(path):
+    return sorted(f for f in glob.glob(os.path.join(path, "*")) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def _is_recording(path, camera):
+    return os.path.exists(os.path.join(path, "cam{}.frames".format(camera)))
+
+
+def count_frames(path, camera):
+    if os.path.isdir(path):
+        if _is_recording(path, camera):
+            from camera.recording import ReplayCamera
+            return len(ReplayCamera(path, camera, "fast").frames)
+        return len(_images(path))
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Can't open {}".format(path))
+    return int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+
+def read_frames(path, camera, start, stop, step=1):
+    # Yields (index, frame) for the frames start, start + step, ... before stop
+    if os.path.isdir(path):
+        if _is_recording(path, camera):
+            from camera.recording import ReplayCamera
+            frames = ReplayCamera(path, camera, "fast").frames
+            for i in range(start, min(stop, len(frames)), step):
+                yield i, np.array(frames[i])
+        else:
+            files = _images(path)
+            for i in range(start, min(stop, len(files)), step):
+                frame = cv2.imread(files[i])
+                if frame is not None:
+                    yield i, frame
+        return
+
+    capture = cv2.VideoCapture(path)
+    capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    for i in range(start, stop):
+        if (i - start) % step == 0:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            yield i, frame
+        elif not capture.grab():
+            break
+#endregion
+
+
+#region Workers
+def find_checkerboards(task):
+    # The checkerboard corners in a range of frames, and the size of the frames
+    path, camera, start, stop, step, rotate, rows, columns = task
+    found, size = [], None
+    for i, frame in read_frames(path, camera, start, stop, step):
+        if rotate:
+            frame = cv2.rotate(frame, 2)
+        size = (frame.shape[1], frame.shape[0])
+        corners = calibration.find_checkerboard(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), rows, columns)
+        if corners is not None:
+            found.append((i, corners))
+    return found, size
+
+
+def find_markers(task):
+    # The corners of the aruco marker in a range of frames, which get undistorted first like in calibtool.py
+    # and the size of the frames, the intrinsics get scaled to it
+    path, camera, start, stop, step, rotate, intrinsics = task
+    detector = cv2.aruco.ArucoDetector(cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_250), cv2.aruco.DetectorParameters())
+    found, size = [], None
+    for i, frame in read_frames(path, camera, start, stop, step):
+        if rotate:
+            frame = cv2.rotate(frame, 2)
+        if size != (frame.shape[1], frame.shape[0]):
+            size = (frame.shape[1], frame.shape[0])
+            cmtx, dist, opt_cmtx = calibration.scale_intrinsics(intrinsics, size)
+        frame = cv2.undistort(frame, cmtx, dist, None, opt_cmtx)
+        corners, ids, rejected = detector.detectMarkers(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+        if len(corners) > 0:
+            found.append((i, corners[0][0]))
+    return found, size
+
+
+def run_tasks(pool, function, tasks, label):
+    results = []
+    for done, result in enumerate(pool.imap(function, tasks), 1):
+        results.append(result)
+        print("\r{}: {}/{} chunks".format(label, done, len(tasks)), end="", flush=True)
+    print()
+    return results
+
+
+def chunks(path, camera, step, workers, extra):
+    # Tasks for the workers, a few per worker so the slow chunks get spread out
+    count = count_frames(path, camera)
+    size = max(step, -(-count // (workers * 4)) // step * step)
+    return [(path, camera, start, min(start + size, count), step, *extra) for start in range(0, count, size)]
+#endregion
+
+
+def calibrate_intrinsics(calib, args, pool):
+    checkerboard = calibration.Checkerboard.from_settings(calib["settings"])
+    tasks = chunks(args.sources[0], args.camera, args.step, args.workers, (args.rotate, checkerboard.rows, checkerboard.columns))
+    results = run_tasks(pool, find_checkerboards, tasks, "Searching the checkerboard")
+
+    found = [item for result, size in results for item in result]
+    if len(found) < 5:
+        raise SystemExit("Found the checkerboard in {} frames, at least 5 are needed".format(len(found)))
+    size = next(size for result, size in results if size is not None)
+
+    imgpoints = [corners for i, corners in found]
+    descriptors = [calibration.describe_view(corners, checkerboard.rows, checkerboard.columns, size) for corners in imgpoints]
+    picked = calibration.select_views(imgpoints, descriptors, size, args.views)
+
+    start = time.monotonic()
+    intrinsics, error = calibration.calibrate_intrinsics(checkerboard, [imgpoints[i] for i in picked], size)
+    print("Found the checkerboard in {} frames, calibrated with {} of them in {:.1f} s, reprojection error {:.3f} px".format(
+        len(found), len(picked), time.monotonic() - start, error))
+    calib["cameras"][args.camera]["intrinsics"] = intrinsics
+
+
+def calibrate_extrinsics(calib, args, pool):
+    cameras = calib["cameras"]
+    sources = args.sources * len(cameras) if len(args.sources) == 1 else args.sources
+    if len(sources) != len(cameras):
+        raise SystemExit("calib.json has {} cameras, but {} sources were given".format(len(cameras), len(sources)))
+    missing = [i for i, camera in enumerate(cameras) if "intrinsics" not in camera]
+    if missing:
+        raise SystemExit("Calibrate the intrinsics of cameras {} first".format(missing))
+
+    size = calib["settings"]["aruco_size"]
+    for i, camera in enumerate(cameras):
+        tasks = chunks(sources[i], i, args.step, args.workers, (args.rotate, camera["intrinsics"]))
+        results = run_tasks(pool, find_markers, tasks, "Searching the marker for camera {}".format(i))
+        observations = [corners for result, frame_size in results for _, corners in result]
+        if not observations:
+            raise SystemExit("Camera {} didn't see the marker".format(i))
+
+        frame_size = next(frame_size for result, frame_size in results if frame_size is not None)
+        cmtx, dist, _ = calibration.scale_intrinsics(camera["intrinsics"], frame_size)
+        rvec, tvec, used = calibration.marker_pose(observations, size, cmtx, dist)
+        print("Camera {}: solved from {} of {} frames with the marker".format(i, used, len(observations)))
+        camera["extrinsics"] = {"rvec": rvec.tolist(), "tvec": tvec.tolist()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrates the cameras from recorded frames")
+    commands = parser.add_subparsers(dest="command", required=True)
+    intrinsics = commands.add_parser("intrinsics", help="calibrate the intrinsics of a camera from frames with the checkerboard")
+    intrinsics.add_argument("camera", type=int, help="index of the camera in calib.json")
+    intrinsics.add_argument("sources", nargs=1, metavar="source", help="video, directory of images, or recording")
+    intrinsics.add_argument("--views", type=int, default=40, help="number of frames to calibrate with")
+    extrinsics = commands.add_parser("extrinsics", help="calibrate the extrinsics of all cameras from frames with the aruco marker")
+    extrinsics.add_argument("sources", nargs="+", metavar="source", help="video, directory of images, or recording, for every camera (or one recording for all)")
+    for command in (intrinsics, extrinsics):
+        command.add_argument("--calib", default="calib.json", help="calibration to update")
+        command.add_argument("--step", type=int, default=1, help="only use every step-th frame")
+        command.add_argument("--no-rotate", dest="rotate", action="store_false", help="the frames are already turned sideways")
+        command.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="number of processes")
+        command.add_argument("--dry-run", action="store_true", help="don't save the calibration")
+    args = parser.parse_args()
+
+    with open(args.calib, "r") as f:
+        calib = pyjson5.load(f)
+    if args.command == "intrinsics" and not 0 <= args.camera < len(calib["cameras"]):
+        parser.error("calib.json has {} cameras".format(len(calib["cameras"])))
+
+    start = time.monotonic()
+    with multiprocessing.get_context("spawn").Pool(args.workers) as pool:
+        if args.command == "intrinsics":
+            calibrate_intrinsics(calib, args, pool)
+        else:
+            calibrate_extrinsics(calib, args, pool)
+    print("Done in {:.1f} s".format(time.monotonic() - start))
+
+    if not args.dry_run:
+        with open(args.calib, "w") as f:
+            f.write(pyjson5.dumps(calib))
+        calibcache.save(calib, os.path.splitext(args.calib)[0] + ".bin")
+        print("Saved {}".format(args.calib))
+
+if __name__ == "__main__":
+    main()
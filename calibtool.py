@@ -7,6 +7,8 @@ import math
 import cv2
 import os
 
+from utils import calibcache, calibration, preview, vision
+
 if not os.path.exists("calib.json"):
     with open("calib.json", "w") as f:
         f.write("""{
@@ -29,12 +31,18 @@ with open("calib.json", "r") as f:
 def save_calib():
     with open("calib.json", "w") as f:
         f.write(pyjson5.dumps(calib))
+    # The compiled calibration which the tracker loads, see utils/calibcache.py
+    calibcache.save(calib, "calib.bin")
 
-def get_cam(type, id):
-    if type == "PS3 Eye Camera":
-        return camera.Camera(id, (640, 480), 50, camera.ps3eye_format.PS3EYE_FORMAT_BGR)
-    else:
-        return cv2.VideoCapture(id+700) #open camera at id with the directshow API (700). Note that same camera is not always on the same id, so this needs a better way.
+# calib.json may have been edited by hand since calib.bin was written
+if calibcache.load(calib, "calib.bin") is None:
+    calibcache.save(calib, "calib.bin")
+
+# Opens camera index of calib.json, at its resolution and frame rate
+def get_cam(index):
+    cam = calib["cameras"][index]
+    resolution, fps = vision.camera_mode(calib, index)
+    return vision.get_cam(cam["type"], cam["id"], resolution=resolution, fps=fps)
 
 def add_camera():
     ids = list(range(camera.get_camera_count()))
@@ -43,6 +51,9 @@ def add_camera():
         [sg.Text('Add Camera', font="SegoeUI 16", justification='center')],
         [sg.Text('Camera Type:', font="SegoeUI 12"), sg.Combo(values=["PS3 Eye Camera", "other"], key="camtype", readonly=True, default_value="PS3 Eye Camera")],
         [sg.Text('Camera ID:', font="SegoeUI 12"), sg.Combo(values=[0,1,2,3], key="camid", readonly=True, default_value=ids[0])],
+        # The PS3 Eye does up to 75 fps at 640x480, and up to 187 fps at 320x240
+        [sg.Text('Resolution:', font="SegoeUI 12"), sg.Combo(values=["640x480", "320x240"], key="camres", readonly=True, default_value="640x480")],
+        [sg.Text('FPS:', font="SegoeUI 12"), sg.Input(vision.DEFAULT_FPS, key="camfps", size=(5, 1))],
         [sg.Text('Name (optional):', font="SegoeUI 12"), sg.Input(key="camname", size=(15, 1))],
         [sg.Button('Add', key="add"), sg.Button('Cancel', key="cancel")]
     ]
@@ -52,13 +63,22 @@ def add_camera():
     while True:
         event, values = window.read()
         
-        cam = {
-            "id": int(values["camid"]),
-            "type": values["camtype"],
-            "name": values["camname"] or f"{values['camtype']} {values['camid']}"
-        }
-        
         if event == "add":
+            try:
+                fps = int(values["camfps"])
+            except ValueError:
+                fps = 0
+            if fps <= 0:
+                sg.popup("FPS must be a whole number greater than 0!")
+                continue
+
+            cam = {
+                "id": int(values["camid"]),
+                "type": values["camtype"],
+                "name": values["camname"] or f"{values['camtype']} {values['camid']}",
+                "resolution": [int(x) for x in values["camres"].split("x")],
+                "fps": fps
+            }
             if len([x for x in calib["cameras"] if (x["id"] == cam["id"] and x["type"] == cam["type"]) or (x["name"] == cam["name"])]) == 0:
                 calib["cameras"].append(cam)
                 window.close()
@@ -105,6 +125,17 @@ def settings():
         window.close()
         return False
     
+undistorters = {}
+def get_undistorter(cam):
+    # Undistorts the preview of cam, kept until its intrinsics change
+    if "intrinsics" not in cam:
+        return None
+    undistorter = undistorters.get(id(cam))
+    if undistorter is None or undistorter.intrinsics is not cam["intrinsics"]:
+        undistorter = undistorters[id(cam)] = preview.Undistorter(cam["intrinsics"])
+    return undistorter
+
+# cap is the preview.FrameGrabber of the camera
 def calibrate_intrinsics(cam, cap):
     calibrate_intrinsics_layout = [
         [sg.Column([
@@ -116,60 +147,42 @@ def calibrate_intrinsics(cam, cap):
         ], element_justification='center')],
     ]
 
-    columns = calib['settings']['checkerboard_columns']
-    rows = calib['settings']['checkerboard_rows']
-    world_scaling = calib['settings']['checkerboard_box_size_scale']
-
-    #coordinates of squares in the checkerboard world space
-    objp = np.zeros((rows*columns,3), np.float32)
-    objp[:,:2] = np.mgrid[0:rows,0:columns].T.reshape(-1,2)
-    objp = world_scaling* objp
-
-    imgpoints = []
-    objpoints = []
+    # The checkerboard gets searched on a pool of threads, this loop only shows the frames (see utils/calibration.py)
+    checkerboard = calibration.Checkerboard.from_settings(calib['settings'])
+    collector = calibration.CheckerboardCollector(checkerboard)
+    frames = calib['settings']['mono_calibration_frames']
 
-    framecnt = 0
-    captured = 0
     window = sg.Window("Intrinsics Calibration", calibrate_intrinsics_layout)
+    shown = preview.Preview()
     while True:
         event, values = window.read(timeout=1)
         if event == "quit" or event is None:
+            collector.close()
             window.close()
             return
 
         ret, frame = cap.read()
         if ret:
             frame = cv2.rotate(frame,2)
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            ret2, corners = cv2.findChessboardCornersSB(gray, (rows, columns), None, cv2.CALIB_CB_EXHAUSTIVE | cv2.CALIB_CB_ACCURACY)
-            if ret2 == True:
-                if framecnt % 2 == 0:
-                    objpoints.append(objp)
-                    imgpoints.append(corners)
-                    captured += 1
-                
-                cv2.drawChessboardCorners(frame, (rows, columns), corners, ret2)
-        framecnt += 1
-        
-        if ret:
-            window["img"].update(data=cv2.imencode(".png", frame)[1].tobytes())
+            collector.submit(frame)
+        captured = collector.collect()
+
+        if ret and shown.due:
+            if collector.corners is not None:
+                cv2.drawChessboardCorners(frame, (checkerboard.rows, checkerboard.columns), collector.corners, True)
+            shown.update(window["img"], frame)
 
-        if captured >= calib['settings']['mono_calibration_frames']:
+        if captured >= frames:
             window.close()
             break
 
-        window["status"].update(f"Captured {captured}/{calib['settings']['mono_calibration_frames']} frames")
+        window["status"].update(f"Captured {captured}/{frames} frames ({collector.similar} skipped, too similar to captured ones)")
+    collector.close()
 
     window = sg.Window("Intrinsics Calibration", [[sg.Text('Calibrating...', font="SegoeUI 12", justification='center')]])
     window.read(timeout=100)
 
-    height, width = frame.shape[:2]    
-    ret, cmtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, (width, height), None, None)
-    cam["intrinsics"] = {
-        "cmtx": cmtx.tolist(),
-        "dist": dist.tolist(),
-        "opt_cmtx": cv2.getOptimalNewCameraMatrix(cmtx, dist, (width, height), 1, (width, height))[0].tolist(),
-    }
+    cam["intrinsics"], error = collector.calibrate()
 
     window.close()
 
@@ -186,15 +199,22 @@ def calibrate_extrinsics():
         ], element_justification='center')],
     ]
 
+    # Every camera gets read on a thread of its own, and the intrinsics are parsed once (see utils/preview.py)
+    # The intrinsics get scaled to the resolution of the camera, when it was calibrated at another one
     cameras = []
-    for cam in calib["cameras"]:
-        cameras.append(get_cam(cam["type"], cam["id"]))
+    intrinsics = []
+    for i, cam in enumerate(calib["cameras"]):
+        cameras.append(preview.FrameGrabber(get_cam(i)))
+        width, height = vision.camera_mode(calib, i)[0]
+        intrinsics.append(calibration.scale_intrinsics(cam["intrinsics"], (height, width))[:2] if "intrinsics" in cam else (None, None))
+    undistorters = [get_undistorter(cam) for cam in calib["cameras"]]
     
     window = sg.Window("Extrinsics Calibration", calibrate_intrinsics_layout)
+    shown = preview.Preview()
     collection = False
     extrinsics = [{ } for i in range(len(cameras))]
 
-    colors = [np.full((480, 640, 3), (0, (5-i) * 51, i * 51), dtype=np.uint8) for i in range(6)]
+    overlays = {} # tints for how long ago each camera saw the marker, for every frame size
     lastseen = [5 for i in range(len(cameras))]
 
     dictionary = aruco.getPredefinedDictionary(aruco.DICT_4X4_250)
@@ -204,9 +224,13 @@ def calibrate_extrinsics():
     s = calib["settings"]["aruco_size"]
     t = calib["settings"]["aruco_calibration_frames"]
 
+    img = np.zeros((480, 640, 3), np.uint8)
+    n = math.ceil(math.sqrt(len(cameras)))
     while True:
         event, values = window.read(timeout=10)
         if event == "quit" or event is None:
+            for grabber in cameras:
+                grabber.stop()
             for i in range(len(cameras)):
                 del cameras[0]
             del cameras
@@ -216,20 +240,22 @@ def calibrate_extrinsics():
         if event == "calibrate":
             collection = True
             for i in range(len(cameras)):
-                extrinsics[i]["rvecs"] = []
-                extrinsics[i]["tvecs"] = []
+                extrinsics[i]["corners"] = []
             lastseen = [5 for i in range(len(cameras))]
             continue
 
-        img = np.zeros((480, 640, 3), np.uint8)
-        n = math.ceil(math.sqrt(len(cameras)))
-        for i, cam in enumerate(cameras):
-            ret, frame = cam.read()
-            frame = cv2.rotate(frame,2) #rotate camera sideways, as that gives more vertical space. Should be a setting somewhere
+        # Before collecting, frames only need to be looked at when the preview gets updated
+        due = shown.due
+        if not collection and not due:
+            continue
+
+        for i, grabber in enumerate(cameras):
+            ret, frame = grabber.read()
             if ret:
-                if "intrinsics" in calib["cameras"][i]:
-                    cmtx, dist, opt_cmtx = np.array(calib["cameras"][i]["intrinsics"]["cmtx"]), np.array(calib["cameras"][i]["intrinsics"]["dist"]), np.array(calib["cameras"][i]["intrinsics"]["opt_cmtx"])
-                    frame = cv2.undistort(frame, cmtx, dist, None, opt_cmtx)
+                frame = cv2.rotate(frame,2) #rotate camera sideways, as that gives more vertical space. Should be a setting somewhere
+                cmtx, dist = intrinsics[i]
+                if undistorters[i] is not None:
+                    frame = undistorters[i](frame)
                 
                 gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
                 corners, ids, rejectedImgPoints = detector.detectMarkers(gray)
@@ -241,8 +267,9 @@ def calibrate_extrinsics():
                     else:
                         lastseen[i] = min(5, lastseen[i] + 0.1)
                       
-                    colors = [np.full(frame.shape, (0, (5-i) * 51, i * 51), dtype=np.uint8) for i in range(6)] #since the image is no longer always 640x480, we change the size to frame.shape
-                    frame = cv2.addWeighted(frame, 1, colors[int(lastseen[i])], 0.1, 0)
+                    if frame.shape not in overlays:
+                        overlays[frame.shape] = [np.full(frame.shape, (0, (5-i) * 51, i * 51), dtype=np.uint8) for i in range(6)]
+                    frame = cv2.addWeighted(frame, 1, overlays[frame.shape][int(lastseen[i])], 0.1, 0)
 
                     if i == 0 and len(corners) > 0:
                         ret, rvec, tvec = cv2.solvePnP(np.array([[0, 0, 0], [s, 0, 0], [s, 0, s], [0, 0, s]], dtype=np.float32), corners[0][0], cmtx, dist)
@@ -253,41 +280,42 @@ def calibrate_extrinsics():
                         frame = cv2.line(frame, imgpts[0], imgpts[2], (0,255,0), 3)
                         frame = cv2.line(frame, imgpts[0], imgpts[3], (255,0,0), 3)
                 else:
-                    if len(corners) > 0 and len(extrinsics[i]['rvecs']) < t:
-                        ret, rvec, tvec = cv2.solvePnP(np.array([[0, 0, 0], [s, 0, 0], [s, 0, s], [0, 0, s]], dtype=np.float32), corners[0][0], cmtx, dist)
-                        imgpts, jac = cv2.projectPoints(np.array([[0, 0, 0], [s, 0, 0], [0, s, 0], [0, 0, s]], dtype=np.float32), rvec, tvec, cmtx, dist)
-
-                        imgpts = np.int32(imgpts).squeeze()
-                        frame = cv2.line(frame, imgpts[0], imgpts[1], (0,0,255), 3)
-                        frame = cv2.line(frame, imgpts[0], imgpts[2], (0,255,0), 3)
-                        frame = cv2.line(frame, imgpts[0], imgpts[3], (255,0,0), 3)
-
-                        extrinsics[i]["rvecs"].append(cv2.Rodrigues(rvec)[0])
-                        extrinsics[i]["tvecs"].append(tvec)
+                    if len(corners) > 0 and len(extrinsics[i]['corners']) < t:
+                        extrinsics[i]["corners"].append(corners[0][0])
+                        if due:
+                            ret, rvec, tvec = cv2.solvePnP(np.array([[0, 0, 0], [s, 0, 0], [s, 0, s], [0, 0, s]], dtype=np.float32), corners[0][0], cmtx, dist)
+                            imgpts, jac = cv2.projectPoints(np.array([[0, 0, 0], [s, 0, 0], [0, s, 0], [0, 0, s]], dtype=np.float32), rvec, tvec, cmtx, dist)
+
+                            imgpts = np.int32(imgpts).squeeze()
+                            frame = cv2.line(frame, imgpts[0], imgpts[1], (0,0,255), 3)
+                            frame = cv2.line(frame, imgpts[0], imgpts[2], (0,255,0), 3)
+                            frame = cv2.line(frame, imgpts[0], imgpts[3], (255,0,0), 3)
                     
-                    cv2.putText(frame, f"Captured {len(extrinsics[i]['rvecs'])}/{t} frames", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
+                    cv2.putText(frame, f"Captured {len(extrinsics[i]['corners'])}/{t} frames", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
                 
-                img[480//n*(i//n):480//n*(i//n+1), 640//n*(i%n):640//n*(i%n+1)] = cv2.resize(frame, (640//n, 480//n))
+                # the tile of a camera stays until it has a new frame
+                if due:
+                    img[480//n*(i//n):480//n*(i//n+1), 640//n*(i%n):640//n*(i%n+1)] = cv2.resize(frame, (640//n, 480//n), interpolation=cv2.INTER_AREA)
 
         # crop bottom
         d = math.ceil(len(cameras) / n)
-        img = img[:480//n*d, :]
-
-        window["img"].update(data=cv2.imencode(".png", img)[1].tobytes())
+        shown.update(window["img"], img[:480//n*d, :])
 
         # if all cameras have captured enough frames, stop
-        if collection and all([len(extrinsics[i]['rvecs']) >= t for i in range(len(cameras))]):
+        if collection and all([len(extrinsics[i]['corners']) >= t for i in range(len(cameras))]):
             break
 
-    # calculate average rvec and tvec for each camera
+    # solve the pose of each camera from all of its frames (see utils/calibration.py)
     for i in range(len(cameras)):
-        extrinsics[i]["rvec"] = np.mean(extrinsics[i]["rvecs"], axis=0)
-        extrinsics[i]["tvec"] = np.mean(extrinsics[i]["tvecs"], axis=0)
+        cmtx, dist = intrinsics[i]
+        rvec, tvec, used = calibration.marker_pose(extrinsics[i]["corners"], s, cmtx, dist)
         calib["cameras"][i]["extrinsics"] = {
-            "rvec": extrinsics[i]["rvec"].tolist(),
-            "tvec": extrinsics[i]["tvec"].tolist()
+            "rvec": rvec.tolist(),
+            "tvec": tvec.tolist()
         }
     
+    for grabber in cameras:
+        grabber.stop()
     for i in range(len(cameras)):
         del cameras[0]
     del cameras
@@ -312,6 +340,21 @@ cam = None
 cap = None
 prevcamval = None
 main_window = sg.Window('Calibration Tool', main_layout)
+main_preview = preview.Preview()
+
+def open_camera(index):
+    # The frames of the selected camera get read on a background thread (see utils/preview.py)
+    global cap, cam
+    close_camera()
+    cam = calib["cameras"][index]
+    cap = preview.FrameGrabber(get_cam(index))
+
+def close_camera():
+    global cap
+    if cap:
+        cap.stop()
+        del cap
+    cap = None
 
 def update_camera_list():
     global cap, prevcamval, cam
@@ -319,13 +362,10 @@ def update_camera_list():
 
     if len(calib["cameras"]) > 0:
         main_window["cameras"].update(set_to_index=0)
-        if cap:
-            del cap
-        cam = calib["cameras"][0]
-        cap = get_cam(cam["type"], cam["id"])
+        open_camera(0)
         prevcamval = main_window["cameras"].get_indexes()[0]
     else:
-        cap = None
+        close_camera()
 
 
 main_window.read(timeout=1)
@@ -338,10 +378,7 @@ while True:
 
     elif len(main_window["cameras"].get_indexes()) > 0 and main_window["cameras"].get_indexes()[0] != prevcamval:
         prevcamval = main_window["cameras"].get_indexes()[0]
-        if cap:
-            del cap
-        cam = calib["cameras"][prevcamval]
-        cap = get_cam(cam["type"], cam["id"])
+        open_camera(prevcamval)
     
     elif event == "add_camera":
         add_camera()
@@ -363,17 +400,22 @@ while True:
     
     elif event == "extrinsics":
         #cap.__del__()              #this caused a crash. Works okay without?
+        # the extrinsics window reads all cameras itself
+        if cap:
+            cap.stop()
         calibrate_extrinsics()
         save_calib()
         update_camera_list()
     
     elif cap:
 
+        if not main_preview.due:
+            continue
         ret, frame = cap.read()
         if not ret:
             continue
         frame = cv2.rotate(frame,2) #rotate camera sideways, as that gives more vertical space. Should be a setting somewhere
-        if "intrinsics" in cam:
-            cmtx, dist, opt_cmtx = np.array(cam["intrinsics"]["cmtx"]), np.array(cam["intrinsics"]["dist"]), np.array(cam["intrinsics"]["opt_cmtx"])
-            frame = cv2.undistort(frame, cmtx, dist, None, opt_cmtx)
-        main_window['img'].update(data=cv2.imencode('.png', frame)[1].tobytes())
+        undistort = get_undistorter(cam)
+        if undistort:
+            frame = undistort(frame)
+        main_preview.update(main_window['img'], frame)
@@ -0,0 +1,198 @@
+# Recording and replaying of the raw camera frames, for reproducing problems and A/B testing on identical input
+# A recording is a directory with two files per camera:
+#   cam<i>.frames: a header, followed by one fixed-size slot per frame (so the file can be memory-mapped as an array)
+#   cam<i>.index:  the capture time (time.monotonic) and capture number of every frame in the slots
+# and a calib.json which replays the recording when used instead of the normal calib.json.
+import threading
+import struct
+import queue
+import json
+import time
+import os
+
+import numpy as np
+
+HEADER_SIZE = 4096 # Slots start on a page boundary
+SLOT_ALIGN = 4096
+header = struct.Struct("<8sIIIIQ") # magic, version, height, width, channels, slot size
+index_dtype = np.dtype([("time", "<f8"), ("sequence", "<u8")])
+
+def start_recording(directory, calib):
+    # Creates the directory of a new recording, with a calib.json for replaying it
+    path = os.path.join(directory, time.strftime("%Y%m%d_%H%M%S"))
+    os.makedirs(path, exist_ok=True)
+
+    cameras = [{**camera, "type": "Replay", "id": i, "path": path} for i, camera in enumerate(calib["cameras"])]
+    with open(os.path.join(path, "calib.json"), "w") as f:
+        json.dump({**calib, "cameras": cameras}, f, indent=4)
+    print("Recording to {}".format(path))
+    return path
+
+
+class FrameRecorder:
+    # Appends the frames of one camera to cam<i>.frames, from a background thread
+    # write() never blocks, frames get dropped when the disk can't keep up (they show up as gaps in the sequence)
+    # Frames must not be modified after they have been written
+    def __init__(self, path, queue_size=64):
+        self.path = path
+        self.queue = queue.Queue(queue_size)
+        self.sequence = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._write_loop, name="recorder_" + os.path.basename(path), daemon=True)
+        self.thread.start()
+
+    def write(self, frame, timestamp):
+        try:
+            self.queue.put_nowait((frame, timestamp, self.sequence))
+        except queue.Full:
+            self.dropped += 1
+        self.sequence += 1
+
+    def _write_loop(self):
+        frames = None
+        shape = None
+        padding = b""
+        with open(self.path + ".index", "wb") as index:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+
+                frame, timestamp, sequence = item
+                frame = frame[:, :, None] if frame.ndim == 2 else frame
+                if frames is None:
+                    shape = frame.shape
+                    slot_size = (frame.nbytes + SLOT_ALIGN - 1) // SLOT_ALIGN * SLOT_ALIGN
+                    padding = bytes(slot_size - frame.nbytes)
+                    frames = open(self.path + ".frames", "wb")
+                    frames.write(header.pack(b"TTFRAMES", 1, *shape, slot_size).ljust(HEADER_SIZE, b"\0"))
+                elif frame.shape != shape:
+                    continue # Slots have a fixed size
+
+                frames.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+                frames.write(padding)
+                index.write(np.array([(timestamp, sequence)], dtype=index_dtype).tobytes())
+
+        if frames is not None:
+            frames.close()
+
+    def close(self):
+        # Waits until all queued frames have been written
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ReplayClock:
+    # Decides which frame each camera of a recording returns, the cameras of a recording share one clock
+    #   "realtime": frames are returned at the time they were captured, frames are skipped when reading is too slow
+    #   "fast":     every frame is returned, as fast as they get read
+    #   "lockstep": every camera returns the frame closest in time to the next frame of camera 0,
+    #               but only after the previous frame set has left the pipeline (see frame_done)
+    #               Nothing gets dropped and the ROI of the previous frame set is always known, so every run gets the same input
+    clocks = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path, mode):
+        with cls.lock:
+            key = (os.path.abspath(path), mode)
+            if key not in cls.clocks:
+                cls.clocks[key] = cls(mode)
+            return cls.clocks[key]
+
+    def __init__(self, mode):
+        if mode not in ("realtime", "fast", "lockstep"):
+            raise ValueError('Unknown replay mode: {}'.format(mode))
+
+        self.mode = mode
+        self.cameras = {}
+        self.cond = threading.Condition()
+        self.start = None
+        self.t0 = None
+        self.done = 0
+
+    def register(self, camera):
+        self.cameras[camera.id] = camera
+
+    def _start(self):
+        with self.cond:
+            if self.start is None:
+                self.t0 = min(camera.times[0] for camera in self.cameras.values() if len(camera.times))
+                self.start = time.monotonic()
+
+    def next_frame(self, camera):
+        # Index of the frame camera.read() should return, or None at the end of the recording
+        if self.start is None:
+            self._start()
+
+        times = camera.times
+        if self.mode == "fast":
+            i = camera.position
+
+        elif self.mode == "realtime":
+            # The latest frame which has been captured by now, or wait for the next one
+            latest = np.searchsorted(times, time.monotonic() - self.start + self.t0, "right") - 1
+            i = max(camera.position, latest)
+            if i < len(times):
+                delay = self.start + times[i] - self.t0 - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+        else:
+            step = camera.position
+            with self.cond:
+                while self.done < step:
+                    self.cond.wait()
+
+            reference = self.cameras[min(self.cameras)].times
+            if step >= len(reference):
+                return None
+            i = min(np.searchsorted(times, reference[step]), len(times) - 1)
+            if i > 0 and reference[step] - times[i - 1] < times[i] - reference[step]:
+                i -= 1
+            camera.position = step + 1
+            return i
+
+        if i >= len(times):
+            return None
+        camera.position = i + 1
+        return i
+
+    def frame_done(self, trace, completed):
+        # Listener of the pipeline, called when a frame set has been sent or dropped
+        with self.cond:
+            self.done += 1
+            self.cond.notify_all()
+
+
+class ReplayCamera:
+    # Replays camera id of a recording, with the same read() as camera.binding.Camera and cv2.VideoCapture
+    # The frames are read-only views into the memory-mapped recording
+    def __init__(self, path, id, mode="realtime"):
+        self.id = int(id)
+        base = os.path.join(path, "cam{}".format(self.id))
+
+        with open(base + ".frames", "rb") as f:
+            magic, version, height, width, channels, slot_size = header.unpack(f.read(header.size))
+        if magic != b"TTFRAMES":
+            raise ValueError("{}.frames is not a recording".format(base))
+        self.shape = (height, width, channels)
+
+        count = (os.path.getsize(base + ".frames") - HEADER_SIZE) // slot_size
+        index = np.fromfile(base + ".index", dtype=index_dtype)[:count]
+        if len(index) == 0:
+            raise ValueError("{} has no frames".format(base))
+        self.times = index["time"]
+        self.sequence = index["sequence"]
+        slots = np.memmap(base + ".frames", dtype=np.uint8, mode="r", offset=HEADER_SIZE, shape=(len(index), slot_size))
+        self.frames = slots[:, :height * width * channels].reshape(len(index), *self.shape)
+
+        self.position = 0
+        self.clock = ReplayClock.get(path, mode)
+        self.clock.register(self)
+
+    def read(self):
+        i = self.clock.next_frame(self)
+        if i is None:
+            return False, None
+        return True, self.frames[i]
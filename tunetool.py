@@ -0,0 +1,261 @@
+# Tunes the filter and triangulation settings on a session log (see session_log in settings.json), faster than realtime
+# The raw 2d landmarks of the log go through the same post processing as in the tracker: flip detection, the 2d filter,
+# triangulation, skeleton fitting, the 3d filter and the tracker poses. The cameras and the models aren't needed.
+#
+#   python tunetool.py sessions/session_20240101_120000.tlog --sweep sweep.json
+#
+# The sweep file contains the settings to try (on top of settings.json), every list gets expanded into its options:
+#   {
+#       "2d_filter": {"type": "OneEuro", "mincutoff": [0.5, 1, 2], "beta": [0.005, 0.01], "dcutoff": 1},
+#       "3d_filter": [null, {"type": "OneEuro", "mincutoff": [0.05, 0.2, 0.5], "beta": 80, "dcutoff": 1}],
+#       "multicam_val": [0.5, 0.625, 0.75],
+#       "flip_detection": [false, true]
+#   }
+# gives 6 * 4 * 3 * 2 = 144 configurations. A list of sweep objects tries each of them.
+#
+# Every configuration gets scored on the positions of the trackers, against a reference which is the unfiltered
+# triangulation smoothed without delay (which is only possible afterwards):
+#   jitter: RMS distance (mm) between the tracker positions and a delay free smoothing of themselves
+#   lag:    delay (ms) of the tracker positions which matches the reference best
+#   error:  RMS distance (mm) between the tracker positions and the reference
+# The configurations are ranked by jitter + lag_weight * lag.
+import multiprocessing
+import itertools
+import argparse
+import json
+import time
+
+import numpy as np
+import pyjson5
+
+from utils import sessionlog, inference, vision, stages, pose, config
+
+# Settings which change the triangulated points, configurations which share them only get triangulated once
+TRIANGULATION_SETTINGS = ["fps", "2d_filter", "flip_detection", "flip_detection_max", "multicam_mode", "multicam_val",
+                          "multicam_max_error", "scale_multiplier", "flip_x", "flip_y", "flip_z", "swap_xz"]
+
+def expand(value):
+    # Every combination of the options of the lists in value
+    if isinstance(value, list):
+        return [option for item in value for option in expand(item)]
+    if isinstance(value, dict):
+        keys = list(value)
+        return [dict(zip(keys, combination)) for combination in itertools.product(*(expand(value[key]) for key in keys))]
+    return [value]
+
+
+#region Replay
+class Session:
+    # The frames of a session log, with the landmarks from before flip detection and filtering
+    def __init__(self, path, calib=None):
+        header, records = sessionlog.load(path)
+        if len(records) < 10:
+            raise ValueError("{} has too few frames".format(path))
+
+        self.landmarks = records["landmarks"].astype(np.float64)
+        if "raw_landmarks" in records.dtype.names and not np.isnan(records["raw_landmarks"][:, 0, 0, 0]).any():
+            self.landmarks = records["raw_landmarks"].astype(np.float64)
+            self.raw = True
+        else:
+            # Older logs, and logs of trackers running the landmark stage in another process
+            self.raw = False
+        self.flags = records["flags"].astype(np.float64)
+
+        # Filters get the capture times, which are what the tracker would have seen without any processing delay
+        self.times = np.where(np.isnan(records["capture"]), records["time"], records["capture"]) * 1000
+
+        if "proj" in header:
+            proj = [np.array(p) for p in header["proj"]]
+        else:
+            if calib is not None:
+                vision.calib = pyjson5.decode_io(open(calib, "r"))
+            proj = [vision.get_projection_matrix(i) for i in range(header["cameras"])]
+        self.oncm = [(None, None, None, None, None, p) for p in proj]
+
+        # Reprojection errors are compared at 640x480 like in the tracker, older logs are taken to be 640x480
+        self.pixel_scale = None
+        if "resolutions" in header:
+            self.pixel_scale = [res[0] / vision.DEFAULT_RESOLUTION[0] for res in header["resolutions"]]
+
+    def missing_joints(self, joints):
+        # Joints which weren't processed while logging, those are left at zero by the landmark stage
+        return [int(j) for j in joints if not self.landmarks[:, :, j, :2].any()]
+
+    def triangulate(self, settings):
+        # Triangulated points (frames, 39, 3) for the 2d settings (a config.Config)
+        post = stages.PoseLandmarkPostStage(len(self.oncm), settings)
+        triangulator = vision.Triangulator(self.oncm, settings.multicam_max_error, pixel_scale=self.pixel_scale)
+        triangulation = stages.TriangulationStage(self.oncm, triangulator, settings)
+
+        points = np.zeros((len(self.times), 39, 3))
+        prev_landmarks, prev_t = None, None
+        for k, t in enumerate(self.times):
+            landmarks = self.landmarks[k].copy()
+            if settings.flip_detection and prev_landmarks is not None and t - prev_t < 100:
+                inference.autoflip(prev_landmarks, landmarks, settings.flip_detection_max)
+            prev_landmarks, prev_t = landmarks, t
+
+            post.smooth(landmarks, t)
+            values = [(None, landmarks[i], self.flags[k, i:i + 1]) for i in range(len(self.oncm))]
+            points[k] = triangulation.triangulate(values)[0]
+        return points
+
+    def trackers(self, settings, triangulated):
+        # Tracker positions (frames, trackers, 3) for the 3d settings, NaN for trackers which aren't sent
+        triangulation = stages.TriangulationStage(self.oncm, None, settings)
+        tap = sessionlog.TrackerTap(NullClient())
+        positions = np.zeros((len(self.times), len(sessionlog.TRACKERS), 3))
+        for k, t in enumerate(self.times):
+            points = triangulation.smooth(triangulated[k].copy(), t)
+            pose.calc_pose(points, tap, settings.send_rot, settings.extra_trackers)
+            positions[k] = tap.positions
+        return positions
+
+
+class NullClient:
+    def send_pos(self, p, v = [0,0,0]):
+        pass
+
+    def send_rot(self, p, v = [0,0,0]):
+        pass
+
+    def flush(self):
+        pass
+#endregion
+
+
+#region Scoring
+def smooth(x, sigma):
+    # Gaussian smoothing along the first axis, without delay. sigma is in frames
+    radius = max(int(3 * sigma), 1)
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    kernel /= kernel.sum()
+
+    flat = x.reshape(len(x), -1)
+    padded = np.pad(flat, ((radius, radius), (0, 0)), mode="edge")
+    result = np.stack([np.convolve(padded[:, i], kernel, mode="valid") for i in range(flat.shape[1])], axis=1)
+    return result.reshape(x.shape)
+
+
+def score(positions, reference, frame_time, sigma, max_lag, lag_weight):
+    sent = ~np.isnan(positions).any(axis=(0, 2)) & ~np.isnan(reference).any(axis=(0, 2))
+    positions, reference = positions[:, sent] * 1000, reference[:, sent] * 1000 # mm
+
+    jitter = np.sqrt(np.mean(np.sum((positions - smooth(positions, sigma)) ** 2, axis=2)))
+    error = np.sqrt(np.mean(np.sum((positions - reference) ** 2, axis=2)))
+
+    # positions[k + lag] matches reference[k] best, with a parabola through the best shift and its neighbours
+    shifts = np.arange(min(int(max_lag / frame_time), len(positions) // 2) + 1)
+    errors = np.array([np.mean(np.sum((positions[s:] - reference[:len(reference) - s]) ** 2, axis=2)) for s in shifts])
+    best = int(np.argmin(errors))
+    lag = float(best)
+    if 0 < best < len(errors) - 1:
+        a, b, c = errors[best - 1:best + 2]
+        if a - 2 * b + c > 0:
+            lag += 0.5 * (a - c) / (a - 2 * b + c)
+    lag *= frame_time
+
+    return {"score": jitter + lag_weight * lag, "jitter": jitter, "lag": lag, "error": error}
+#endregion
+
+
+#region Workers
+session = None
+reference = None
+options = None
+
+def init_worker(path, calib, reference_positions, args):
+    global session, reference, options
+    session = Session(path, calib)
+    reference = reference_positions
+    options = args
+
+
+def run_group(configs):
+    # Triangulates once for the configurations of a group, which only differ in their 3d settings
+    triangulated = session.triangulate(configs[0][1])
+
+    results = []
+    for index, settings in configs:
+        positions = session.trackers(settings, triangulated)
+        results.append((index, score(positions, reference, options["frame_time"], options["sigma"], options["max_lag"], options["lag_weight"])))
+    return results
+#endregion
+
+
+def format_config(sweep):
+    return ", ".join("{}={}".format(key, json.dumps(value)) for key, value in sweep.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tunes the filter and triangulation settings on a session log")
+    parser.add_argument("log", help="session log (.tlog) recorded with session_log enabled")
+    parser.add_argument("--sweep", required=True, help="JSON file with the settings to try")
+    parser.add_argument("--settings", default="settings.json", help="settings the sweep is applied to")
+    parser.add_argument("--calib", help="calib.json for logs without the projection matrices (default: calib.json)")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="number of processes")
+    parser.add_argument("--lag-weight", type=float, default=0.05, help="mm of jitter which are worth 1 ms of lag")
+    parser.add_argument("--sigma", type=float, default=50, help="ms of smoothing for the reference and the jitter")
+    parser.add_argument("--max-lag", type=float, default=500, help="largest lag in ms which gets searched")
+    parser.add_argument("--top", type=int, default=10, help="number of configurations to show")
+    parser.add_argument("--output", help="write all results to this JSON file")
+    args = parser.parse_args()
+
+    base = pyjson5.decode_io(open(args.settings, "r"))
+    # Nothing which needs a window, a headset or a user
+    base.update({"debug": False, "draw_pose": False, "owotrack": False, "session_log": False})
+    configs = expand(pyjson5.decode_io(open(args.sweep, "r")))
+    unknown = config.unknown_settings({key: None for sweep in configs for key in sweep})
+    if unknown:
+        parser.error("unknown settings in the sweep: {}".format(", ".join(unknown)))
+
+    start = time.monotonic()
+    tuning = Session(args.log, args.calib)
+    if not tuning.raw:
+        print("Warning: the log has no raw landmarks, flip detection and the 2d filter of the tracker are applied twice")
+    frame_time = float(np.median(np.diff(tuning.times)))
+    options = {"frame_time": frame_time, "sigma": args.sigma / frame_time, "max_lag": args.max_lag, "lag_weight": args.lag_weight}
+
+    # Configurations which share their triangulation settings and joints get run by the same worker
+    groups = {}
+    for index, sweep in enumerate(configs):
+        try:
+            settings = config.from_dict({**base, **sweep})
+        except ValueError as e:
+            parser.error("{} ({})".format(e, format_config(sweep)))
+        joints = pose.select_joints(settings)
+        missing = tuning.missing_joints(joints)
+        if missing:
+            parser.error("the log has no landmarks for joints {} which are needed by {}".format(missing, format_config(sweep)))
+        key = json.dumps([[{**base, **sweep}.get(name) for name in TRIANGULATION_SETTINGS], joints.tolist()])
+        groups.setdefault(key, []).append((index, settings))
+
+    # The reference is the unfiltered triangulation of the base settings, smoothed without delay
+    raw_settings = config.from_dict({**base, "2d_filter": None, "3d_filter": None, "skeleton_fit": False})
+    reference = smooth(tuning.trackers(raw_settings, tuning.triangulate(raw_settings)), options["sigma"])
+
+    print("{} frames ({:.0f} s), {} configurations in {} triangulation groups, {} workers".format(
+        len(tuning.times), (tuning.times[-1] - tuning.times[0]) / 1000, len(configs), len(groups), args.workers))
+
+    results = [None] * len(configs)
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(args.workers, init_worker, (args.log, args.calib, reference, options)) as pool:
+        for group_results in pool.imap_unordered(run_group, groups.values()):
+            for index, result in group_results:
+                results[index] = {**result, "config": configs[index]}
+            done = sum(result is not None for result in results)
+            print("\r{}/{} configurations".format(done, len(configs)), end="", flush=True)
+    print(" in {:.1f} s".format(time.monotonic() - start))
+
+    results.sort(key=lambda result: result["score"])
+    print("\n{:>4} {:>8} {:>10} {:>8} {:>10}  {}".format("rank", "score", "jitter mm", "lag ms", "error mm", "settings"))
+    for rank, result in enumerate(results[:args.top], 1):
+        print("{:>4} {:>8.2f} {:>10.2f} {:>8.1f} {:>10.2f}  {}".format(
+            rank, result["score"], result["jitter"], result["lag"], result["error"], format_config(result["config"])))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"time": time.time(), "log": args.log, "args": vars(args), "results": results}, f, indent=4)
+
+if __name__ == "__main__":
+    main()
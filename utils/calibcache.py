@@ -0,0 +1,138 @@
+# Compiled calibration, written by calibtool.py next to calib.json (calib.json -> calib.bin)
+# It holds everything the tracker would otherwise compute from calib.json while starting: the projection matrices,
+# the optimal camera matrices and the undistort maps. The maps go from the raw camera frame straight to the rotated,
+# undistorted frame, so the camera stages need a single cv2.remap per frame instead of cv2.rotate and cv2.undistort.
+# Like the session logs (see utils/sessionlog.py) the file is a JSON header padded to a multiple of 4096 bytes,
+# followed by the arrays, which load() reads in one go. They are read rather than memory-mapped, as Windows doesn't
+# allow replacing a mapped file, which would keep calibtool.py from saving while the tracker is running.
+# The header has a hash of the cameras in calib.json, the tracker only uses the file when it still matches.
+# Every camera gets compiled for its own resolution (see vision.camera_mode), with its intrinsics scaled to it.
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+from . import calibration
+from . import vision
+
+HEADER_SIZE = 4096
+VERSION = 2
+ALIGNMENT = 64
+
+def resolutions(calib):
+    # Of the raw camera frames, before rotating
+    return [vision.camera_mode(calib, i)[0] for i in range(len(calib["cameras"]))]
+
+
+def calib_hash(calib):
+    # Changes whenever anything which ends up in the compiled calibration changes
+    data = {"version": VERSION, "resolutions": resolutions(calib), "cameras": calib["cameras"]}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def compile_camera(camera, res=vision.DEFAULT_RESOLUTION):
+    # The arrays of one camera of calib.json, res is the (width, height) of its raw frames
+    # The intrinsics are calibrated on the rotated frames (see calibtool.py), which are res turned sideways
+    width, height = res
+    size = (height, width)
+    cmtx, dist, _ = calibration.scale_intrinsics(camera["intrinsics"], size)
+    rvec = np.array(camera["extrinsics"]["rvec"], dtype=np.float64).squeeze()
+    tvec = np.array(camera["extrinsics"]["tvec"], dtype=np.float64)
+    proj = cmtx @ np.hstack([rvec, tvec.reshape(3, 1)])
+
+    optimal, _ = cv2.getOptimalNewCameraMatrix(cmtx, dist, size, 1, size)
+
+    # Position in the rotated frame of every pixel of the undistorted frame
+    map_x, map_y = cv2.initUndistortRectifyMap(cmtx, dist, None, optimal, size, cv2.CV_32FC1)
+    # The frames get rotated counterclockwise, pixel (x, y) of the rotated frame is pixel (width - 1 - y, x) of the raw frame
+    map1, map2 = cv2.convertMaps(width - 1 - map_y, map_x, cv2.CV_16SC2)
+
+    return {"cmtx": cmtx, "dist": dist, "optimal": optimal, "rvec": rvec, "tvec": tvec, "proj": proj, "map1": map1, "map2": map2}
+
+
+def compile_cameras(calib):
+    # The compiled cameras of calib, or None when a camera isn't calibrated yet
+    if not all("intrinsics" in camera and "extrinsics" in camera for camera in calib["cameras"]):
+        return None
+    return [compile_camera(camera, res) for camera, res in zip(calib["cameras"], resolutions(calib))]
+
+
+def save(calib, path="calib.bin"):
+    # Compiles calib and writes it to path, returns False (and removes an outdated file) when it can't be compiled
+    # Also returns False when path can't be replaced, which Windows doesn't allow while another program has it open
+    cameras = compile_cameras(calib)
+    if cameras is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+
+    # Offsets are relative to the end of the header
+    arrays = []
+    layout = []
+    offset = 0
+    for camera in cameras:
+        entries = {}
+        for name, array in camera.items():
+            array = np.ascontiguousarray(array)
+            entries[name] = [offset, array.dtype.str, list(array.shape)]
+            arrays.append((offset, array))
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        layout.append(entries)
+
+    header = json.dumps({"version": VERSION, "hash": calib_hash(calib), "resolutions": resolutions(calib), "cameras": layout}).encode()
+    header = header.ljust((len(header) // HEADER_SIZE + 1) * HEADER_SIZE, b"\0")
+
+    # Written next to the old file and then swapped in, so a running tracker never sees half a file
+    with open(path + ".tmp", "wb") as f:
+        f.write(header)
+        for position, array in arrays:
+            f.seek(len(header) + position)
+            f.write(array.tobytes())
+        f.truncate(len(header) + offset)
+    try:
+        os.replace(path + ".tmp", path)
+    except PermissionError:
+        os.remove(path + ".tmp")
+        print("{} is in use, close the tracker to update it".format(path))
+        return False
+    return True
+
+
+def load(calib, path="calib.bin"):
+    # The compiled cameras, or None when path is missing or doesn't match calib
+    try:
+        data = b""
+        with open(path, "rb") as f:
+            while b"\0" not in data:
+                block = f.read(HEADER_SIZE)
+                if not block:
+                    return None
+                data += block
+            header = json.loads(data.rstrip(b"\0"))
+            if header.get("version") != VERSION or header.get("hash") != calib_hash(calib):
+                return None
+            # The arrays are views into a single buffer, nothing keeps the file open
+            memory = np.fromfile(f, dtype=np.uint8)
+    except (OSError, ValueError):
+        return None
+
+    cameras = []
+    for entries in header["cameras"]:
+        camera = {}
+        for name, (offset, dtype, shape) in entries.items():
+            dtype = np.dtype(dtype)
+            camera[name] = memory[offset:offset + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+        cameras.append(camera)
+    return cameras
+
+
+def get_cameras(calib, path="calib.bin"):
+    # The compiled calibration of path, compiled from calib when the file is missing or outdated
+    cameras = load(calib, path)
+    if cameras is None:
+        if os.path.exists(path):
+            print("{} doesn't match the calibration, open calibtool.py to update it".format(path))
+        cameras = compile_cameras(calib)
+    return cameras
@@ -0,0 +1,219 @@
+# Checkerboard detection, intrinsics and extrinsics calibration for calibtool.py and calibbatch.py, without the GUI
+# Finding the checkerboard accurately takes a few hundred ms per frame, so it runs on a pool of threads (OpenCV releases
+# the GIL) while the GUI keeps showing frames. A fast pass on a downscaled frame skips frames without a checkerboard,
+# and the accurate pass only searches the part of the frame where the fast pass found it.
+# Frames which show the checkerboard almost like an already captured frame add little to the calibration,
+# so they get skipped: the captured frames end up covering more positions, distances and angles.
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import cv2
+import numpy as np
+
+INTRINSICS_SIZE = (480, 640) # of intrinsics without a size, which were calibrated on 640x480 frames turned sideways
+
+class Checkerboard:
+    # rows and columns are the numbers of inner corners, square is the size of a square (the unit of the extrinsics)
+    def __init__(self, rows, columns, square):
+        self.rows = rows
+        self.columns = columns
+        self.points = np.zeros((rows * columns, 3), np.float32)
+        self.points[:, :2] = np.mgrid[0:rows, 0:columns].T.reshape(-1, 2)
+        self.points *= square
+
+    @staticmethod
+    def from_settings(settings):
+        # The settings of calib.json
+        return Checkerboard(settings["checkerboard_rows"], settings["checkerboard_columns"], settings["checkerboard_box_size_scale"])
+
+
+def find_checkerboard(gray, rows, columns, precheck_scale=0.5, margin=0.1):
+    # Corners (rows * columns, 1, 2) of the checkerboard in a grayscale frame, or None
+    small = cv2.resize(gray, None, fx=precheck_scale, fy=precheck_scale, interpolation=cv2.INTER_AREA)
+    found, corners = cv2.findChessboardCornersSB(small, (rows, columns), None, 0)
+    if not found:
+        return None
+
+    # The accurate pass only looks at the checkerboard, and a margin around it
+    corners = corners.reshape(-1, 2) / precheck_scale
+    border = margin * (corners.max(axis=0) - corners.min(axis=0)) + 10
+    x0, y0 = np.maximum(corners.min(axis=0) - border, 0).astype(int)
+    x1, y1 = np.minimum(corners.max(axis=0) + border, (gray.shape[1], gray.shape[0])).astype(int)
+    found, corners = cv2.findChessboardCornersSB(gray[y0:y1, x0:x1], (rows, columns), None, cv2.CALIB_CB_EXHAUSTIVE | cv2.CALIB_CB_ACCURACY)
+    if not found:
+        return None
+    return corners + np.array([x0, y0], dtype=np.float32)
+
+
+def describe_view(corners, rows, columns, size):
+    # Where the checkerboard is in the frame, how large it is, and how it's turned and tilted, all about 0 to 1
+    # size is the (width, height) of the frame
+    grid = corners.reshape(columns, rows, 2)
+    outline = np.array([grid[0, 0], grid[0, -1], grid[-1, -1], grid[-1, 0]])
+    width, height = size
+    center = outline.mean(axis=0) / size
+    area = cv2.contourArea(outline.astype(np.float32)) / (width * height)
+
+    # Tilt makes the opposite edges of the checkerboard differ in length
+    edges = np.linalg.norm(outline - np.roll(outline, -1, axis=0), axis=1)
+    tilt = [(edges[0] - edges[2]) / (edges[0] + edges[2]), (edges[1] - edges[3]) / (edges[1] + edges[3])]
+    direction = outline[1] - outline[0]
+    angle = np.arctan2(direction[1], direction[0])
+    return np.array([center[0], center[1], np.sqrt(area), tilt[0] * 2, tilt[1] * 2, np.cos(angle) / 4, np.sin(angle) / 4])
+
+
+def view_difference(descriptor, descriptors):
+    # Distance of descriptor to the closest of descriptors
+    if len(descriptors) == 0:
+        return np.inf
+    return float(np.min(np.linalg.norm(np.array(descriptors) - descriptor, axis=1)))
+
+
+class CheckerboardCollector:
+    # Collects frames with the checkerboard for calibrating the intrinsics, see the top of this file
+    # Frames are only accepted while a worker is free, so the workers always get the latest frames and never fall behind
+    # min_difference is the smallest view_difference of a frame to the captured ones for capturing it as well
+    def __init__(self, checkerboard, workers=None, min_difference=0.05):
+        self.checkerboard = checkerboard
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="checkerboard")
+        self.min_difference = min_difference
+        self.pending = []
+        self.size = None
+        self.imgpoints = []
+        self.descriptors = []
+        self.similar = 0
+        self.corners = None # of the latest frame which has been searched, for drawing
+
+    def submit(self, frame):
+        # Returns False when all workers are busy, and the frame gets skipped
+        if len(self.pending) >= self.workers:
+            return False
+        self.size = (frame.shape[1], frame.shape[0])
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.pending.append(self.pool.submit(find_checkerboard, gray, self.checkerboard.rows, self.checkerboard.columns))
+        return True
+
+    def collect(self):
+        # Takes the results of the finished workers, returns the number of captured frames
+        for future in [future for future in self.pending if future.done()]:
+            self.pending.remove(future)
+            corners = self.corners = future.result()
+            if corners is None:
+                continue
+            descriptor = describe_view(corners, self.checkerboard.rows, self.checkerboard.columns, self.size)
+            if view_difference(descriptor, self.descriptors) < self.min_difference:
+                self.similar += 1
+                continue
+            self.imgpoints.append(corners)
+            self.descriptors.append(descriptor)
+        return len(self.imgpoints)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def calibrate(self):
+        # Intrinsics as stored in calib.json, and the RMS reprojection error in pixels
+        return calibrate_intrinsics(self.checkerboard, self.imgpoints, self.size)
+
+
+def calibrate_intrinsics(checkerboard, imgpoints, size):
+    # size is the (width, height) of the frames
+    objpoints = [checkerboard.points] * len(imgpoints)
+    error, cmtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, size, None, None)
+    return {
+        "cmtx": cmtx.tolist(),
+        "dist": dist.tolist(),
+        "opt_cmtx": cv2.getOptimalNewCameraMatrix(cmtx, dist, size, 1, size)[0].tolist(),
+        "size": list(size),
+    }, error
+
+
+def scale_intrinsics(intrinsics, size):
+    # cmtx, dist and opt_cmtx (None when missing) of intrinsics of calib.json for frames of size (width, height, of the rotated frames)
+    # Intrinsics remember the size of the frames they were calibrated with, older ones were always calibrated at 640x480.
+    # Scaling them only works for camera modes which see the whole sensor (like the 320x240 mode of the PS3 Eye),
+    # modes which crop the sensor need to be calibrated on their own
+    cmtx, dist, opt_cmtx = (np.array(intrinsics[key], dtype=np.float64) if key in intrinsics else None for key in ("cmtx", "dist", "opt_cmtx"))
+    calibrated = intrinsics.get("size", INTRINSICS_SIZE)
+    if tuple(calibrated) == tuple(size):
+        return cmtx, dist, opt_cmtx
+
+    # Pixel centers are at +0.5, so the principal point doesn't move by half a pixel
+    scale = np.array([[size[0] / calibrated[0]], [size[1] / calibrated[1]]])
+    for m in (cmtx, opt_cmtx):
+        if m is None:
+            continue
+        m[:2, :2] *= scale
+        m[:2, 2:] = (m[:2, 2:] + 0.5) * scale - 0.5
+    return cmtx, dist, opt_cmtx
+
+
+def select_views(imgpoints, descriptors, size, count, grid=8):
+    # Indices of count views which together cover the frame best, and differ the most (see describe_view)
+    # Each step picks the view which covers the most cells of a grid over the frame which aren't covered yet,
+    # plus its view_difference to the picked views, so once the frame is covered the views get picked by variety
+    if len(imgpoints) <= count:
+        return list(range(len(imgpoints)))
+    width, height = size
+    cells = np.zeros((len(imgpoints), grid * grid), dtype=bool)
+    for i, corners in enumerate(imgpoints):
+        corners = corners.reshape(-1, 2)
+        x = np.clip((corners[:, 0] / width * grid).astype(int), 0, grid - 1)
+        y = np.clip((corners[:, 1] / height * grid).astype(int), 0, grid - 1)
+        cells[i, y * grid + x] = True
+
+    descriptors = np.array(descriptors)
+    covered = np.zeros(grid * grid, dtype=bool)
+    difference = np.ones(len(imgpoints))
+    picked = []
+    for _ in range(count):
+        score = (cells & ~covered).sum(axis=1) / (grid * grid) + difference
+        score[picked] = -np.inf
+        best = int(np.argmax(score))
+        picked.append(best)
+        covered |= cells[best]
+        difference = np.minimum(difference, np.linalg.norm(descriptors - descriptors[best], axis=1))
+    return sorted(picked)
+
+
+def average_rotations(rotations):
+    # Rotation matrix closest to the mean of the matrices (chordal L2 mean), averaging them element-wise doesn't give a rotation
+    u, s, vt = np.linalg.svd(np.sum(rotations, axis=0))
+    return u @ np.diag([1, 1, np.linalg.det(u @ vt)]) @ vt
+
+
+def rotation_angles(a, b):
+    # Angles in degrees between every rotation matrix of a (n, 3, 3) and every one of b (m, 3, 3), as an (n, m) array
+    # trace(a.T @ b) is the sum of the element-wise product
+    trace = np.einsum("iab,jab->ij", a, b)
+    return np.degrees(np.arccos(np.clip((trace - 1) / 2, -1, 1)))
+
+
+def marker_points(size):
+    # The corners of the aruco marker at the origin, which lies on the floor (see calibrate_extrinsics in calibtool.py)
+    return np.array([[0, 0, 0], [size, 0, 0], [size, 0, size], [0, 0, size]], dtype=np.float32)
+
+
+def marker_pose(observations, size, cmtx, dist, max_angle=10, max_seed_frames=200):
+    # Rotation matrix and translation of a camera which saw the marker at observations (the corners of every frame)
+    # A flat marker can flip between two poses, so the frames are seeded with the rotation which the most other frames
+    # agree with (within max_angle degrees) rather than the average of all of them, which may lie between the two.
+    # The seed gets picked among max_seed_frames frames spread over the observations, as comparing every pair of
+    # frames takes quadratic time.
+    # Frames which disagree with the seed get dropped, the others get averaged and are solved together: the marker and
+    # the camera don't move, so all corners belong to a single pose
+    objp = marker_points(size)
+    poses = [cv2.solvePnP(objp, corners, cmtx, dist)[1:] for corners in observations]
+    rotations = np.array([cv2.Rodrigues(rvec)[0] for rvec, tvec in poses])
+
+    candidates = rotations[np.unique(np.linspace(0, len(rotations) - 1, max_seed_frames).astype(int))]
+    seed = candidates[np.argmax((rotation_angles(candidates, candidates) <= max_angle).sum(axis=1))]
+    # The seed itself is always close to itself, so at least one frame is kept
+    inliers = np.flatnonzero(rotation_angles(rotations, seed[None])[:, 0] <= max_angle)
+    rotation = average_rotations(rotations[inliers])
+    tvec = np.median([poses[i][1] for i in inliers], axis=0)
+
+    ret, rvec, tvec = cv2.solvePnP(np.tile(objp, (len(inliers), 1)), np.concatenate([observations[i] for i in inliers]),
+                                   cmtx, dist, cv2.Rodrigues(rotation)[0], tvec.copy(), useExtrinsicGuess=True)
+    return cv2.Rodrigues(rvec)[0], tvec, len(inliers)
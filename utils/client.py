@@ -1,12 +1,87 @@
 # Functions for communicating with the OSC server
-from pythonosc import udp_client
+import socket
+import struct
+import time
+
+def get_client(config):
+    if config.osc_bundle:
+        return OSCBundleClient(config.ip, config.port, config.osc_epsilon)
+    else:
+        return OSCClient(config.ip, config.port)
 
 class OSCClient:
     def __init__(self, ip, port = 9000):
+        from pythonosc import udp_client # Imports asyncio, which takes a while
         self.client = udp_client.SimpleUDPClient(ip, port)
 
     def send_pos(self, p, v = [0,0,0]):
         self.client.send_message("/tracking/trackers/{0}/position".format(str(p)), [float(x) for x in v])
 
     def send_rot(self, p, v = [0,0,0]):
-        self.client.send_message("/tracking/trackers/{0}/rotation".format(str(p)), [float(x) for x in v])
\ No newline at end of file
+        self.client.send_message("/tracking/trackers/{0}/rotation".format(str(p)), [float(x) for x in v])
+
+    def flush(self):
+        pass
+
+
+def _osc_string(s):
+    # OSC strings are null terminated and padded to a multiple of 4 bytes
+    b = s.encode("ascii")
+    return b + b"\x00" * (4 - len(b) % 4)
+
+_vec3 = struct.Struct(">fff")
+_bundle_header = b"#bundle\x00" + struct.pack(">Q", 1) # Time tag 1 means "immediately"
+
+# Sends all the positions and rotations of a frame as a single OSC bundle
+# send_pos and send_rot only store the values, flush builds the bundle and sends it
+# Tracker values which changed less than epsilon since they were last sent are skipped,
+# but are still sent every keepalive seconds
+class OSCBundleClient:
+    def __init__(self, ip, port = 9000, epsilon = 0, keepalive = 1.0):
+        self.address = (ip, port)
+        self.epsilon = epsilon
+        self.keepalive = keepalive
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+        self.headers = {}
+        self.pending = {}
+        self.sent = {}
+
+    def _header(self, p, kind):
+        # Address and type tag get encoded once per tracker, prefixed by the size of the bundle element
+        key = (p, kind)
+        header = self.headers.get(key)
+        if header is None:
+            msg = _osc_string("/tracking/trackers/{0}/{1}".format(str(p), kind)) + _osc_string(",fff")
+            header = struct.pack(">i", len(msg) + _vec3.size) + msg
+            self.headers[key] = header
+        return header
+
+    def send_pos(self, p, v = [0,0,0]):
+        self.pending[self._header(p, "position")] = (float(v[0]), float(v[1]), float(v[2]))
+
+    def send_rot(self, p, v = [0,0,0]):
+        self.pending[self._header(p, "rotation")] = (float(v[0]), float(v[1]), float(v[2]))
+
+    def flush(self):
+        t = time.monotonic()
+        elements = []
+        for header, v in self.pending.items():
+            if self.epsilon > 0 and header in self.sent:
+                prev, prev_t = self.sent[header]
+                if t - prev_t < self.keepalive and max(abs(v[0] - prev[0]), abs(v[1] - prev[1]), abs(v[2] - prev[2])) < self.epsilon:
+                    continue
+            self.sent[header] = (v, t)
+            elements.append(header + _vec3.pack(*v))
+        self.pending.clear()
+
+        if not elements:
+            return
+
+        try:
+            self.sock.sendto(_bundle_header + b"".join(elements), self.address)
+        except (BlockingIOError, InterruptedError):
+            # The socket buffer is full, the frame is dropped as a newer one will follow shortly
+            pass
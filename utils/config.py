@@ -0,0 +1,231 @@
+# The settings of settings.json, checked once and compiled into a frozen Config which the stages read as attributes
+# While tracking, ConfigWatcher reloads settings.json when it changes, and the pipeline swaps in the new Config
+# between frames (see Stage.step). Filter and threshold changes apply right away, settings which are only used while
+# starting (cameras, models, OSC, ...) are marked with restart and keep their old value until the tracker is restarted.
+from dataclasses import dataclass, field, fields, replace
+import threading
+import typing
+import types
+import os
+
+from . import filters
+
+class FrozenDict(dict):
+    # Read-only dict for the object valued settings (filters, mailboxes), which still has .get() and can be pickled
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Settings can't be modified")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def setting(default, key=None, restart=False):
+    # key: name in settings.json, when it isn't a valid attribute name
+    # restart: the setting is only used while starting, so changes need a restart
+    return field(default=default, metadata={"key": key, "restart": restart})
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    # Main
+    ip: str = setting("127.0.0.1", restart=True)
+    port: int = setting(9000, restart=True)
+    osc_bundle: bool = setting(True, restart=True)
+    osc_epsilon: float = setting(0.0, restart=True)
+    debug: bool = setting(False, restart=True)
+    debug_fps: float = setting(30.0, restart=True)
+    fps: int = setting(30, restart=True)
+    model: int = setting(1, restart=True)
+
+    # Filtering
+    filter_2d: FrozenDict | None = setting(None, key="2d_filter")
+    filter_3d: FrozenDict | None = setting(None, key="3d_filter")
+    skeleton_fit: bool = setting(False)
+    skeleton_learn_time: float = setting(3.0)
+    skeleton_iterations: int = setting(10)
+
+    # Multicam
+    multicam_val: float = setting(0.75)
+    multicam_mode: str = setting("select")
+    multicam_max_error: float = setting(20.0)
+
+    # Pipeline
+    mailboxes: FrozenDict | None = setting(None, restart=True)
+    process_stages: tuple = setting((), restart=True)
+    tracing: bool = setting(False, restart=True)
+    tracing_file: str = setting("tracing.jsonl", restart=True)
+    tracing_interval: float = setting(5.0, restart=True)
+    tracing_port: int | None = setting(None, restart=True)
+    profile: bool = setting(False, restart=True)
+    profiler_rate: float = setting(100.0, restart=True)
+    profiler_duration: float = setting(10.0, restart=True)
+    profiler_port: int | None = setting(None, restart=True)
+    profiler_output: str = setting("profiles", restart=True)
+    record: bool = setting(False, restart=True)
+    record_dir: str = setting("recordings", restart=True)
+    replay_mode: str = setting("realtime", restart=True)
+    session_log: bool = setting(False, restart=True)
+    session_log_dir: str = setting("sessions", restart=True)
+    reload_settings: bool = setting(True, restart=True)
+
+    # Advanced
+    undistort: bool = setting(True)
+    pose_det_min_score: float = setting(0.75)
+    pose_lm_min_score: float = setting(0.3)
+    pose_det_model: str | None = setting(None, restart=True)
+    pose_landmark_model: str | None = setting(None, restart=True)
+    required_joints: tuple | None = setting(None)
+    refine_landmarks: bool = setting(True)
+    refine_kernel_size: int = setting(7)
+    refine_min_score: float = setting(0.5)
+    flip_detection: bool = setting(False)
+    flip_detection_max: float = setting(10.0)
+    draw_pose: bool = setting(False, restart=True)
+    draw_pose_views: tuple = setting(("front", "side", "top"), restart=True)
+    scale_multiplier: float = setting(1.0)
+    flip_x: bool = setting(False)
+    flip_y: bool = setting(False)
+    flip_z: bool = setting(False)
+    swap_xz: bool = setting(False)
+    send_rot: bool = setting(False)
+    extra_trackers: bool = setting(False)
+    owotrack: bool = setting(False, restart=True)
+    owotrack_fusion: bool = setting(True, restart=True)
+    owotrack_fusion_time: float = setting(2.0)
+
+    def __post_init__(self):
+        if self.multicam_mode not in ("select", "weighted"):
+            raise ValueError('multicam_mode must be "select" or "weighted", not {}'.format(self.multicam_mode))
+        if self.replay_mode not in ("realtime", "fast", "lockstep"):
+            raise ValueError('replay_mode must be "realtime", "fast" or "lockstep", not {}'.format(self.replay_mode))
+        if self.model not in (0, 1, 2):
+            raise ValueError("model must be 0, 1 or 2, not {}".format(self.model))
+        if self.fps <= 0:
+            raise ValueError("fps must be greater than 0")
+        if self.debug_fps <= 0:
+            raise ValueError("debug_fps must be greater than 0")
+        if self.owotrack_fusion_time <= 0:
+            raise ValueError("owotrack_fusion_time must be greater than 0")
+        for view in self.draw_pose_views:
+            if view not in ("front", "side", "top"):
+                raise ValueError('draw_pose_views can contain "front", "side" and "top", not {}'.format(view))
+        # Raises for unknown filter types
+        filters.get_filter(self.filter_2d, self.fps, 2)
+        filters.get_filter(self.filter_3d, self.fps, 3)
+
+    def changes(self, other):
+        # Names (as in settings.json) of the settings which differ from other
+        return [key for name, key, restart in _fields if getattr(self, name) != getattr(other, name)]
+
+    def apply(self, new):
+        # The config to run with after settings.json changed to new, and the changed settings which need a restart
+        restart = [name for name, key, needs_restart in _fields if needs_restart and getattr(self, name) != getattr(new, name)]
+        return replace(new, **{name: getattr(self, name) for name in restart}), [_keys[name] for name in restart]
+
+
+_hints = typing.get_type_hints(Config)
+_fields = [(f.name, f.metadata["key"] or f.name, f.metadata["restart"]) for f in fields(Config)]
+_names = {key: name for name, key, restart in _fields}
+_keys = {name: key for name, key, restart in _fields}
+
+def _convert(key, value, kind):
+    if typing.get_origin(kind) in (typing.Union, types.UnionType):
+        for option in typing.get_args(kind):
+            try:
+                return _convert(key, value, option)
+            except ValueError:
+                pass
+    elif kind is type(None):
+        if value is None:
+            return None
+    elif kind is bool:
+        if isinstance(value, bool):
+            return value
+    elif kind is int:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    elif kind is float:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+    elif kind is str:
+        if isinstance(value, str):
+            return value
+    elif kind is tuple:
+        if isinstance(value, (list, tuple)):
+            return tuple(value)
+    elif kind is FrozenDict:
+        if isinstance(value, dict):
+            return FrozenDict({k: FrozenDict(v) if isinstance(v, dict) else v for k, v in value.items()})
+
+    names = [getattr(option, "__name__", str(option)) for option in (typing.get_args(kind) or [kind])]
+    raise ValueError("Setting {} must be {}, not {!r}".format(key, " or ".join(names).replace("NoneType", "null").replace("FrozenDict", "object"), value))
+
+
+def from_dict(settings):
+    # Checks the settings (a dict as in settings.json) and turns them into a Config, raises ValueError when invalid
+    # Unknown settings are ignored
+    return Config(**{_names[key]: _convert(key, value, _hints[_names[key]]) for key, value in settings.items() if key in _names})
+
+
+def unknown_settings(settings):
+    return [key for key in settings if key not in _names]
+
+
+def load(path="settings.json"):
+    import pyjson5
+    with open(path, "r") as f:
+        settings = pyjson5.decode_io(f)
+    for key in unknown_settings(settings):
+        print("Unknown setting in {}: {}".format(path, key))
+    return from_dict(settings)
+
+
+class ConfigWatcher:
+    # Checks the settings file every interval seconds, and gives the pipeline the new Config when it changed
+    # Invalid files are reported and ignored, the tracker keeps running with the last valid settings
+    def __init__(self, path, pipeline, interval=1.0):
+        self.path = path
+        self.pipeline = pipeline
+        self.interval = interval
+        self.mtime = os.stat(path).st_mtime_ns
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._watch, name="config_watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+
+        import pyjson5
+        try:
+            new = load(self.path)
+        except (ValueError, TypeError, OSError, pyjson5.Json5Exception) as e:
+            print("Not reloading {}: {}".format(self.path, e))
+            return
+
+        current = self.pipeline.config
+        config, restart = current.apply(new)
+        changed = config.changes(current)
+        if changed:
+            # Stages pick the new config up before their next frame
+            self.pipeline.config = config
+            print("Applied settings: {}".format(", ".join(changed)))
+        if restart:
+            print("Restart to apply: {}".format(", ".join(restart)))
@@ -3,42 +3,38 @@ import cv2
 import numpy as np
 
 #region Camera Debug
-def hsv_to_rgb(h, s, v):
-    bgr = cv2.cvtColor(
-        np.array([[[h, s, v]]], dtype=np.uint8), cv2.COLOR_HSV2BGR
-    )[0][0]
-    return (int(bgr[2]), int(bgr[1]), int(bgr[0]))
+connections = np.array([(0, 1), (1, 2), (2, 3), (3, 7), (0, 4), (4, 5),
+                        (5, 6), (6, 8), (9, 10), (11, 12), (11, 13),
+                        (13, 15), (15, 17), (15, 19), (15, 21), (17, 19),
+                        (12, 14), (14, 16), (16, 18), (16, 20), (16, 22),
+                        (18, 20), (11, 23), (12, 24), (23, 24), (23, 25),
+                        (24, 26), (25, 27), (26, 28), (27, 29), (28, 30),
+                        (29, 31), (30, 32), (27, 31), (28, 32)])
+
+# Lines are coloured by the keypoint they start at, around the hue circle
+# The connections of each colour get drawn with a single cv2.polylines call
+hues = [cv2.cvtColor(np.array([[[255 * i / 33, 255, 255]]], dtype=np.uint8), cv2.COLOR_HSV2RGB)[0][0] for i in range(33)]
+colour_groups = [(tuple(int(c) for c in hues[start]), connections[connections[:, 0] == start]) for start in np.unique(connections[:, 0])]
+tracker_colours = [(255*(i%2), 255*((i//2)%2), 255*((i//4)%2)) for i in range(1, 7)]
 
-def line(input_img, landmarks, flags, point1, point2):
+def display_result(img, landmarks, flags, roi):
     threshold = 0.2
-    
-    if flags[0] >= threshold and landmarks[point1, 3] >= threshold and landmarks[point2, 3] >= threshold:
-        color = hsv_to_rgb(255 * point1 / 33, 255, 255)
-        line_width = 2
+    # Lines and points keep their size relative to the frame, for cameras running at a lower resolution
+    thickness, radius = max(round(2 * img.shape[1] / 480), 1), max(round(5 * img.shape[1] / 480), 2)
 
-        x1 = int(landmarks[point1, 0])
-        y1 = int(landmarks[point1, 1])
-        x2 = int(landmarks[point2, 0])
-        y2 = int(landmarks[point2, 1])
-        cv2.line(input_img, (x1, y1), (x2, y2), color, line_width)
+    if flags[0] >= threshold:
+        visible = landmarks[:, 3] >= threshold
+        points = landmarks[:, :2].astype(np.int32)
+        for colour, group in colour_groups:
+            group = group[visible[group[:, 0]] & visible[group[:, 1]]]
+            if len(group):
+                cv2.polylines(img, points[group], False, colour, thickness)
 
-def display_result(img, landmarks, flags, roi):
-    connections = [(0, 1), (1, 2), (2, 3), (3, 7), (0, 4), (4, 5),
-                   (5, 6), (6, 8), (9, 10), (11, 12), (11, 13),
-                   (13, 15), (15, 17), (15, 19), (15, 21), (17, 19),
-                   (12, 14), (14, 16), (16, 18), (16, 20), (16, 22),
-                   (18, 20), (11, 23), (12, 24), (23, 24), (23, 25),
-                   (24, 26), (25, 27), (26, 28), (27, 29), (28, 30),
-                   (29, 31), (30, 32), (27, 31), (28, 32)]
-
-    for connection in connections:
-        line(img, landmarks, flags, connection[0], connection[1])
-    
     if(len(landmarks) > 32):
         for i in range(1,7):
-            cv2.circle(img, (int(landmarks[32+i, 0]), int(landmarks[32+i, 1])), 5, (255*(i%2), 255*((i//2)%2), 255*((i//4)%2)), -1)
+            cv2.circle(img, (int(landmarks[32+i, 0]), int(landmarks[32+i, 1])), radius, tracker_colours[i - 1], -1)
 
-    if roi:
+    if roi is not None and not np.isnan(roi).any():
         scale = roi[2] / 2
         corners = np.array([
             [-scale, scale],
@@ -55,53 +51,58 @@ def display_result(img, landmarks, flags, roi):
         corners[:, 0] += roi[0]
         corners[:, 1] += roi[1]
         
-        cv2.polylines(img, [np.int32(corners)], True, (0, 255, 0), 2)
+        cv2.polylines(img, [np.int32(corners)], True, (0, 255, 0), thickness)
 
     return img
+
+def draw_cameras(arrays):
+    # Debug windows of utils/viewer.py, arrays are the frame, landmarks, flags and ROI of every camera
+    return {"Pose{}".format(i // 4): display_result(*arrays[i:i + 4]) for i in range(0, len(arrays), 4)}
 #endregion
 
 #region Pose Debug
-from matplotlib import pyplot as plt
-# Believe it or not, this is the most efficient way to draw the skeleton
-connections_body = [33, 24, 26, 28, 32, 30, 28, 26, 24, 12, 14, 16, 18, 20, 16, 22, 16, 14, 12, 11, 13, 15, 17, 19, 15, 21, 13, 11, 23, 25, 27, 29, 31, 27, 25, 23, 24]
-connections_face = [8, 6, 5, 4, 0, 1, 2, 3, 7]
-lines_body = None
-lines_face = None
-fig = None
-
-def init_pose_plot(size = 6, radius = 2.5):
-    global lines_body, lines_face, fig
-
-    plt.ioff()
-    fig = plt.figure(figsize=(size, size))
-
-    ax = fig.add_subplot(1, 1, 1, projection='3d')
-    ax.view_init(elev=15., azim=np.array(75., dtype=np.float32))
-    ax.set_xlim3d([-radius / 2, radius / 2])
-    ax.set_zlim3d([0, radius])
-    ax.set_ylim3d([-radius / 2, radius / 2])
-
-    ax.set_xticklabels([])
-    ax.set_yticklabels([])
-    ax.set_zticklabels([])
-    ax.dist = 12.5
-    ax.set_title("Visualisation")
-    
-    lines_body = ax.plot([0, 0], [0, 0], [0, 0], zdir='y', c='black')
-    lines_face = ax.plot([0, 0], [0, 0], [0, 0], zdir='y', c='red')
-    
-    plt.show(block=False)
-
-def update_pose_plot(pos):
-    lines_body[0].set_xdata(pos[connections_body, 0])
-    lines_body[0].set_ydata(pos[connections_body, 1])
-    lines_body[0].set_3d_properties(pos[connections_body, 2], zdir='y')
-
-    lines_face[0].set_xdata(pos[connections_face, 0])
-    lines_face[0].set_ydata(pos[connections_face, 1])
-    lines_face[0].set_3d_properties(pos[connections_face, 2], zdir='y')
-
-def draw_plot():
-    fig.canvas.draw()
-    fig.canvas.flush_events()
+# Orthographic views of the triangulated points, drawn by utils/viewer.py
+connections_body = np.array([33, 24, 26, 28, 32, 30, 28, 26, 24, 12, 14, 16, 18, 20, 16, 22, 16, 14, 12, 11, 13, 15, 17, 19, 15, 21, 13, 11, 23, 25, 27, 29, 31, 27, 25, 23, 24])
+connections_face = np.array([8, 6, 5, 4, 0, 1, 2, 3, 7])
+joints_shown = np.unique(np.concatenate([connections_body, connections_face]))
+
+# Axes shown to the right and up in each view (y is up), and the part of the tracking space they show in metres
+pose_views = {
+    "front": (0, 1),
+    "side": (2, 1),
+    "top": (0, 2),
+}
+pose_ranges = [(-1.25, 1.25), (0, 2.5), (-1.25, 1.25)]
+
+def error_colours(residuals, max_error):
+    # BGR colour of every joint, from green (no reprojection error) over yellow to red (max_error and above)
+    # Joints without a residual are white
+    ratio = np.clip(residuals / max_error, 0, 1)
+    colours = np.stack([np.zeros_like(ratio), np.minimum(1, 2 - 2 * ratio), np.minimum(1, 2 * ratio)], axis=1) * 255
+    colours[np.isnan(residuals)] = 255
+    return colours.astype(int)
+
+def draw_pose_view(points, colours, view, size):
+    img = np.zeros((size, size, 3), dtype=np.uint8)
+    horizontal, vertical = pose_views[view]
+    (h0, h1), (v0, v1) = pose_ranges[horizontal], pose_ranges[vertical]
+    xy = np.stack([(points[:, horizontal] - h0) / (h1 - h0), (v1 - points[:, vertical]) / (v1 - v0)], axis=1) * size
+    xy = np.round(xy).astype(np.int32)
+
+    cv2.polylines(img, [xy[connections_body]], False, (200, 200, 200), 1, cv2.LINE_AA)
+    cv2.polylines(img, [xy[connections_face]], False, (0, 0, 255), 1, cv2.LINE_AA)
+    for i in joints_shown:
+        cv2.circle(img, (int(xy[i, 0]), int(xy[i, 1])), 3, tuple(int(c) for c in colours[i]), -1)
+    cv2.putText(img, view, (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+    cv2.line(img, (size - 1, 0), (size - 1, size - 1), (80, 80, 80), 1)
+    return img
+
+def draw_skeleton(arrays, views=("front", "side", "top"), size=240):
+    # Pose window of utils/viewer.py, arrays are the points (m), the residuals (pixels, NaN when unknown) and the max error
+    points, residuals, max_error = arrays
+    colours = error_colours(residuals, max_error[0])
+    img = np.hstack([draw_pose_view(points, colours, view, size) for view in views])
+    text = "reprojection error: green 0 px, red {:.0f} px".format(max_error[0]) if not np.isnan(residuals).all() else "no reprojection error"
+    cv2.putText(img, text, (5, size - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+    return {"Skeleton": img}
 #endregion
\ No newline at end of file
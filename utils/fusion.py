@@ -0,0 +1,104 @@
+# Fuses the orientation of an owoTrack device on the hips with the hip rotation from the cameras (complementary filter)
+# The phone sends its orientation many times per camera frame and with little noise, but its heading drifts. The cameras
+# give the hips in the tracking space, but jittery and only once per frame set.
+# Only the heading gets fused: the hip rotation is the one of the torso in the latest frame set (see solver.torso_rot),
+# turned about the vertical axis to the heading of the phone plus an offset. Every frame set pulls the offset a bit
+# towards the one the cameras saw, so the hips turn with the phone between frames while their heading follows the
+# cameras. The tilt always comes from the cameras.
+# The heading of the phone is the one of the forward direction of the hips, which the filter learns in the coordinates
+# of the phone from the frame sets, so the phone can be strapped to the hips in any orientation.
+# Quaternions are (x, y, z, w) like the ones owoTrack sends, in the frame of the Android rotation vector (z up).
+# The tracking space is vertical along y (see calibrate_extrinsics in calibtool.py), up is where the shoulders are.
+# Flip settings which mirror the tracking space turn the hips the other way than the phone, which mirrored accounts for.
+from collections import deque
+
+import numpy as np
+
+from . import solver
+
+def quat_to_matrix(q):
+    x, y, z, w = q / np.linalg.norm(q)
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]
+    ])
+
+
+def wrap(angle):
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+def hip_axes(points):
+    # Direction of the spine (downwards) and from the left to the right hip, like solver.solve uses for the hip rotation
+    shoulder_midpoint = (points[11] + points[12]) / 2
+    hip_midpoint = (points[23] + points[24]) / 2
+    return solver.normalize(hip_midpoint - shoulder_midpoint), solver.normalize(points[24] - points[23])
+
+
+def turn(vectors, angle):
+    # Turns (n, 3) vectors by angle (radians) about the y axis
+    cos, sin = np.cos(angle), np.sin(angle)
+    return vectors @ np.array([[cos, 0, -sin], [0, 1, 0], [sin, 0, cos]])
+
+
+class HipFusion:
+    # time_constant is how many seconds it takes the heading to mostly (63%) follow a change seen by the cameras
+    # history is how many seconds of phone rotations are kept, for pairing a frame set with the rotation at its capture
+    def __init__(self, time_constant=2.0, history=1.0, mirrored=False):
+        self.time_constant = time_constant
+        self.history = history
+        self.mirrored = mirrored
+        self.samples = deque() # (time, rotation matrix) of the phone
+        self.forward = None # forward direction of the hips in the coordinates of the phone
+        self.offset = None # heading of the hips minus the one of the phone
+        self.hips = None # spine and side direction, up (1 or -1 along y) and heading of the hips in the latest frame set
+        self.last_vision = None
+
+    def phone_heading(self, rotation):
+        forward = rotation @ self.forward
+        heading = np.arctan2(forward[1], forward[0])
+        return -heading if self.mirrored else heading
+
+    def update_imu(self, timestamp, quat):
+        # Returns the fused hip rotation (rotation vector in degrees, like solver.solve), or None until the cameras have
+        # seen the hips once
+        rotation = quat_to_matrix(quat)
+        self.samples.append((timestamp, rotation))
+        while self.samples[0][0] < timestamp - self.history:
+            self.samples.popleft()
+        if self.offset is None:
+            return None
+
+        spine, side, up, vision_heading = self.hips
+        spine, side = turn(np.stack((spine, side)), up * wrap(self.phone_heading(rotation) + self.offset - vision_heading))
+        return solver.torso_rot(np.zeros((1, 3)), spine[None], np.zeros((1, 3)), side[None])[0]
+
+    def update_vision(self, timestamp, points):
+        # timestamp is when the frames were captured, points the keypoints the hip rotation gets calculated from
+        spine, side = hip_axes(points)
+        forward = solver.normalize(np.cross(side, -spine))
+        if not np.all(np.isfinite(forward)):
+            return
+        up = 1 if spine[1] <= 0 else -1
+        heading = np.arctan2(up * forward[0], forward[2])
+        self.hips = (spine, side, up, heading)
+        if not self.samples:
+            return
+
+        # The phone rotation closest to the capture, as the frames took a while to get here
+        rotation = min(self.samples, key=lambda sample: abs(sample[0] - timestamp))[1]
+
+        if self.offset is None:
+            self.offset = 0
+            alpha = 1
+        else:
+            alpha = 1 - np.exp(-min(max(timestamp - self.last_vision, 0), self.time_constant) / self.time_constant)
+            self.offset = wrap(self.offset + wrap(heading - self.phone_heading(rotation) - self.offset) * alpha)
+        self.last_vision = timestamp
+
+        # Where the phone would see the forward direction of the hips with this offset
+        phone_heading = -(heading - self.offset) if self.mirrored else heading - self.offset
+        horizontal = np.hypot(forward[0], forward[2])
+        seen = rotation.T @ np.array([horizontal * np.cos(phone_heading), horizontal * np.sin(phone_heading), up * forward[1]])
+        self.forward = seen if self.forward is None else solver.normalize(self.forward + (seen - self.forward) * alpha)
@@ -4,10 +4,30 @@
 import cv2
 import math
 import numpy as np
-from scipy.special import expit
 
 num_coords = 12
 
+def create_session(path, suppress_warnings=False):
+    if path.endswith(".npz"):
+        return ReplaySession(path)
+
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if suppress_warnings:
+        options.log_severity_level = 3
+    return onnxruntime.InferenceSession(path, options, providers=["CUDAExecutionProvider", "CPUExecutionProvider"])
+
+class ReplaySession:
+    # Stand-in for an onnxruntime session, which returns the outputs stored in a .npz file (used by main.py --benchmark)
+    # The outputs are stored for a batch size of 1, and get repeated for every image of the input
+    def __init__(self, path):
+        self.outputs = dict(np.load(path))
+
+    def run(self, output_names, input_feed):
+        batch = len(next(iter(input_feed.values())))
+        return [np.repeat(self.outputs[name], batch, axis=0) for name in output_names]
+
 def resize_pad(img):
     """ resize and pad images to be input to the detectors
 
@@ -97,8 +117,8 @@ def raw_output_to_detections(raw_box, raw_score, anchors, min_score_thresh):
 
     thresh = 100.0
     raw_score = raw_score.clip(-thresh, thresh)
-    # expit = sigmoid (instead of defining our own sigmoid function which yields a warning)
-    detection_scores = expit(raw_score).squeeze(axis=-1)
+    # Sigmoid written with tanh, which doesn't overflow for large negative scores (so no warning, like scipy's expit)
+    detection_scores = (0.5 * np.tanh(0.5 * raw_score) + 0.5).squeeze(axis=-1)
 
     # Note: we stripped off the last dimension from the scores tensor
     # because there is only has one class. Now we can simply use a mask
@@ -244,24 +264,30 @@ def sigmoid(x):
     return 1.0 / (1.0 + np.exp(-x))
 
 
-def landmark_postprocess(landmarks, aux = True):
+def landmark_postprocess(landmarks, aux = True, joints = None):
+    # Only the keypoints in joints are processed, the others are left at 0
     num = len(landmarks)
-    normalized_landmarks = np.zeros((num, 39 if aux else 33, 4))
-    for i in range(num):
-        xx = landmarks[i]
-        for j in range(39 if aux else 33):
-            x = xx[j * 5] / 256
-            y = xx[j * 5 + 1] / 256
-            z = xx[j * 5 + 2] / 256
-            visibility = xx[j * 5 + 3]
-            presence = xx[j * 5 + 4]
-            #normalized_landmarks[i, j] = (x, y, z, sigmoid(min(visibility, presence)))
-            normalized_landmarks[i, j] = (x, y, z, sigmoid(visibility))
+    count = 39 if aux else 33
+    if joints is None:
+        joints = np.arange(count)
+
+    xx = np.asarray(landmarks).reshape(num, -1, 5)[:, joints]
+    normalized_landmarks = np.zeros((num, count, 4))
+    normalized_landmarks[:, joints, :3] = xx[:, :, :3] / 256
+    #normalized_landmarks[:, joints, 3] = sigmoid(np.minimum(xx[:, :, 3], xx[:, :, 4]))
+    normalized_landmarks[:, joints, 3] = sigmoid(xx[:, :, 3])
 
     return normalized_landmarks
 
 
-anchors = np.load('models/anchors.npy').astype("float32")
+anchors = None
+def get_anchors():
+    # The anchors of the detection model, loaded on first use so that importing doesn't read any files
+    global anchors
+    if anchors is None:
+        anchors = np.load('models/anchors.npy').astype("float32")
+    return anchors
+
 def detector_postprocess(preds_ailia, min_score_thresh=0.75):
     """
     Process detection predictions from ailia and return filtered detections
@@ -270,7 +296,7 @@ def detector_postprocess(preds_ailia, min_score_thresh=0.75):
     raw_score = preds_ailia[1]  # (1, 2254, 1)
 
     # Postprocess the raw predictions:
-    detections = raw_output_to_detections(raw_box, raw_score, anchors, min_score_thresh)
+    detections = raw_output_to_detections(raw_box, raw_score, get_anchors(), min_score_thresh)
 
     # Non-maximum suppression to remove overlapping detections:
     filtered_detections = []
@@ -405,12 +431,13 @@ def estimator_preprocess(src_img, detections, scale, pad):
     return img, affine, box
 
 
-def denormalize_landmarks(landmarks, affines):
-    landmarks[:, :, :2] *= 256
+def denormalize_landmarks(landmarks, affines, joints = None):
+    if joints is None:
+        joints = np.arange(landmarks.shape[1])
     for i in range(len(landmarks)):
-        landmark, affine = landmarks[i], affines[i]
-        landmark = (affine[:, :2] @ landmark[:, :2].T + affine[:, 2:]).T
-        landmarks[i, :, :2] = landmark
+        landmark, affine = landmarks[i, joints, :2] * 256, affines[i]
+        landmark = (affine[:, :2] @ landmark.T + affine[:, 2:]).T
+        landmarks[i, joints, :2] = landmark
     return landmarks
 
 
@@ -418,7 +445,7 @@ def landmarks_to_roi(landmarks):
     return detection2roi(np.array([[0, 0, 0, 0, landmarks[33][0], landmarks[33][1], landmarks[34][0], landmarks[34][1]]]))
 
 
-def refine_landmarks(landmarks, heatmap, kernel_size = 7, min_conf = 0.5):
+def refine_landmarks(landmarks, heatmap, kernel_size = 7, min_conf = 0.5, joints = None):
     # Adapted from
     # https://github.com/google/mediapipe/blob/master/mediapipe/calculators/util/refine_landmarks_from_heatmap_calculator.cc
     # heatmap: (batch, height, width, landmarks)
@@ -431,6 +458,9 @@ def refine_landmarks(landmarks, heatmap, kernel_size = 7, min_conf = 0.5):
     center_rows = np.uint8(landmarks[:, :, 1] * hm_height)
 
     refinement_needed = np.logical_and(np.logical_and(center_cols >= 0, center_cols < hm_width), np.logical_and(center_rows >= 0, center_rows < hm_height))
+    if joints is not None:
+        # Only refine the keypoints which are used
+        refinement_needed[:, np.setdiff1d(np.arange(landmarks.shape[1]), joints)] = False
     refinement_needed = np.where(refinement_needed)
     
     begin_cols = np.maximum(0, center_cols[refinement_needed] - offset).astype(int)
@@ -1,113 +1,184 @@
-from socket import socket,AF_INET , SOCK_DGRAM
+# Server for the owoTrack app, which sends the orientation of phones (or other IMU devices) over UDP
+# A single thread serves all devices: it waits on the socket with a selector, and sends the heartbeats of every device
+# from one timer in between. Devices are told apart by their address, and every device has a slot (see utils/pipeline.py)
+# holding its latest orientation and when it arrived. Values in the slots and the dict of devices get replaced, never
+# changed, so pose.calc_pose reads them without locking.
+import selectors
+import socket
 import struct
 import math
 import threading
 import time
 
-class BinReader:
-    def __init__(self, data):
-        self.data = data
-        self.offset = 0
+import numpy as np
+
+from .pipeline import Slot
+
+PACKET_HEARTBEAT = 0
+PACKET_ROTATION = 1
+PACKET_HANDSHAKE = 3
+
+_header = struct.Struct("!iq") # type, packet id
+_handshake = struct.Struct("!7i") # board, imu, mcu, 3 x info, firmware build
+_rotation = struct.Struct("!4f") # x, y, z, w
+
+_heartbeat = struct.pack("!i", 1)
+_handshake_response = b"\x03Hey OVR =D 5"
+
+class Device:
+    def __init__(self, address, index):
+        self.address = address
+        self.index = index # the lowest one which was free when the device connected
+        self.firmware = None
+        self.rotation = Slot("owotrack{}".format(index)) # (time.monotonic() of arrival, quaternion x, y, z, w) or None
+        self.last_packet = time.monotonic()
 
-    def read_int(self):
-        value = struct.unpack_from('!i', self.data, self.offset)[0]
-        self.offset += 4
-        return value
-    
-    def read_long(self):
-        value = struct.unpack_from('!q', self.data, self.offset)[0]
-        self.offset += 8
-        return value
-    
-    def read_byte(self):
-        value = struct.unpack_from('!b', self.data, self.offset)[0]
-        self.offset += 1
-        return value
-    
-    def read_string(self):
-        length = self.read_byte()
-        value = struct.unpack_from(f'!{length}s', self.data, self.offset)[0]
-        self.offset += length
-        return value.decode('utf-8')
-    
-    def read_float(self):
-        value = struct.unpack_from('!f', self.data, self.offset)[0]
-        self.offset += 4
-        return value
 
 class OwoTrackServer():
-    def __init__(self, port=6969):
+    # Devices which didn't send anything for timeout seconds are dropped
+    def __init__(self, port=6969, heartbeat_interval=0.25, timeout=5.0):
         self.port = port
-        self.connected = False
-        self.heartbeat_thread = None
-        self.heartbeat = True
-        self.rotation = [0, 0, 0]
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout
+        self.devices = {} # address -> Device, replaced as a whole when a device connects or gets dropped
         self.sobj = None
+        self.selector = selectors.DefaultSelector()
+        self.received = threading.Condition() # notified after every batch of packets, for wait()
+        self.running = True
         self.start_server(self.port)
-        threading.Thread(target=self.main_loop).start()
+        self.thread = threading.Thread(target=self.main_loop, name="owotrack", daemon=True)
+        self.thread.start()
 
-    def start_server(self, port=6969):
-        if self.heartbeat_thread is not None:
-            self.heartbeat = False
-            self.heartbeat_thread.join()
+    @property
+    def connected(self):
+        return len(self.devices) > 0
 
+    def device(self, index=0):
+        # The index-th connected device, or None
+        for device in self.devices.values():
+            if device.index == index:
+                return device
+        return None
+
+    def latest(self, index=0, max_age=None):
+        # (time, quaternion) of the index-th device, or None when there is none or it's older than max_age seconds
+        device = self.device(index)
+        value = device.rotation.get() if device is not None else None
+        if value is None or (max_age is not None and time.monotonic() - value[0] > max_age):
+            return None
+        return value
+
+    def wait(self, index=0, seen=None, timeout=None):
+        # Waits until the index-th device sent a rotation other than seen (a value of latest()), returns it or None after timeout
+        with self.received:
+            value = self.received.wait_for(lambda: (value := self.latest(index)) is not seen and value, timeout)
+        return value or None
+
+    def start_server(self, port=6969):
         if self.sobj is not None:
+            self.selector.unregister(self.sobj)
             self.sobj.close()
-        
-        self.sobj = socket(AF_INET,SOCK_DGRAM)
+
+        self.sobj = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sobj.bind(('0.0.0.0', port))
-        self.connected = False
+        self.sobj.setblocking(False)
+        self.selector.register(self.sobj, selectors.EVENT_READ)
+        self.devices = {}
         print("OwoTrack server started on port", port)
 
-    def heartbeat_f(self, source):
-        while self.heartbeat:
-            self.sobj.sendto(b"\x00\x00\x00\x01", source)
-            time.sleep(0.25)
+    def stop(self):
+        self.running = False
+        self.thread.join(1)
+        self.selector.close()
+        self.sobj.close()
 
     def main_loop(self):
-        while True:
+        next_heartbeat = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                self.send_heartbeats(now)
+                next_heartbeat = now + self.heartbeat_interval
+
+            if not self.selector.select(max(next_heartbeat - time.monotonic(), 0)):
+                continue
+
+            # Everything which arrived while waiting
+            while True:
+                try:
+                    msg, source = self.sobj.recvfrom(512)
+                except BlockingIOError:
+                    break
+                except ConnectionResetError:
+                    # Windows reports a heartbeat which couldn't be delivered on the next receive, the socket is fine
+                    continue
+                except OSError:
+                    print("Connection lost, retrying...")
+                    self.start_server(self.port)
+                    break
+                self.handle(msg, source)
+
+            with self.received:
+                self.received.notify_all()
+
+    def handle(self, msg, source):
+        try:
+            type, p_id = _header.unpack_from(msg)
+        except struct.error:
+            return
+
+        device = self.devices.get(source)
+        if device is None:
+            # A device which reconnects gets the index it had, when no other device took it
+            used = {d.index for d in self.devices.values()}
+            device = Device(source, next(i for i in range(len(used) + 1) if i not in used))
+            self.devices = {**self.devices, source: device}
+        now = time.monotonic()
+        device.last_packet = now
+
+        if type == PACKET_HANDSHAKE:
             try:
-                msg, source = self.sobj.recvfrom(512)
-            except Exception as excep:
-                print("Connection lost, retrying...")
-                self.start_server(self.port)
-            
-            reader = BinReader(msg)
-            type = reader.read_int()
-            p_id = reader.read_long() # packet id
-
-            if type == 3: # handshake
-                boardType, imuType, mcuType = reader.read_int(), reader.read_int(), reader.read_int()
-                info1, info2, info3 = reader.read_int(), reader.read_int(), reader.read_int()
-                firmwareBuild = reader.read_int()
-                firmware = reader.read_string()
-                print("Handshake received from", source, "with firmware", firmware)
-                
-                # Send handshake response
-                self.sobj.sendto(b"\x03Hey OVR =D 5", source)
-                
-                self.heartbeat = True
-                self.heartbeat_thread = threading.Thread(target=self.heartbeat_f, args=(source,))
-                self.heartbeat_thread.start()
-                self.connected = True
-
-            elif type == 1:
-                rot_x, rot_y, rot_z, rot_w = reader.read_float(), reader.read_float(), reader.read_float(), reader.read_float()
-
-                # Convert to euler degrees
-                sinr_cosp = 2 * (rot_w * rot_x + rot_y * rot_z)
-                cosr_cosp = 1 - 2 * (rot_x * rot_x + rot_y * rot_y)
-                roll = math.atan2(sinr_cosp, cosr_cosp)
-
-                sinp = 2 * (rot_w * rot_y - rot_z * rot_x)
-                if abs(sinp) >= 1:
-                    pitch = math.copysign(math.pi / 2, sinp)
-                else:
-                    pitch = math.asin(sinp)
-
-                siny_cosp = 2 * (rot_w * rot_z + rot_x * rot_y)
-                cosy_cosp = 1 - 2 * (rot_y * rot_y + rot_z * rot_z)
-                yaw = math.atan2(siny_cosp, cosy_cosp)
-                roll, pitch, yaw = math.degrees(roll), math.degrees(pitch), math.degrees(yaw)
-
-                self.rotation = [roll, pitch, yaw]
\ No newline at end of file
+                build = _handshake.unpack_from(msg, _header.size)[-1]
+                offset = _header.size + _handshake.size
+                device.firmware = "{} (build {})".format(msg[offset + 1:offset + 1 + msg[offset]].decode("utf-8", "replace"), build)
+            except (struct.error, IndexError):
+                pass
+            print("Handshake received from", source, "with firmware", device.firmware)
+            self.sobj.sendto(_handshake_response, source)
+
+        elif type == PACKET_ROTATION:
+            try:
+                device.rotation.put((now, np.array(_rotation.unpack_from(msg, _header.size))))
+            except struct.error:
+                pass
+
+    def send_heartbeats(self, now):
+        devices = self.devices
+        for address, device in devices.items():
+            if now - device.last_packet > self.timeout:
+                print("OwoTrack device", address, "timed out")
+                self.devices = {a: d for a, d in self.devices.items() if d is not device}
+                continue
+            try:
+                self.sobj.sendto(_heartbeat, address)
+            except OSError:
+                pass
+
+
+def quat_to_euler(q):
+    # Roll, pitch and yaw in degrees of a quaternion (x, y, z, w)
+    rot_x, rot_y, rot_z, rot_w = q
+    sinr_cosp = 2 * (rot_w * rot_x + rot_y * rot_z)
+    cosr_cosp = 1 - 2 * (rot_x * rot_x + rot_y * rot_y)
+    roll = math.atan2(sinr_cosp, cosr_cosp)
+
+    sinp = 2 * (rot_w * rot_y - rot_z * rot_x)
+    if abs(sinp) >= 1:
+        pitch = math.copysign(math.pi / 2, sinp)
+    else:
+        pitch = math.asin(sinp)
+
+    siny_cosp = 2 * (rot_w * rot_z + rot_x * rot_y)
+    cosy_cosp = 1 - 2 * (rot_y * rot_y + rot_z * rot_z)
+    yaw = math.atan2(siny_cosp, cosy_cosp)
+    return [math.degrees(roll), math.degrees(pitch), math.degrees(yaw)]
@@ -0,0 +1,480 @@
+# Small runtime for running the tracking pipeline as a graph of stages
+# Stages are connected through named mailboxes. The policy of each mailbox decides what happens
+# when a stage produces items faster than the next stage can consume them:
+#   "latest":      only the newest item is kept, older ones are dropped (default)
+#   "drop_oldest": up to size items are kept, the oldest one is dropped when full
+#   "fifo":        up to size items are kept, the producer blocks when full (back-pressure)
+# Stages run on their own thread by default, but can also be run in a worker process (see ProcessRunner)
+from collections import deque
+import multiprocessing
+import numpy as np
+import threading
+import time
+
+from .tracing import Trace
+
+class MailboxClosed(Exception):
+    pass
+
+class Mailbox:
+    def __init__(self, name, policy="latest", size=1):
+        if policy not in ("latest", "drop_oldest", "fifo"):
+            raise ValueError('Unknown mailbox policy: {}'.format(policy))
+
+        self.name = name
+        self.policy = policy
+        self.size = 1 if policy == "latest" else max(int(size), 1)
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.puts = 0
+        self.dropped = 0
+        self.on_drop = None # Called with the trace of every dropped item
+
+    def put(self, item, trace=None):
+        with self.cond:
+            if self.policy == "fifo":
+                while len(self.items) >= self.size and not self.closed:
+                    self.cond.wait()
+            elif len(self.items) >= self.size:
+                _, dropped_trace, _ = self.items.popleft()
+                self.dropped += 1
+                if self.on_drop is not None:
+                    self.on_drop(dropped_trace)
+
+            if self.closed:
+                raise MailboxClosed(self.name)
+
+            self.items.append((item, trace, time.monotonic()))
+            self.puts += 1
+            self.cond.notify_all()
+
+    def get(self):
+        # Returns the item and its trace
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+
+            if self.closed:
+                raise MailboxClosed(self.name)
+
+            item, trace, put_time = self.items.popleft()
+            self.cond.notify_all()
+
+        if trace is not None:
+            trace.wait(self.name, time.monotonic() - put_time)
+        return item, trace
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+# Holds a single value which is read without being consumed (eg. the ROI fed back by the landmark stage)
+class Slot:
+    def __init__(self, name, value=None):
+        self.name = name
+        self.value = value
+
+    def put(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class Stage:
+    # inputs:  mailboxes read by the stage, one item of each is passed to process
+    # outputs: mailboxes the stage writes to, the first one receives the return value of process
+    # slots:   slots the stage reads or writes
+    # Stages without inputs are sources, process gets called in a loop
+    # Stages without outputs are sinks, the trace of the frame set ends there
+    # self.trace holds the trace of the frame set being processed
+    # self.config is replaced by the config of the pipeline between frames, when it changed (see utils/config.py)
+    def __init__(self, name, inputs=(), outputs=(), slots=()):
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.slots = list(slots)
+        self.pipeline = None
+        self.trace = None
+        self.emitted = False
+        self.config = None
+
+    def setup(self):
+        # Called on the thread (or in the process) of the stage before it starts processing
+        # Resources which can't be shared between processes (models, sockets, ...) should be created here
+        pass
+
+    def teardown(self):
+        # Called on the thread (or in the process) of the stage after it stopped processing
+        pass
+
+    def reconfigure(self, previous):
+        # Called before processing a frame when self.config has been replaced, previous is the old config
+        # State which was built from the config (eg. filters) should be rebuilt here when its settings changed
+        pass
+
+    def __getstate__(self):
+        # The pipeline stays in the main process when the stage gets sent to a worker process
+        state = self.__dict__.copy()
+        state["pipeline"] = None
+        return state
+
+    def process(self, *items):
+        raise NotImplementedError
+
+    def emit(self, output, item):
+        if output not in self.outputs:
+            raise ValueError('Stage {} has no output {}'.format(self.name, output))
+        self.trace.end(self.name)
+        self.emitted = True
+        self.pipeline.mailboxes[output].put(item, self.trace)
+
+    def slot(self, name):
+        if name not in self.slots:
+            raise ValueError('Stage {} has no slot {}'.format(self.name, name))
+        return self.pipeline.slots[name]
+
+    def step(self, items, traces):
+        config = self.pipeline.config
+        if config is not None and config is not self.config:
+            previous, self.config = self.config, config
+            if previous is not None:
+                self.reconfigure(previous)
+
+        self.trace = Trace.merge(traces) if traces else Trace()
+        self.trace.begin(self.name)
+        self.emitted = False
+
+        result = self.process(*items)
+        if not self.outputs:
+            self.trace.end(self.name)
+            self.pipeline.complete(self.trace)
+        elif result is not None:
+            self.emit(self.outputs[0], result)
+        elif not self.emitted:
+            # The frame set doesn't go any further (eg. no person was found)
+            self.pipeline.discard(self.trace)
+
+    def run(self):
+        self.setup()
+        inputs = [self.pipeline.mailboxes[name] for name in self.inputs]
+        try:
+            while self.pipeline.running:
+                received = [mailbox.get() for mailbox in inputs]
+                self.step([item for item, _ in received], [trace for _, trace in received])
+        except MailboxClosed:
+            pass
+        finally:
+            self.teardown()
+
+
+#region Multiprocessing
+# Items get passed to and from worker processes through shared memory
+# Only the structure of the item (lists, tuples, dicts, scalars) gets pickled, the arrays are copied into the shared memory block
+class _ArrayRef:
+    def __init__(self, index):
+        self.index = index
+
+def _flatten(item, arrays):
+    if isinstance(item, np.ndarray):
+        arrays.append(item)
+        return _ArrayRef(len(arrays) - 1)
+    elif isinstance(item, (list, tuple)):
+        return type(item)(_flatten(x, arrays) for x in item)
+    elif isinstance(item, dict):
+        return {k: _flatten(v, arrays) for k, v in item.items()}
+    return item
+
+def _unflatten(item, arrays):
+    if isinstance(item, _ArrayRef):
+        return arrays[item.index]
+    elif isinstance(item, (list, tuple)):
+        return type(item)(_unflatten(x, arrays) for x in item)
+    elif isinstance(item, dict):
+        return {k: _unflatten(v, arrays) for k, v in item.items()}
+    return item
+
+# shared_memory is imported when a block gets created or attached, so it's only loaded when process_stages are used
+def _attach(name):
+    from multiprocessing import shared_memory
+    # Attaching shouldn't register the block with the resource tracker, as the writer owns it
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedWriter:
+    # Writes items into a shared memory block, which grows when an item doesn't fit
+    # The reader must have read the previous item before the next one gets written
+    def __init__(self):
+        self.shm = None
+
+    def write(self, item):
+        arrays = []
+        structure = _flatten(item, arrays)
+        arrays = [np.ascontiguousarray(a) for a in arrays]
+        size = sum((a.nbytes + 63) // 64 * 64 for a in arrays)
+
+        if self.shm is None or self.shm.size < size:
+            from multiprocessing import shared_memory
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size * 2, 1 << 20))
+
+        refs = []
+        offset = 0
+        for a in arrays:
+            np.ndarray(a.shape, a.dtype, buffer=self.shm.buf, offset=offset)[...] = a
+            refs.append((offset, a.shape, a.dtype.str))
+            offset += (a.nbytes + 63) // 64 * 64
+        return (self.shm.name, structure, refs)
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class SharedReader:
+    def __init__(self):
+        self.shm = None
+
+    def read(self, layout):
+        name, structure, refs = layout
+        if self.shm is None or self.shm.name != name:
+            if self.shm is not None:
+                self.shm.close()
+            self.shm = _attach(name)
+
+        # Arrays are copied out, so that the writer can reuse the block
+        arrays = [np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset).copy() for offset, shape, dtype in refs]
+        return _unflatten(structure, arrays)
+
+
+# Stands in for the pipeline inside of a worker process
+# Items emitted by the stage and values put in slots get sent back to the main process
+class _WorkerMailbox:
+    def __init__(self, name, conn):
+        self.name = name
+        self.conn = conn
+        self.writer = SharedWriter()
+
+    def put(self, item, trace=None):
+        self.conn.send(("emit", self.name, self.writer.write(item), trace))
+        self.conn.recv() # Wait until the main process has read the item
+
+class _WorkerSlot(Slot):
+    def __init__(self, name, conn):
+        super().__init__(name)
+        self.conn = conn
+
+    def put(self, value):
+        self.value = value
+        self.conn.send(("slot", self.name, value))
+
+class _WorkerPipeline:
+    def __init__(self, stage, conn):
+        self.conn = conn
+        self.running = True
+        self.config = stage.config # Replaced when the main process sends a new one
+        self.mailboxes = {name: _WorkerMailbox(name, conn) for name in stage.outputs}
+        self.slots = {name: _WorkerSlot(name, conn) for name in stage.slots}
+
+    def stop(self):
+        self.running = False
+        self.conn.send(("stop",))
+
+    def complete(self, trace):
+        self.conn.send(("trace", trace))
+
+    def discard(self, trace):
+        self.conn.send(("discard", trace))
+
+    def stats(self):
+        # The mailboxes live in the main process
+        return {}
+
+def _run_worker(stage, conn_in, conn_out):
+    stage.pipeline = _WorkerPipeline(stage, conn_out)
+    stage.setup()
+
+    reader = SharedReader()
+    while stage.pipeline.running:
+        layout = conn_in.recv()
+        if layout is None:
+            break
+        items, slots, trace, config = reader.read(layout)
+        conn_in.send(True) # The input block can be reused
+        if config is not None:
+            stage.pipeline.config = config
+
+        # The slots are updated with the values they had in the main process when the items were taken
+        for name, value in slots.items():
+            stage.pipeline.slots[name].value = value
+
+        stage.step(items, [trace])
+
+    stage.teardown()
+    for mailbox in stage.pipeline.mailboxes.values():
+        mailbox.writer.close()
+
+
+# Runs a stage in a worker process
+# A feed thread takes the inputs from the mailboxes and sends them to the worker,
+# and a collect thread puts the outputs of the worker in the mailboxes of the main process
+class ProcessRunner:
+    def __init__(self, pipeline, stage):
+        if not stage.inputs:
+            raise ValueError('Stage {} has no inputs and can\'t run in a process'.format(stage.name))
+
+        self.pipeline = pipeline
+        self.stage = stage
+        self.process = None
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.conn_in, child_in = ctx.Pipe()
+        self.conn_out, child_out = ctx.Pipe()
+        self.process = ctx.Process(target=_run_worker, args=(self.stage, child_in, child_out), name=self.stage.name, daemon=True)
+        self.process.start()
+
+        threads = [
+            threading.Thread(target=self.feed, name=self.stage.name + "_feed", daemon=True),
+            threading.Thread(target=self.collect, name=self.stage.name + "_collect", daemon=True)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def feed(self):
+        inputs = [self.pipeline.mailboxes[name] for name in self.stage.inputs]
+        writer = SharedWriter()
+        sent = self.stage.config
+        try:
+            while self.pipeline.running:
+                received = [mailbox.get() for mailbox in inputs]
+                items = [item for item, _ in received]
+                trace = Trace.merge([trace for _, trace in received])
+                slots = {name: self.pipeline.slots[name].get() for name in self.stage.slots}
+                # The config only gets sent along when it changed
+                config = self.pipeline.config
+                update = config if config is not sent else None
+                sent = config
+                self.conn_in.send(writer.write((items, slots, trace, update)))
+                self.conn_in.recv() # Wait until the worker has read the item
+        except (MailboxClosed, EOFError, OSError):
+            pass
+        finally:
+            # Tells the worker to stop
+            try:
+                self.conn_in.send(None)
+            except OSError:
+                pass
+            writer.close()
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+
+    def collect(self):
+        readers = {}
+        try:
+            while True:
+                msg = self.conn_out.recv()
+                if msg[0] == "emit":
+                    _, name, layout, trace = msg
+                    item = readers.setdefault(name, SharedReader()).read(layout)
+                    self.conn_out.send(True)
+                    self.pipeline.mailboxes[name].put(item, trace)
+                elif msg[0] == "trace":
+                    self.pipeline.complete(msg[1])
+                elif msg[0] == "discard":
+                    self.pipeline.discard(msg[1])
+                elif msg[0] == "slot":
+                    self.pipeline.slots[msg[1]].put(msg[2])
+                elif msg[0] == "stop":
+                    self.pipeline.stop()
+        except (MailboxClosed, EOFError, OSError):
+            pass
+#endregion
+
+
+class Pipeline:
+    def __init__(self, policies=None, process_stages=(), monitor=None, config=None):
+        # policies: {mailbox name: {"policy": ..., "size": ...}}, the "default" entry applies to all other mailboxes
+        # process_stages: names of the stages which run in a worker process instead of a thread
+        # monitor: tracing.LatencyMonitor which receives the trace of every frame set that reached a sink
+        # config: config of the stages, assigning a new one makes every stage switch to it before its next frame
+        self.config = config
+        self.policies = policies or {}
+        self.process_stages = list(process_stages)
+        self.monitor = monitor
+        if monitor is not None:
+            monitor.pipeline = self
+        self.mailboxes = {}
+        self.slots = {}
+        self.stages = []
+        self.threads = []
+        self.runners = []
+        self.running = False
+        self.listeners = [] # Called with the trace of every frame set leaving the pipeline, and whether it reached a sink
+
+    def mailbox(self, name):
+        if name not in self.mailboxes:
+            config = self.policies.get(name, self.policies.get("default", {}))
+            self.mailboxes[name] = Mailbox(name, config.get("policy", "latest"), config.get("size", 1))
+            self.mailboxes[name].on_drop = self.discard
+        return self.mailboxes[name]
+
+    def add(self, stage):
+        for name in stage.inputs + stage.outputs:
+            self.mailbox(name)
+        for name in stage.slots:
+            self.slots.setdefault(name, Slot(name))
+
+        stage.pipeline = self
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        self.running = True
+        for stage in self.stages:
+            if stage.name in self.process_stages:
+                runner = ProcessRunner(self, stage)
+                self.threads += runner.start()
+                self.runners.append(runner)
+            else:
+                thread = threading.Thread(target=stage.run, name=stage.name, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        for mailbox in self.mailboxes.values():
+            mailbox.close()
+        for runner in self.runners:
+            runner.join(1)
+
+    def join(self, timeout=None):
+        # Waits for the stages to finish their current item after stop
+        end = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if end is None else max(end - time.monotonic(), 0))
+
+    def complete(self, trace):
+        if self.monitor is not None:
+            self.monitor.record(trace)
+        for listener in self.listeners:
+            listener(trace, True)
+
+    def discard(self, trace):
+        for listener in self.listeners:
+            listener(trace, False)
+
+    def stats(self):
+        # Amount of items put in and dropped by every mailbox
+        return {name: {"puts": mailbox.puts, "dropped": mailbox.dropped} for name, mailbox in self.mailboxes.items()}
@@ -1,40 +1,39 @@
 # Calculate and send pose tracker position and rotation based on keypoints location
 import numpy as np
 from . import owotrack
-from scipy.spatial.transform import Rotation as R
+from . import solver
+from . import skeleton
 
 def get_foot_rot(knee, ankle, direction):
-    # Calculate the unit vector from the ankle to the knee
-    ankle_to_knee = knee - ankle
-    ankle_to_knee /= np.linalg.norm(ankle_to_knee)
-
-    # Calculate the vector that points forward while being perpendicular to the ankle to knee vector (the lower leg)
-    forward_vector = np.array([0, 0, 1.])
-    forward_vector -= np.dot(forward_vector, ankle_to_knee) * ankle_to_knee
-    forward_vector /= np.linalg.norm(forward_vector)
-
-    # Rotate the forward vetor around the ankle to knee vector by the direction
-    angle = direction / 180 * np.pi
-    point = forward_vector
-    point = np.cos(angle) * point + np.sin(angle) * np.cross(ankle_to_knee, point) + np.dot(ankle_to_knee, point) * ankle_to_knee
-    point = np.dot(R.from_euler("y", angle).as_matrix(), point)
-
-    # Convert forward up right to rotation vector
-    rot = R.from_matrix(np.column_stack((np.cross(ankle_to_knee, point), ankle_to_knee, point)))
-    return np.rad2deg(rot.as_rotvec())
+    return solver.limb_rot(knee[None], ankle[None], np.array([direction], dtype=float))[0]
 
 
 def get_hip_rot(left_shoulder, right_shoulder, left_hip, right_hip):
     shoulder_midpoint = (left_shoulder + right_shoulder) / 2
     hip_midpoint = (left_hip + right_hip) / 2
-    spine_direction = hip_midpoint - shoulder_midpoint
-    spine_direction /= np.linalg.norm(spine_direction)
-    hip_direction = right_hip - left_hip
-    hip_direction /= np.linalg.norm(hip_direction)
-    axis_of_rotation = np.cross(spine_direction, hip_direction)
-    angle_of_rotation = np.arccos(np.dot(spine_direction, hip_direction) / (np.linalg.norm(spine_direction) * np.linalg.norm(hip_direction)))
-    rotation_vector = axis_of_rotation * angle_of_rotation
-    return np.rad2deg(rotation_vector)
+    return solver.torso_rot(shoulder_midpoint[None], hip_midpoint[None], left_hip[None], right_hip[None])[0]
+
+def get_required_joints(extra_trackers=False):
+    # Keypoints used by calc_pose, and the keypoints used for calculating the ROI (33, 34)
+    # The shoulders and hips (11, 12, 23, 24) are always needed for the hip rotation
+    joints = [7, 8, 11, 12, 23, 24, 25, 26, 27, 28, 33, 34]
+    if extra_trackers:
+        joints += [13, 14]
+    return np.array(sorted(joints))
+
+def select_joints(config):
+    # Keypoints which get processed, all of them are only needed for the debug views
+    if config.debug or config.draw_pose:
+        return np.arange(39)
+
+    joints = get_required_joints(config.extra_trackers)
+    if config.required_joints is not None:
+        joints = np.union1d(joints, config.required_joints)
+    if config.flip_detection:
+        joints = np.union1d(joints, np.arange(1, 23))
+    if config.skeleton_fit:
+        joints = np.union1d(joints, skeleton.bones.flatten())
+    return joints
 
 owotrack_server = None
 def start_owotrack_server():
@@ -44,25 +43,30 @@ def start_owotrack_server():
         owotrack_server = owotrack.OwoTrackServer(6969)
 
 
-def calc_pose(points, client, send_rot=False):
+def send_hip_rot(client, rotvec=None):
+    # rotvec is the hip rotation of solver.solve, the hip isn't turned without one
+    # Returns the rotation which was sent
+    rot = rotvec[[1, 0, 2]] if rotvec is not None else np.zeros(3)
+    client.send_rot(3, rot)
+    return rot
+
+# Returns the rotations of solver.solve, fused_hip leaves the hip rotation to the fusion stage (see utils/fusion.py)
+def calc_pose(points, client, send_rot=False, extra_trackers=False, fused_hip=False):
+    # All tracker rotations are calculated at once
+    rot = solver.solve(points, send_rot, extra_trackers)
+
     # Hips
-    direction = 0
     hip_center = points[33]
     client.send_pos(3, hip_center)
 
-    if owotrack_server and owotrack_server.connected:
-        #direction = owotrack_server.rotation[0]
-        client.send_rot(3, owotrack_server.rotation)
-    if send_rot:
-        left_shoulder = points[11]
-        right_shoulder = points[12]
-        left_hip = points[23]
-        right_hip = points[24]
-        hip_rot = get_hip_rot(left_shoulder, right_shoulder, left_hip, right_hip)
-        direction = hip_rot[0]
-        client.send_rot(3, hip_rot[[1, 0, 2]])
-    else:
-        client.send_rot(3)
+    # The first owoTrack device turns the hips, as long as it keeps sending
+    # With fused_hip, the fusion stage sends the hip rotation at the rate of the device instead
+    if not fused_hip:
+        imu = owotrack_server.latest(0, max_age=0.5) if owotrack_server else None
+        if imu is not None:
+            client.send_rot(3, owotrack.quat_to_euler(imu[1]))
+        else:
+            send_hip_rot(client, rot[solver.HIP] if send_rot else None)
 
     # Head
     head_center = (points[7] + points[8]) / 2
@@ -74,11 +78,28 @@ def calc_pose(points, client, send_rot=False):
     client.send_pos(1, left_ankle)
     client.send_pos(2, right_ankle)
 
-    client.send_rot(1, get_foot_rot(left_knee, left_ankle, direction))
-    client.send_rot(2, get_foot_rot(right_knee, right_ankle, direction))
+    client.send_rot(1, rot[solver.LEFT_FOOT])
+    client.send_rot(2, rot[solver.RIGHT_FOOT])
 
     # Knees
     client.send_pos(4, left_knee)
     client.send_pos(5, right_knee)
-    client.send_rot(4)
-    client.send_rot(5)
\ No newline at end of file
+    if extra_trackers:
+        client.send_rot(4, rot[solver.LEFT_KNEE])
+        client.send_rot(5, rot[solver.RIGHT_KNEE])
+    else:
+        client.send_rot(4)
+        client.send_rot(5)
+
+    # Chest and elbows
+    if extra_trackers:
+        chest_center = (points[11] + points[12]) / 3 + (points[23] + points[24]) / 6
+        client.send_pos(6, chest_center)
+        client.send_rot(6, rot[solver.CHEST][[1, 0, 2]])
+        client.send_pos(7, points[13])
+        client.send_pos(8, points[14])
+        client.send_rot(7, rot[solver.LEFT_ELBOW])
+        client.send_rot(8, rot[solver.RIGHT_ELBOW])
+
+    client.flush()
+    return rot
\ No newline at end of file
@@ -0,0 +1,86 @@
+# Live camera previews of calibtool.py, which have to stay responsive with many cameras
+# Every camera is read by a thread of its own, so the GUI never waits for a frame. Previews get downscaled and encoded
+# as PPM (uncompressed, which Tk shows as is) at a capped rate: encoding full frames as PNG took most of the GUI time.
+import threading
+import time
+
+import cv2
+
+from . import calibration
+
+class FrameGrabber:
+    # Reads the frames of a camera on a background thread, and keeps the latest one
+    def __init__(self, camera):
+        self.camera = camera
+        self.frame = None
+        self.sequence = 0
+        self.seen = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._read_loop, name="frame_grabber", daemon=True)
+        self.thread.start()
+
+    def _read_loop(self):
+        while self.running:
+            ret, frame = self.camera.read()
+            if not ret:
+                time.sleep(0.01)
+                continue
+            self.frame = frame
+            self.sequence += 1
+
+    def read(self):
+        # Like camera.read(), but doesn't wait: ret is False when there is no new frame since the last read()
+        sequence, frame = self.sequence, self.frame
+        if sequence == self.seen:
+            return False, None
+        self.seen = sequence
+        return True, frame
+
+    def stop(self):
+        self.running = False
+        self.thread.join(1)
+
+
+class Undistorter:
+    # Undistorts frames with the intrinsics of calib.json, which are parsed once and turned into maps for cv2.remap
+    # The intrinsics get scaled to the size of the frames, for cameras running at another resolution than they were calibrated at
+    def __init__(self, intrinsics):
+        self.intrinsics = intrinsics
+        self.size = None
+        self.maps = None
+
+    def __call__(self, frame):
+        size = (frame.shape[1], frame.shape[0])
+        if size != self.size:
+            cmtx, dist, opt_cmtx = calibration.scale_intrinsics(self.intrinsics, size)
+            self.maps = cv2.initUndistortRectifyMap(cmtx, dist, None, opt_cmtx, size, cv2.CV_16SC2)
+            self.size = size
+        return cv2.remap(frame, self.maps[0], self.maps[1], cv2.INTER_LINEAR)
+
+
+class Preview:
+    # Shows frames in an sg.Image, downscaled to fit into size and at most max_fps times a second
+    def __init__(self, size=(640, 480), max_fps=30):
+        self.size = size
+        self.interval = 1 / max_fps
+        self.next = 0
+
+    @property
+    def due(self):
+        # Whether the next update gets shown, frames only need to be drawn when it does
+        return time.monotonic() >= self.next
+
+    def update(self, element, frame):
+        now = time.monotonic()
+        if now < self.next:
+            return
+        self.next = now + self.interval
+        element.update(data=encode(frame, self.size))
+
+
+def encode(frame, size=(640, 480)):
+    # PPM of frame, downscaled to fit into size
+    scale = min(size[0] / frame.shape[1], size[1] / frame.shape[0], 1)
+    if scale < 1:
+        frame = cv2.resize(frame, (round(frame.shape[1] * scale), round(frame.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+    return cv2.imencode(".ppm", frame)[1].tobytes()
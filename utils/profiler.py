@@ -0,0 +1,131 @@
+# Sampling profiler which can be started while the tracker is running
+# The stacks of all threads get sampled with sys._current_frames() for a few seconds. When done,
+# a collapsed stack file (which can be turned into a flamegraph with flamegraph.pl or speedscope) gets written
+# for every thread, together with a summary of the time spent in the functions of utils.
+from socket import socket, AF_INET, SOCK_DGRAM
+from collections import Counter
+import threading
+import signal
+import math
+import time
+import sys
+import os
+
+# Innermost functions which mean the thread is waiting (on a mailbox, a worker process, ...) instead of working
+# Waits inside C functions (time.sleep, socket.recvfrom, camera reads) can't be told apart from work
+idle_functions = {"threading.Condition.wait", "threading.Thread._wait_for_tstate_lock", "multiprocessing.connection.Connection._recv"}
+
+def _label(frame):
+    code = frame.f_code
+    return "{}.{}".format(frame.f_globals.get("__name__", "?"), getattr(code, "co_qualname", code.co_name))
+
+
+class SamplingProfiler:
+    def __init__(self, rate=100, duration=10, output="profiles"):
+        self.rate = rate
+        self.duration = duration
+        self.output = output
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration=None):
+        # Returns False if the profiler is already running
+        if self.running:
+            return False
+
+        self.thread = threading.Thread(target=self._sample, args=(duration or self.duration,), name="profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def _sample(self, duration):
+        print("Profiling for {} seconds...".format(duration))
+        stacks = {} # thread name: Counter of stacks
+        interval = 1 / self.rate
+        own = threading.get_ident()
+
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame))
+                    frame = frame.f_back
+                stacks.setdefault(names.get(ident, str(ident)), Counter())[tuple(reversed(stack))] += 1
+            time.sleep(interval)
+
+        self.write(stacks)
+
+    def write(self, stacks):
+        os.makedirs(self.output, exist_ok=True)
+        prefix = os.path.join(self.output, time.strftime("profile_%Y%m%d_%H%M%S"))
+
+        summary = []
+        for thread, counter in sorted(stacks.items()):
+            # Collapsed stacks, one "frame;frame;frame count" line per unique stack
+            with open("{}_{}.collapsed".format(prefix, thread), "w") as f:
+                for stack, count in counter.most_common():
+                    f.write("{} {}\n".format(";".join(stack), count))
+
+            summary.append(self.summarize(thread, counter))
+
+        with open(prefix + "_summary.txt", "w") as f:
+            f.write("\n".join(summary))
+        print("Profile written to {}_*".format(prefix))
+
+    def summarize(self, thread, counter):
+        # Share of the samples of the thread spent in each utils function
+        # Self only counts the samples where the function was the innermost utils function on the stack
+        total = sum(counter.values())
+        idle = sum(count for stack, count in counter.items() if stack and stack[-1] in idle_functions)
+        inclusive = Counter()
+        exclusive = Counter()
+        for stack, count in counter.items():
+            functions = [label for label in stack if label.startswith("utils.")]
+            for label in set(functions):
+                inclusive[label] += count
+            if functions:
+                exclusive[functions[-1]] += count
+
+        lines = ["{} ({} samples, {:.1f}% waiting)".format(thread, total, 100 * idle / total)]
+        for label, count in inclusive.most_common():
+            lines.append("    {:6.1f}% total {:6.1f}% self  {}".format(100 * count / total, 100 * exclusive[label] / total, label))
+        return "\n".join(lines) + "\n"
+
+    def listen(self, port):
+        # Starts the profiler when a "profile [seconds]" datagram is received on 127.0.0.1:port
+        def loop():
+            sock = socket(AF_INET, SOCK_DGRAM)
+            sock.bind(("127.0.0.1", port))
+            while True:
+                try:
+                    msg, source = sock.recvfrom(64)
+                    command = msg.decode("utf-8", "ignore").split()
+                    if not command or command[0] != "profile":
+                        continue
+                    try:
+                        duration = float(command[1]) if len(command) > 1 else None
+                    except ValueError:
+                        duration = -1
+                    if duration is not None and not 0 < duration < math.inf:
+                        sock.sendto(b"error: the duration must be a number of seconds", source)
+                        continue
+                    sock.sendto(b"started" if self.start(duration) else b"busy", source)
+                except ConnectionResetError:
+                    # Windows reports a reply which couldn't be delivered on the next receive, the socket is fine
+                    continue
+
+        threading.Thread(target=loop, name="profiler_listen", daemon=True).start()
+
+    def install_signal(self):
+        # Starts the profiler on SIGUSR1 (Linux/Mac) or Ctrl+Break (Windows)
+        # Must be called from the main thread
+        sig = getattr(signal, "SIGUSR1", None) or getattr(signal, "SIGBREAK", None)
+        if sig is not None:
+            signal.signal(sig, lambda signum, frame: self.start())
@@ -0,0 +1,158 @@
+# Binary log of every frame set sent by the tracker, for analysing jitter, flips and dropouts afterwards
+# and for tuning the filters without the cameras (see tunetool.py)
+# The file is a JSON header padded to a multiple of 4096 bytes, followed by records of a NumPy structured dtype,
+# so a log can be opened without copying with load(path).
+# Records are written into preallocated chunks, and full chunks get written to the file by a background thread.
+# Logging never blocks: when the disk can't keep up and no free chunk is left, records are dropped (and counted).
+import threading
+import queue
+import json
+import time
+import os
+
+import numpy as np
+
+HEADER_SIZE = 4096
+VERSION = 2
+TRACKERS = [1, 2, 3, 4, 5, 6, 7, 8, "head"]
+_tracker_index = {tracker: i for i, tracker in enumerate(TRACKERS)}
+
+def record_dtype(cam_count, num_points=39, version=VERSION):
+    fields = [
+        ("time", "<f8"),                                  # time.time() when the trackers were sent
+        ("capture", "<f8"),                               # time.monotonic() of the capture of the oldest frame
+        ("landmarks", "<f4", (cam_count, num_points, 4)), # x, y (pixels), z, visibility
+        ("flags", "<f4", (cam_count,)),                   # f score of the landmark model
+        ("roi", "<f4", (cam_count, 4)),                   # xc, yc, scale, theta of the ROI for the next frame
+        ("points", "<f4", (num_points, 3)),               # triangulated points (m), before skeleton fitting and filtering
+        ("filtered", "<f4", (num_points, 3)),             # points used for the trackers
+        ("residuals", "<f4", (num_points,)),              # reprojection error in pixels (weighted multicam mode only)
+        ("tracker_pos", "<f4", (len(TRACKERS), 3)),       # as sent over OSC, NaN if not sent
+        ("tracker_rot", "<f4", (len(TRACKERS), 3)),
+    ]
+    if version >= 2:
+        # Before flip detection and the 2d filter, NaN when not known (see tunetool.py)
+        fields.append(("raw_landmarks", "<f4", (cam_count, num_points, 4)))
+    return np.dtype(fields)
+
+
+def load(path):
+    # Returns the header and a read-only memory-mapped array of the records
+    # The header is padded to a multiple of HEADER_SIZE, and ends with at least one zero byte
+    data = b""
+    with open(path, "rb") as f:
+        while b"\0" not in data:
+            block = f.read(HEADER_SIZE)
+            if not block:
+                raise ValueError("{} is not a session log".format(path))
+            data += block
+    header = json.loads(data.rstrip(b"\0"))
+    dtype = record_dtype(header["cameras"], header["points"], header["version"])
+    count = (os.path.getsize(path) - len(data)) // dtype.itemsize
+    if count == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode="r", offset=len(data), shape=(count,))
+
+
+class TrackerTap:
+    # Wraps the OSC client, and keeps the last position and rotation sent for every tracker
+    def __init__(self, client):
+        self.client = client
+        self.positions = np.full((len(TRACKERS), 3), np.nan)
+        self.rotations = np.full((len(TRACKERS), 3), np.nan)
+
+    def send_pos(self, p, v = [0,0,0]):
+        self.positions[_tracker_index[p]] = v
+        self.client.send_pos(p, v)
+
+    def send_rot(self, p, v = [0,0,0]):
+        self.rotations[_tracker_index[p]] = v
+        self.client.send_rot(p, v)
+
+    def record_rot(self, p, v):
+        # A rotation which was sent through another client, like the hip rotation of the fusion stage
+        self.rotations[_tracker_index[p]] = v
+
+    def flush(self):
+        self.client.flush()
+
+
+class SessionLogger:
+    # proj are the projection matrices of the cameras, which get stored in the header for replaying the log
+    # resolutions are the (width, height) of the raw frames of the cameras, the pixels the reprojection errors are measured in
+    def __init__(self, path, cam_count, num_points=39, chunk_size=256, chunks=8, proj=None, resolutions=None):
+        self.path = path
+        self.dtype = record_dtype(cam_count, num_points)
+        self.free = queue.Queue()
+        for _ in range(chunks):
+            self.free.put(np.zeros(chunk_size, dtype=self.dtype))
+        self.full = queue.Queue()
+        self.chunk = self.free.get()
+        self.count = 0
+        self.dropped = 0
+
+        header = {"version": VERSION, "cameras": cam_count, "points": num_points, "trackers": TRACKERS, "start": time.time()}
+        if proj is not None:
+            header["proj"] = [np.asarray(p).tolist() for p in proj]
+        if resolutions is not None:
+            header["resolutions"] = [[int(r[0]), int(r[1])] for r in resolutions]
+        with open(path, "wb") as f:
+            data = json.dumps(header).encode()
+            f.write(data.ljust((len(data) // HEADER_SIZE + 1) * HEADER_SIZE, b"\0"))
+
+        self.thread = threading.Thread(target=self._write_loop, name="session_log", daemon=True)
+        self.thread.start()
+
+    def record(self):
+        # Returns the next record to fill in, or None when the record has to be dropped
+        if self.chunk is None or self.count == len(self.chunk):
+            if self.chunk is not None:
+                self.full.put((self.chunk, self.count))
+            try:
+                self.chunk = self.free.get_nowait()
+            except queue.Empty:
+                self.chunk = None
+                self.dropped += 1
+                return None
+            self.count = 0
+
+        record = self.chunk[self.count]
+        self.count += 1
+        return record
+
+    def log(self, values, points, filtered, residuals, tap, capture):
+        record = self.record()
+        if record is None:
+            return
+
+        record["time"] = time.time()
+        record["capture"] = capture
+        for i, value in enumerate(values):
+            record["landmarks"][i] = value[1]
+            record["flags"][i] = value[2][0]
+            record["roi"][i] = np.ravel(value[3]) if len(value) > 3 else np.nan
+            record["raw_landmarks"][i] = value[4] if len(value) > 4 and value[4] is not None else np.nan
+        record["points"] = points
+        record["filtered"] = filtered
+        record["residuals"] = np.nan if residuals is None else residuals
+        record["tracker_pos"] = tap.positions
+        record["tracker_rot"] = tap.rotations
+
+    def _write_loop(self):
+        with open(self.path, "ab") as f:
+            while True:
+                item = self.full.get()
+                if item is None:
+                    break
+                chunk, count = item
+                f.write(chunk[:count].data)
+                f.flush()
+                self.free.put(chunk)
+
+    def close(self):
+        # Writes the records of the current chunk, and waits until everything is on disk
+        if self.chunk is not None and self.count > 0:
+            self.full.put((self.chunk, self.count))
+            self.chunk = None
+        self.full.put(None)
+        self.thread.join()
@@ -0,0 +1,58 @@
+# Bone length constrained skeleton fitting for the triangulated 3d keypoints
+# The bone lengths of the user are learned during the first seconds, after which every frame
+# gets projected onto a skeleton with those bone lengths. This removes most of the bone stretching
+# caused by triangulation noise, which means the 3d filter can be a lot lighter.
+import numpy as np
+
+# Same topology as draw.connections_body, without the duplicate edges used for drawing it as a single line
+bones = np.array([
+    (33, 23), (33, 24), (23, 24), (11, 12), (11, 23), (12, 24),            # Torso
+    (11, 13), (13, 15), (15, 17), (15, 19), (15, 21), (17, 19),            # Left arm
+    (12, 14), (14, 16), (16, 18), (16, 20), (16, 22), (18, 20),            # Right arm
+    (23, 25), (25, 27), (27, 29), (27, 31), (29, 31),                      # Left leg
+    (24, 26), (26, 28), (28, 30), (28, 32), (30, 32),                      # Right leg
+])
+
+class SkeletonFitter:
+    def __init__(self, learn_time=3.0, iterations=10, num_points=39):
+        self.learn_time = learn_time * 1000
+        self.iterations = iterations
+
+        # Every bone pulls its two joints together (or pushes them apart) by half of its error
+        # Each joint then moves by the average of all the corrections of its bones
+        self.incidence = np.zeros((num_points, len(bones)))
+        self.incidence[bones[:, 0], np.arange(len(bones))] = 0.5
+        self.incidence[bones[:, 1], np.arange(len(bones))] = -0.5
+        degree = np.count_nonzero(self.incidence, axis=1)
+        self.incidence /= np.maximum(degree, 1)[:, None]
+
+        self.samples = []
+        self.start = None
+        self.lengths = None
+
+    def bone_lengths(self, points):
+        return np.linalg.norm(points[bones[:, 1]] - points[bones[:, 0]], axis=1)
+
+    def learn(self, points, timestamp):
+        if self.start is None:
+            self.start = timestamp
+
+        self.samples.append(self.bone_lengths(points))
+        if timestamp - self.start >= self.learn_time:
+            # The median ignores the frames where the model made a mistake
+            self.lengths = np.median(self.samples, axis=0)
+            self.samples = None
+
+    def filter(self, points, timestamp=None):
+        if self.lengths is None:
+            self.learn(points, timestamp)
+            return points
+
+        points = points.copy()
+        for _ in range(self.iterations):
+            d = points[bones[:, 1]] - points[bones[:, 0]]
+            length = np.linalg.norm(d, axis=1, keepdims=True)
+            error = (length - self.lengths[:, None]) / np.maximum(length, 1e-9) * d
+            points += self.incidence @ error
+
+        return points
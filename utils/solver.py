@@ -0,0 +1,121 @@
+# Batched tracker rotation math
+# Computes the orientation of every tracker from the 3d keypoints in a single vectorized pass, using only numpy
+import numpy as np
+
+# Rows of the array returned by solve
+HIP, LEFT_FOOT, RIGHT_FOOT, LEFT_KNEE, RIGHT_KNEE, CHEST, LEFT_ELBOW, RIGHT_ELBOW = range(8)
+
+_eye = np.eye(3)
+
+def normalize(v):
+    return v / np.sqrt(np.sum(v * v, axis=-1, keepdims=True))
+
+
+def cross(a, b):
+    # np.cross has a lot of overhead for small arrays
+    return np.stack((
+        a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1],
+        a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2],
+        a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+    ), axis=1)
+
+
+def matrix_to_rotvec(m):
+    # Closed form conversion of rotation matrices (n, 3, 3) to rotation vectors (n, 3) in radians
+    # Follows the same steps as scipy's Rotation.from_matrix(m).as_rotvec()
+
+    # Matrices which are not orthogonal get replaced by the closest rotation matrix
+    gram = m @ m.transpose(0, 2, 1)
+    not_orthogonal = np.any(np.abs(gram - _eye) > 1e-12 + 1e-5 * _eye, axis=(1, 2))
+    if not_orthogonal.any():
+        m = m.copy()
+        u, _, vt = np.linalg.svd(m[not_orthogonal])
+        m[not_orthogonal] = u @ vt
+
+    # Matrix to quaternion (x, y, z, w), using the most numerically stable of the four cases
+    m00, m01, m02 = m[:, 0, 0], m[:, 0, 1], m[:, 0, 2]
+    m10, m11, m12 = m[:, 1, 0], m[:, 1, 1], m[:, 1, 2]
+    m20, m21, m22 = m[:, 2, 0], m[:, 2, 1], m[:, 2, 2]
+    trace = m00 + m11 + m22
+    choice = np.argmax(np.stack((m00, m11, m22, trace), axis=1), axis=1)
+
+    cases = np.stack((
+        1 - trace + 2 * m00, m10 + m01, m20 + m02, m21 - m12,
+        m10 + m01, 1 - trace + 2 * m11, m21 + m12, m02 - m20,
+        m20 + m02, m21 + m12, 1 - trace + 2 * m22, m10 - m01,
+        m21 - m12, m02 - m20, m10 - m01, 1 + trace
+    ), axis=1).reshape(-1, 4, 4)
+    quat = cases[np.arange(len(m)), choice]
+
+    quat /= np.sqrt(np.sum(quat * quat, axis=1, keepdims=True))
+    quat[quat[:, 3] < 0] *= -1
+
+    # Quaternion to rotation vector, with a taylor expansion for small angles
+    angle = 2 * np.arctan2(np.sqrt(np.sum(quat[:, :3] * quat[:, :3], axis=1)), quat[:, 3])
+    small = angle <= 1e-3
+    scale = np.where(small, 2 + angle ** 2 / 12 + 7 * angle ** 4 / 2880, angle / (np.sin(angle / 2) + small))
+    return scale[:, None] * quat[:, :3]
+
+
+def limb_rot(upper, lower, direction):
+    # Rotation of trackers attached to a limb (eg. the foot from the knee and the ankle)
+    # upper, lower: (n, 3), direction: (n,) in degrees
+    # Returns (n, 3) rotation vectors in degrees
+    lower_to_upper = normalize(upper - lower)
+
+    # The vector that points forward while being perpendicular to the limb
+    forward_vector = np.array([0, 0, 1.]) - lower_to_upper[:, 2:] * lower_to_upper
+    forward_vector = normalize(forward_vector)
+
+    # Rotate the forward vector around the limb by the direction, and then around the y axis
+    angle = (direction / 180 * np.pi)[:, None]
+    cos, sin = np.cos(angle), np.sin(angle)
+    point = cos * forward_vector + sin * cross(lower_to_upper, forward_vector) \
+        + np.sum(lower_to_upper * forward_vector, axis=1, keepdims=True) * lower_to_upper
+    point = np.concatenate((
+        cos * point[:, :1] + sin * point[:, 2:],
+        point[:, 1:2],
+        cos * point[:, 2:] - sin * point[:, :1]
+    ), axis=1)
+
+    # Convert forward up right to rotation vector
+    m = np.stack((cross(lower_to_upper, point), lower_to_upper, point), axis=2)
+    return np.rad2deg(matrix_to_rotvec(m))
+
+
+def torso_rot(top, bottom, left, right):
+    # Rotation of trackers attached to the torso (eg. the hip from the shoulder and hip midpoints and the hips)
+    # top, bottom, left, right: (n, 3)
+    # Returns (n, 3) rotation vectors in degrees
+    spine_direction = normalize(bottom - top)
+    side_direction = normalize(right - left)
+    axis_of_rotation = cross(spine_direction, side_direction)
+    angle_of_rotation = np.arccos(np.sum(spine_direction * side_direction, axis=1) / np.sqrt(np.sum(spine_direction * spine_direction, axis=1) * np.sum(side_direction * side_direction, axis=1)))
+    return np.rad2deg(axis_of_rotation * angle_of_rotation[:, None])
+
+
+def solve(points, hip_direction=False, extra=False):
+    # Calculates the rotation of all trackers from the (39, 3) keypoints
+    # If hip_direction is set, the feet get turned by the hip rotation
+    # If extra is set, the chest and elbows are calculated too
+    # Returns an (8, 3) array of rotation vectors in degrees, indexed by HIP, LEFT_FOOT, ...
+    shoulder_midpoint = (points[11] + points[12]) / 2
+    hip_midpoint = (points[23] + points[24]) / 2
+
+    rot = np.zeros((8, 3))
+    if extra:
+        rot[[HIP, CHEST]] = torso_rot(
+            np.stack((shoulder_midpoint, shoulder_midpoint)),
+            np.stack((hip_midpoint, hip_midpoint)),
+            points[[23, 11]],
+            points[[24, 12]]
+        )
+        # Feet, knees and elbows
+        upper, lower, rows = [25, 26, 23, 24, 11, 12], [27, 28, 25, 26, 13, 14], [LEFT_FOOT, RIGHT_FOOT, LEFT_KNEE, RIGHT_KNEE, LEFT_ELBOW, RIGHT_ELBOW]
+    else:
+        rot[HIP] = torso_rot(shoulder_midpoint[None], hip_midpoint[None], points[None, 23], points[None, 24])[0]
+        upper, lower, rows = [25, 26], [27, 28], [LEFT_FOOT, RIGHT_FOOT]
+
+    direction = rot[HIP, 0] if hip_direction else 0
+    rot[rows] = limb_rot(points[upper], points[lower], np.full(len(rows), direction, dtype=float))
+    return rot
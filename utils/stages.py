@@ -0,0 +1,424 @@
+# Stages of the tracking pipeline, see utils/pipeline.py for how they get connected
+import numpy as np
+import time
+import cv2
+import os
+
+from . import inference
+from . import filters
+from . import client
+from . import skeleton
+from . import vision
+from . import pose
+from . import sessionlog
+from . import fusion
+from . import solver
+from .pipeline import Stage
+from camera.recording import FrameRecorder
+
+# Fetch frame of camera, and undistorts it.
+# A CameraStage gets created for each camera for being able to fetch frames in parallel
+# The raw frames get recorded when a recording directory is given (see camera/recording.py)
+# maps are the undistort maps of utils/calibcache.py, which rotate and undistort the frame in one step
+# They are made for the resolution of the camera in calib.json, which the camera has to deliver
+class CameraStage(Stage):
+    def __init__(self, id, camera, oncm, config, recording=None, maps=None):
+        super().__init__("cam{}".format(id), outputs=["cam{}".format(id)])
+        self.id = id
+        self.camera = camera
+        self.oncm = oncm
+        self.config = config
+        self.recording = recording
+        self.recorder = None
+        self.maps = maps
+
+    def setup(self):
+        if self.recording is not None:
+            self.recorder = FrameRecorder(os.path.join(self.recording, "cam{}".format(self.id)))
+
+    def teardown(self):
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def process(self):
+        ret, frame = self.camera.read()   #.read() is general for both cv2 and ps eyes
+        self.trace.mark("capture")
+        if not ret:
+            # The camera got disconnected, or the end of a replay has been reached
+            self.pipeline.stop()
+            return None
+        if self.maps is not None and frame.shape[:2] != self.maps[0].shape[1::-1]:
+            print("Camera {} gives {}x{} frames instead of the {}x{} of calib.json".format(
+                self.id, frame.shape[1], frame.shape[0], self.maps[0].shape[0], self.maps[0].shape[1]))
+            self.pipeline.stop()
+            return None
+        if self.recorder is not None:
+            self.recorder.write(frame, self.trace.marks["capture"])
+        if self.config.undistort and self.maps is not None:
+            frame = cv2.remap(frame, self.maps[0], self.maps[1], cv2.INTER_LINEAR)
+        else:
+            frame = cv2.rotate(frame,2)     #rotate camera sideways, as that gives more vertical space. Should be a setting somewhere
+            if self.config.undistort:
+                frame = cv2.undistort(frame, self.oncm[0], self.oncm[1], None, self.oncm[2])
+        frame.flags.writeable = False
+        return frame
+
+
+# Preprocessing for the pose detection model
+# Takes one frame from each camera
+class PoseDetPreStage(Stage):
+    def __init__(self, cam_count):
+        super().__init__("pose_det_pre", inputs=["cam{}".format(i) for i in range(cam_count)], outputs=["pose_det_pre", "pose_det_post"], slots=["roi"])
+        self.cam_count = cam_count
+
+    def process(self, *frames):
+        imgs = [cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB) for frame in frames]
+
+        values = []
+
+        # If we have a ROI, we can skip the detection step
+        # This ROI is given be the landmark detection
+        roi = self.slot("roi").get()
+        if roi is not None:
+            for i in range(self.cam_count):
+                xc, yc, scale, theta = roi[i]
+                # Images get cropped according to the ROI
+                img2, affine, _ = inference.extract_roi(imgs[i],
+                    np.array([xc]),
+                    np.array([yc]),
+                    np.array([theta]),
+                    np.array([scale])
+                )
+                values.append((img2[0], affine[0], imgs[i]))
+
+            # Images get put on the pose_det_post mailbox directly, skipping the pose detection step
+            # As the images have already been cropped to fit the person
+            self.emit("pose_det_post", values)
+            return None
+
+        # Crops the image to 224x224 for a round of pose detection
+        for i in range(self.cam_count):
+            img224, scale, pad = inference.resize_pad(imgs[i])
+            img224 = img224.astype('float32') / 128. - 1.
+            values.append((img224, scale, pad, imgs[i]))
+        return values
+
+
+# Run inference on the pose detection model
+class PoseDetStage(Stage):
+    def __init__(self, cam_count, config):
+        super().__init__("pose_det", inputs=["pose_det_pre"], outputs=["pose_det"])
+        self.cam_count = cam_count
+        self.config = config
+        self.det_sess = None
+
+    def setup(self):
+        self.det_sess = inference.create_session(self.config.pose_det_model or "models/pose_detection.onnx")
+
+    def process(self, values):
+        for i in range(self.cam_count):
+            img224, scale, pad, img = values[i]
+            img224s = np.expand_dims(img224, axis=0)
+            # TODO: figure out how to batch this
+            pred_onnx = self.det_sess.run(["Identity", "Identity_1"], {"input_1": img224s})
+            values[i] = (pred_onnx, img, scale, pad)
+        return values
+
+
+# Post processing for the detection model
+class PoseDetPostStage(Stage):
+    def __init__(self, cam_count, config):
+        super().__init__("pose_det_post", inputs=["pose_det"], outputs=["pose_det_post"])
+        self.cam_count = cam_count
+        self.config = config
+
+    def process(self, values):
+        for i in range(self.cam_count):
+            pred_onnx, img, scale, pad = values[i]
+            post = inference.detector_postprocess(pred_onnx, min_score_thresh=self.config.pose_det_min_score)
+            count = len(post) if post[0].size != 0 else 0
+
+            # If no person is detected on one of the cameras, we can't continue
+            if count < 1:
+                return None
+
+            imgs, affine, _ = inference.estimator_preprocess(img, post, scale, pad)
+            values[i] = (imgs[0], affine[0], img)
+        return values
+
+
+# Run inference on the pose landmark model
+class PoseLandmarkStage(Stage):
+    def __init__(self, cam_count, config):
+        super().__init__("pose_landmark", inputs=["pose_det_post"], outputs=["pose_landmark"], slots=["roi"])
+        self.cam_count = cam_count
+        self.config = config
+        self.joints = pose.select_joints(config)
+        self.landmark_sess = None
+
+        self.prev_landmarks = None
+        self.prev_t = None
+
+    def setup(self):
+        model = ["lite", "full", "heavy"][self.config.model]
+        path = self.config.pose_landmark_model or f"models/pose_landmark_{model}_batched.onnx"
+        self.landmark_sess = inference.create_session(path, suppress_warnings=True)
+
+    def reconfigure(self, previous):
+        self.joints = pose.select_joints(self.config)
+
+    def process(self, values):
+        config = self.config
+        output = self.landmark_sess.run(["Identity", "Identity_1", "Identity_3"], {"input_1": [values[i][0].transpose(2, 0, 1) for i in range(self.cam_count)]})
+        normalized_landmarks, f, heatmap = output
+
+        # If the confidence of the pose detection (on any of the images) is too low, we can't continue
+        # The ROI is also removed as no one was found in it
+        if((f[:, 0] < config.pose_lm_min_score).any()):
+            self.slot("roi").put(None)
+            return None
+
+        normalized_landmarks = inference.landmark_postprocess(normalized_landmarks, True, self.joints)
+        landmarks = np.stack(normalized_landmarks)
+        if config.refine_landmarks:
+            landmarks = inference.refine_landmarks(landmarks, heatmap, kernel_size=config.refine_kernel_size, min_conf=config.refine_min_score, joints=self.joints)
+        landmarks = inference.denormalize_landmarks(landmarks, [values[i][1] for i in range(self.cam_count)], self.joints)
+
+        # The session log keeps the landmarks from before flip detection and filtering, for replaying them in tunetool.py
+        raw = landmarks.copy() if config.session_log else None
+        if config.flip_detection and self.prev_landmarks is not None and time.time() - self.prev_t < 0.1:
+            inference.autoflip(self.prev_landmarks, landmarks, config.flip_detection_max)
+        self.prev_landmarks = landmarks
+        self.prev_t = time.time()
+
+        return (landmarks, f, [values[i][2] for i in range(self.cam_count)], raw)
+
+
+# Post processing for the landmarks
+# viewer shows the debug windows (see utils/viewer.py), when given
+class PoseLandmarkPostStage(Stage):
+    def __init__(self, cam_count, config, viewer=None):
+        super().__init__("pose_landmark_post", inputs=["pose_landmark"], outputs=["pose_landmark_post"], slots=["roi"])
+        self.cam_count = cam_count
+        self.config = config
+        self.joints = pose.select_joints(config)
+        self.smoothing = [[filters.get_filter(config.filter_2d, config.fps, 2) for _ in range(39)] for _ in range(cam_count)]
+        self.viewer = viewer
+
+    def teardown(self):
+        if self.viewer is not None:
+            self.viewer.close()
+
+    def reconfigure(self, previous):
+        config = self.config
+        self.joints = pose.select_joints(config)
+        if config.filter_2d != previous.filter_2d:
+            self.smoothing = [[filters.get_filter(config.filter_2d, config.fps, 2) for _ in range(39)] for _ in range(self.cam_count)]
+
+    def smooth(self, landmarks, t):
+        # Filters the landmarks of every camera in place, t is in ms
+        for i in range(self.cam_count):
+            for j in self.joints:
+                landmarks[i][j][:2] = self.smoothing[i][j].filter(landmarks[i][j][:2], t)
+
+    def process(self, item):
+        landmarks, flags, imgs, raw = item
+        values = []
+
+        roi = [inference.landmarks_to_roi(landmarks[i]) for i in range(self.cam_count)]
+        self.slot("roi").put(roi)
+
+        self.smooth(landmarks, time.time() * 1000)
+        for i in range(self.cam_count):
+            values.append((imgs[i], landmarks[i], flags[i], roi[i], None if raw is None else raw[i]))
+
+        if self.viewer is not None:
+            # Escape closes the debug windows and stops tracking
+            if self.viewer.closed:
+                self.pipeline.stop()
+                return None
+            self.viewer.publish([a for i in range(self.cam_count) for a in (imgs[i], landmarks[i], flags[i], np.ravel(roi[i]))])
+
+        return values
+
+
+# Calculate pose from 3d points and send it to the OSC server
+# viewer shows the skeleton (see utils/viewer.py), when given
+# resolutions are the (width, height) of the raw frames of the cameras, for the session log
+class TriangulationStage(Stage):
+    def __init__(self, oncm, triangulator, config, viewer=None, resolutions=None):
+        super().__init__("triangulation", inputs=["pose_landmark_post"], slots=["hip", "fused_hip"])
+        self.oncm = oncm
+        self.triangulator = triangulator
+        self.config = config
+        self.joints = pose.select_joints(config)
+        self.client = None
+        self.logger = None
+        self.viewer = viewer
+        self.resolutions = resolutions
+
+        self.smoothing = [filters.get_filter(config.filter_3d, config.fps, 3) for _ in range(39)]
+        self.fitter = skeleton.SkeletonFitter(config.skeleton_learn_time, config.skeleton_iterations) if config.skeleton_fit else None
+
+        self.start = None
+        self.frames = 0
+
+    def reconfigure(self, previous):
+        config = self.config
+        self.joints = pose.select_joints(config)
+        if config.filter_3d != previous.filter_3d:
+            self.smoothing = [filters.get_filter(config.filter_3d, config.fps, 3) for _ in range(39)]
+        # The bone lengths get learned again
+        if (config.skeleton_fit, config.skeleton_learn_time, config.skeleton_iterations) != (previous.skeleton_fit, previous.skeleton_learn_time, previous.skeleton_iterations):
+            self.fitter = skeleton.SkeletonFitter(config.skeleton_learn_time, config.skeleton_iterations) if config.skeleton_fit else None
+        if self.triangulator is not None:
+            self.triangulator.max_error = config.multicam_max_error
+
+    def setup(self):
+        self.client = client.get_client(self.config)
+        # With fusion, the owoTrack server runs in the fusion stage
+        if self.config.owotrack and not self.config.owotrack_fusion:
+            pose.start_owotrack_server()
+
+        # The session log also needs the poses which were sent to the trackers
+        if self.config.session_log:
+            directory = self.config.session_log_dir
+            os.makedirs(directory, exist_ok=True)
+            self.logger = sessionlog.SessionLogger(os.path.join(directory, time.strftime("session_%Y%m%d_%H%M%S.tlog")), len(self.oncm),
+                                                  proj=[oncm[5] for oncm in self.oncm], resolutions=self.resolutions)
+            self.client = sessionlog.TrackerTap(self.client)
+
+        self.start = time.time()
+
+    def teardown(self):
+        if self.logger is not None:
+            self.logger.close()
+        if self.viewer is not None:
+            self.viewer.close()
+
+    def process(self, values):
+        config = self.config
+
+        # Display FPS, and the frames dropped between the stages
+        self.frames += 1
+        if self.frames == 100:
+            print("FPS: {}".format(100 / (time.time() - self.start)))
+            dropped = {name: stats["dropped"] for name, stats in self.pipeline.stats().items() if stats["dropped"] > 0}
+            if dropped:
+                print("Dropped: {}".format(dropped))
+            self.start = time.time()
+            self.frames = 0
+
+        # The skeleton view colours the joints by their reprojection error
+        points, residuals = self.triangulate(values, self.viewer is not None and self.viewer.due)
+        triangulated = points.copy() if self.logger is not None else None
+        points = self.smooth(points, time.time() * 1000)
+
+        fused_hip = config.owotrack and config.owotrack_fusion
+        rot = pose.calc_pose(points, self.client, config.send_rot, config.extra_trackers, fused_hip)
+        self.trace.mark("send")
+        if fused_hip:
+            self.slot("hip").put((self.trace.marks.get("capture", time.monotonic()), rot[solver.HIP], points))
+
+        if self.logger is not None:
+            # The fusion stage sends the hip rotation through its own client
+            sent = self.slot("fused_hip").get() if fused_hip else None
+            if sent is not None:
+                self.client.record_rot(3, sent)
+            self.logger.log(values, triangulated, points, residuals, self.client, self.trace.marks.get("capture", np.nan))
+
+        if self.viewer is not None:
+            # Escape closes the skeleton view and stops tracking
+            if self.viewer.closed:
+                self.pipeline.stop()
+                return None
+            self.viewer.publish([points, np.full(len(points), np.nan) if residuals is None else residuals, np.array([config.multicam_max_error])])
+
+    def triangulate(self, values, residuals=False):
+        # 3D points (m) in the tracking space from the landmarks of every camera, and the residuals
+        # The residuals are None unless they come for free (weighted mode), or residuals is True
+        config = self.config
+        if config.multicam_mode == "weighted":
+            points, residuals = self.triangulator.get_depth(values, self.joints)
+        else:
+            points = vision.get_depth(self.oncm, values, multicam_val=config.multicam_val, joints=self.joints)
+            residuals = self.triangulator.residuals(values, points.reshape(-1, 3), self.joints) if residuals else None
+        points = points.squeeze() / 100 # (39, 3)
+
+        points = points * config.scale_multiplier
+        if config.flip_x:
+            points[:, 0] = -points[:, 0]
+        if config.flip_y:
+            points[:, 1] = -points[:, 1]
+        if config.flip_z:
+            points[:, 2] = -points[:, 2]
+        if config.swap_xz:
+            points[:, [0, 2]] = points[:, [2, 0]]
+        return points, residuals
+
+    def smooth(self, points, t):
+        # Skeleton fitting and the 3d filter, t is in ms
+        if self.fitter is not None:
+            points = self.fitter.filter(points, t)
+
+        for i in self.joints:
+            points[i] = self.smoothing[i].filter(points[i], t)
+        return points
+
+
+# Sends the hip rotation every time the owoTrack device sends its orientation, fused with the hips of the triangulation
+# stage (see utils/fusion.py), which puts the hip rotation and the points of every frame set into the hip slot
+# The rotations which were sent go into the fused_hip slot, for the session log of the triangulation stage
+# The stage waits for the device instead of a mailbox, so it always runs on a thread of the main process
+# When the device stops sending, the hip rotation of the frame sets gets sent like without owoTrack
+class FusionStage(Stage):
+    def __init__(self, config):
+        super().__init__("fusion", slots=["hip", "fused_hip"])
+        self.config = config
+        self.client = None
+        self.fusion = None
+
+    def reconfigure(self, previous):
+        self.fusion.time_constant = self.config.owotrack_fusion_time
+        self.fusion.mirrored = self.mirrored()
+
+    def setup(self):
+        self.client = client.get_client(self.config)
+        pose.start_owotrack_server()
+        self.fusion = fusion.HipFusion(self.config.owotrack_fusion_time, mirrored=self.mirrored())
+
+    def mirrored(self):
+        # Every flip (and swapping x and z) of the points mirrors the tracking space
+        config = self.config
+        return (config.flip_x + config.flip_y + config.flip_z + config.swap_xz) % 2 == 1
+
+    def run(self):
+        # Frame sets don't pass through this stage, so it has no traces to step with
+        self.setup()
+        server = pose.owotrack_server
+        imu, vision = None, None
+        try:
+            while self.pipeline.running:
+                config = self.pipeline.config
+                if config is not None and config is not self.config:
+                    previous, self.config = self.config, config
+                    self.reconfigure(previous)
+
+                hip = self.slot("hip").get()
+                new_vision = hip is not None and hip is not vision
+                if new_vision:
+                    vision = hip
+                    self.fusion.update_vision(vision[0], vision[2])
+
+                latest = server.wait(0, imu, timeout=1 / self.config.fps)
+                if latest is not None:
+                    imu = latest
+                    rotvec = self.fusion.update_imu(*imu)
+                    if rotvec is not None:
+                        self.slot("fused_hip").put(pose.send_hip_rot(self.client, rotvec))
+                        self.client.flush()
+                elif new_vision and (imu is None or time.monotonic() - imu[0] > 0.5):
+                    self.slot("fused_hip").put(pose.send_hip_rot(self.client, vision[1] if self.config.send_rot else None))
+                    self.client.flush()
+        finally:
+            self.teardown()
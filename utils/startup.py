@@ -0,0 +1,77 @@
+# Startup time of the tracker, from the start of main.py until the first frame set has been sent to the trackers
+# main.py marks the end of every phase (imports, settings, cameras, ...), the last phase ends with the first frame.
+# The durations get printed, and are part of the tracing summary (see utils/tracing.py).
+# import_report() shows which modules take long to import, using python -X importtime:
+#   python main.py --startup-report
+import time
+import sys
+import os
+
+started = time.monotonic()
+phases = {} # phase: seconds after started when the phase ended, in order
+
+def mark(phase):
+    phases[phase] = time.monotonic() - started
+
+
+def durations():
+    # {phase: seconds}, and the total
+    result = {}
+    previous = 0
+    for phase, end in phases.items():
+        result[phase] = end - previous
+        previous = end
+    result["total"] = previous
+    return result
+
+
+def first_frame(trace, completed):
+    # Listener of the pipeline, the startup is done when the first frame set reaches the trackers
+    if completed and "first_frame" not in phases:
+        mark("first_frame")
+        result = durations()
+        print("Started in {:.2f} s ({})".format(result.pop("total"), ", ".join("{} {:.2f} s".format(phase, seconds) for phase, seconds in result.items())))
+
+
+# Modules which should only get imported when the settings need them
+lazy_modules = ["scipy", "onnxruntime", "pyjson5", "camera.binding"]
+
+def import_report(module="main", top=15):
+    # Imports module in a new interpreter with -X importtime, and prints the slowest imports
+    import subprocess
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd=root, capture_output=True, text=True)
+
+    # Lines look like "import time:       123 |        456 |   package.module" (microseconds, nesting as indentation)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(own), int(cumulative), (len(name) - len(name.lstrip())) // 2))
+    if result.returncode != 0 or not imports:
+        print(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "import {} failed".format(module))
+        return None
+
+    # The imports of a module are listed before it, one level deeper
+    index = next(i for i, (name, own, cumulative, depth) in enumerate(imports) if name == module)
+    total, depth = imports[index][2], imports[index][3]
+    direct = []
+    for name, own, cumulative, level in reversed(imports[:index]):
+        if level <= depth:
+            break
+        if level == depth + 1:
+            direct.append((name, cumulative))
+    print("import {}: {:.1f} ms, {} modules".format(module, total / 1000, len(imports)))
+
+    print("\nSlowest imports of {} (including what they import):".format(module))
+    for name, cumulative in sorted(direct, key=lambda i: -i[1])[:top]:
+        print("    {:>9.1f} ms  {}".format(cumulative / 1000, name))
+
+    print("\nSlowest modules (on their own):")
+    for name, own, cumulative, depth in sorted(imports, key=lambda i: -i[1])[:top]:
+        print("    {:>9.1f} ms  {}".format(own / 1000, name))
+
+    loaded = [name for name in lazy_modules if any(i[0] == name for i in imports)]
+    print("\nLoaded at import, but only needed by some settings: {}".format(", ".join(loaded) if loaded else "none"))
+    return {name: (own, cumulative) for name, own, cumulative, depth in imports}
@@ -0,0 +1,170 @@
+# Latency tracing for the tracking pipeline
+# Every frame set carries a Trace through the pipeline, which records when each stage started and finished,
+# how long the frame waited in each mailbox, how much CPU time each stage used, and when it was captured and sent over OSC.
+# The LatencyMonitor collects the finished traces, and reports rolling percentiles as JSON lines and/or over HTTP.
+from collections import deque
+import numpy as np
+import threading
+import json
+import time
+
+from . import startup
+
+class Trace:
+    __slots__ = ("start", "stages", "cpu", "waits", "marks")
+
+    def __init__(self, start=None):
+        self.start = time.monotonic() if start is None else start
+        self.stages = {}  # stage name: (start, end)
+        self.cpu = {}     # stage name: (start, end) CPU time of the thread running the stage
+        self.waits = {}   # mailbox name: seconds spent waiting in the mailbox
+        self.marks = {}   # event name (capture, send): time
+
+    def begin(self, stage):
+        self.stages[stage] = (time.monotonic(), None)
+        self.cpu[stage] = (time.thread_time(), None)
+
+    def end(self, stage):
+        start = self.stages.get(stage, (self.start, None))[0]
+        self.stages[stage] = (start, time.monotonic())
+        cpu_start = self.cpu.get(stage, (None, None))[0]
+        if cpu_start is not None:
+            self.cpu[stage] = (cpu_start, time.thread_time())
+
+    def wait(self, mailbox, seconds):
+        self.waits[mailbox] = seconds
+
+    def mark(self, name):
+        self.marks[name] = time.monotonic()
+
+    @staticmethod
+    def merge(traces):
+        # Used when a stage takes items from multiple mailboxes (eg. one frame of each camera)
+        # The earliest time is kept for marks which appear in multiple traces, so capture is the time of the oldest frame
+        traces = [trace for trace in traces if trace is not None]
+        if len(traces) == 1:
+            return traces[0]
+
+        merged = Trace(min([trace.start for trace in traces], default=None))
+        for trace in traces:
+            merged.stages.update(trace.stages)
+            merged.cpu.update(trace.cpu)
+            merged.waits.update(trace.waits)
+            for name, t in trace.marks.items():
+                merged.marks[name] = min(t, merged.marks.get(name, t))
+        return merged
+
+
+class LatencyMonitor:
+    quantiles = (50, 95, 99)
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {}
+        self.frames = 0
+        self.pipeline = None
+        self.server = None
+
+    def reset(self):
+        # Forgets the recorded frames, eg. after warming up
+        self.samples = {}
+        self.frames = 0
+
+    def _add(self, key, value):
+        samples = self.samples.get(key)
+        if samples is None:
+            samples = self.samples[key] = deque(maxlen=self.window)
+        samples.append(value)
+
+    def record(self, trace):
+        # Called with the trace of every frame set which made it to the end of the pipeline
+        self.frames += 1
+        if "capture" in trace.marks and "send" in trace.marks:
+            self._add(("latency", "glass_to_osc"), trace.marks["send"] - trace.marks["capture"])
+        for stage, (start, end) in trace.stages.items():
+            if end is not None:
+                self._add(("stage", stage), end - start)
+        for stage, (start, end) in trace.cpu.items():
+            if end is not None:
+                self._add(("cpu", stage), end - start)
+        for mailbox, seconds in trace.waits.items():
+            self._add(("wait", mailbox), seconds)
+
+    def summary(self):
+        # {"frames": N, "latency": {...}, "stage": {name: {"p50": ms, ...}}, "cpu": {...}, "wait": {...}, "dropped": {...}, "startup": {...}}
+        result = {"time": time.time(), "frames": self.frames, "latency": {}, "stage": {}, "cpu": {}, "wait": {}}
+        for (kind, name), samples in list(self.samples.items()):
+            values = np.array(samples) * 1000
+            if len(values):
+                percentiles = np.percentile(values, self.quantiles)
+                result[kind][name] = {"p{}".format(q): round(float(p), 3) for q, p in zip(self.quantiles, percentiles)}
+
+        if self.pipeline is not None:
+            result["dropped"] = {name: stats["dropped"] for name, stats in self.pipeline.stats().items()}
+        # Seconds of every startup phase, once the first frame has been tracked (see utils/startup.py)
+        if "first_frame" in startup.phases:
+            result["startup"] = startup.durations()
+        return result
+
+    def prometheus(self):
+        # Prometheus text exposition format, latencies are summaries in seconds
+        summary = self.summary()
+        metric_names = {"latency": ("toucan_latency_seconds", "path"), "stage": ("toucan_stage_seconds", "stage"), "cpu": ("toucan_stage_cpu_seconds", "stage"), "wait": ("toucan_queue_wait_seconds", "mailbox")}
+
+        lines = ["# TYPE toucan_frames_total counter", "toucan_frames_total {}".format(summary["frames"])]
+        for kind, (metric, label) in metric_names.items():
+            lines.append("# TYPE {} summary".format(metric))
+            for name, values in summary[kind].items():
+                for q in self.quantiles:
+                    lines.append('{}{{{}="{}",quantile="{}"}} {}'.format(metric, label, name, q / 100, values["p{}".format(q)] / 1000))
+        if "dropped" in summary:
+            lines.append("# TYPE toucan_dropped_total counter")
+            for name, dropped in summary["dropped"].items():
+                lines.append('toucan_dropped_total{{mailbox="{}"}} {}'.format(name, dropped))
+        if "startup" in summary:
+            lines.append("# TYPE toucan_startup_seconds gauge")
+            for phase, seconds in summary["startup"].items():
+                lines.append('toucan_startup_seconds{{phase="{}"}} {}'.format(phase, seconds))
+        return "\n".join(lines) + "\n"
+
+    def start(self, path=None, interval=5, port=None):
+        # Writes a JSON line to path every interval seconds, and serves /metrics on 127.0.0.1:port
+        if path is not None:
+            threading.Thread(target=self._report_loop, args=(path, interval), name="tracing", daemon=True).start()
+
+        if port is not None:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+            monitor = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path == "/metrics":
+                        body, content_type = monitor.prometheus().encode(), "text/plain; version=0.0.4"
+                    elif self.path == "/json":
+                        body, content_type = json.dumps(monitor.summary()).encode(), "application/json"
+                    else:
+                        self.send_error(404)
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            # Only reachable from this computer
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            threading.Thread(target=self.server.serve_forever, name="tracing_http", daemon=True).start()
+
+    def _report_loop(self, path, interval):
+        with open(path, "a") as f:
+            while True:
+                time.sleep(interval)
+                f.write(json.dumps(self.summary()) + "\n")
+                f.flush()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
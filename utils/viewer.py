@@ -0,0 +1,153 @@
+# Debug views, drawn and shown by a process of their own so they don't slow down tracking
+# The stages publish their latest arrays into a shared memory block, at most max_fps times a second. The viewer process
+# draws whatever is newest when it's due for a frame, values published in between are overwritten instead of queued.
+# A sequence number in front of the arrays (a seqlock) tells the viewer when it read a value while it was being written.
+import multiprocessing
+import time
+
+import cv2
+import numpy as np
+
+from .pipeline import _attach
+
+HEADER = 64 # bytes before the arrays, for the sequence number
+
+def _layout(arrays):
+    # Offsets of the arrays in the shared memory block, and its size
+    refs = []
+    offset = HEADER
+    for a in arrays:
+        refs.append((offset, a.shape, a.dtype.str))
+        offset += (a.nbytes + 63) // 64 * 64
+    return refs, offset
+
+
+def _views(shm, refs):
+    return np.ndarray((1,), np.int64, buffer=shm.buf), [np.ndarray(shape, dtype, buffer=shm.buf, offset=offset) for offset, shape, dtype in refs]
+
+
+class Viewer:
+    # draw(arrays) returns {window name: image} for a published list of arrays, it runs in the viewer process
+    # and has to be a module level function, so it can be sent there
+    # The viewer gets started in the main process, and can be given to a stage which runs in a worker process
+    def __init__(self, draw, max_fps=30):
+        ctx = multiprocessing.get_context("spawn")
+        self.draw = draw
+        self.interval = 1 / max_fps
+        self.next = 0
+        self.conn, self.child = ctx.Pipe()
+        self.escape = ctx.Event()
+        self.process = None
+        self.shm = None
+        self.shapes = None
+        self.seq = None
+        self.views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["process"] = None
+        return state
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.process = ctx.Process(target=_run, args=(self.draw, self.interval, self.child, self.escape), name="viewer", daemon=True)
+        self.process.start()
+
+    @property
+    def closed(self):
+        # The windows got closed with escape
+        return self.escape.is_set()
+
+    @property
+    def due(self):
+        # Whether the next publish gets shown, for skipping work which is only needed for the view
+        return time.monotonic() >= self.next
+
+    def publish(self, arrays):
+        # Only copies the arrays when the viewer is due for a new frame
+        now = time.monotonic()
+        if now < self.next:
+            return
+        self.next = now + self.interval
+
+        shapes = [(a.shape, a.dtype.str) for a in arrays]
+        if shapes != self.shapes:
+            self._allocate(arrays)
+            self.shapes = shapes
+
+        # Odd while writing
+        self.seq[0] += 1
+        for view, a in zip(self.views, arrays):
+            view[...] = a
+        self.seq[0] += 1
+
+    def _allocate(self, arrays):
+        from multiprocessing import shared_memory
+        refs, size = _layout(arrays)
+        self._release()
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.seq, self.views = _views(self.shm, refs)
+        self.seq[0] = 0
+        try:
+            self.conn.send((self.shm.name, refs))
+        except OSError:
+            pass
+
+    def _release(self):
+        if self.shm is not None:
+            self.seq = self.views = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def close(self):
+        # Called by the stage which publishes, in the process it runs in
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        if self.process is not None:
+            self.process.join(1)
+        self._release()
+
+
+def _run(draw, interval, conn, escape):
+    shm, seq, views = None, None, None
+    seen = 0
+    try:
+        while True:
+            start = time.monotonic()
+            while conn.poll():
+                msg = conn.recv()
+                if msg is None:
+                    return
+                # The arrays changed shape, and got moved to a new block
+                seq = views = None
+                if shm is not None:
+                    shm.close()
+                    shm = None
+                name, refs = msg
+                try:
+                    shm = _attach(name)
+                except FileNotFoundError:
+                    continue # Already replaced by the next block
+                seq, views = _views(shm, refs)
+                seen = 0
+
+            if seq is not None:
+                before = int(seq[0])
+                if before != seen and before % 2 == 0:
+                    arrays = [view.copy() for view in views]
+                    if int(seq[0]) == before:
+                        seen = before
+                        for window, image in draw(arrays).items():
+                            cv2.imshow(window, image)
+
+            wait = interval - (time.monotonic() - start)
+            if cv2.waitKey(max(int(wait * 1000), 1)) == 27:
+                escape.set()
+                return
+    except (EOFError, OSError, KeyboardInterrupt):
+        pass
+    finally:
+        cv2.destroyAllWindows()
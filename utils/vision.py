@@ -1,17 +1,41 @@
 # Functions for camera distortion and 3D keypoint calculation
 import cv2
-import pyjson5
 import numpy as np
-import camera.binding as camera
 
-with open("calib.json", "r") as f:
-    calib = pyjson5.load(f)
+# calib.json is read when it's first needed, so this module can be used without a calibration (eg. by the benchmarks)
+calib = None
+def get_calib():
+    global calib
+    if calib is None:
+        import pyjson5
+        with open("calib.json", "r") as f:
+            calib = pyjson5.load(f)
+    return calib
 
-def get_cam(type, id):
+DEFAULT_RESOLUTION = (640, 480)
+DEFAULT_FPS = 50
+
+def camera_mode(calib, camera_id):
+    # (width, height) of the raw frames and frame rate of a camera of calib.json
+    # Cameras can set "resolution" and "fps", eg. the PS3 Eye gives 320x240 at up to 187 fps instead of 640x480 at 60 fps
+    camera = calib["cameras"][int(camera_id)]
+    resolution = camera.get("resolution", calib.get("settings", {}).get("resolution", DEFAULT_RESOLUTION))
+    return (int(resolution[0]), int(resolution[1])), camera.get("fps", DEFAULT_FPS)
+
+def get_cam(type, id, path=None, replay_mode="realtime", resolution=DEFAULT_RESOLUTION, fps=DEFAULT_FPS):
     if type == "PS3 Eye Camera":
-        return camera.Camera(id, (640, 480), 50, camera.ps3eye_format.PS3EYE_FORMAT_BGR)
+        import camera.binding as camera # Loads the PS3 Eye driver
+        return camera.Camera(id, tuple(resolution), fps, camera.ps3eye_format.PS3EYE_FORMAT_BGR)
+    elif type == "Replay":
+        # Camera id of the recording at path, see camera/recording.py
+        from camera.recording import ReplayCamera
+        return ReplayCamera(path, id, replay_mode)
     else:
-        return cv2.VideoCapture(id+700) #open camera at id with the directshow API (700). Note that same camera is not always on the same id, so this needs a better way.
+        cap = cv2.VideoCapture(id+700) #open camera at id with the directshow API (700). Note that same camera is not always on the same id, so this needs a better way.
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+        cap.set(cv2.CAP_PROP_FPS, fps)
+        return cap
 
 def _make_homogeneous_rep_matrix(R, t):
     P = np.zeros((4,4))
@@ -21,9 +45,11 @@ def _make_homogeneous_rep_matrix(R, t):
     return P
 
 def read_camera_parameters(camera_id):
+    calib = get_calib()
     return np.array(calib["cameras"][int(camera_id)]["intrinsics"]["cmtx"]), np.array(calib["cameras"][int(camera_id)]["intrinsics"]["dist"])
 
 def read_rotation_translation(camera_id):
+    calib = get_calib()
     return np.array(calib["cameras"][int(camera_id)]["extrinsics"]["rvec"]).squeeze(), np.array(calib["cameras"][int(camera_id)]["extrinsics"]["tvec"])
 
 def get_projection_matrix(camera_id):
@@ -50,20 +76,24 @@ def triangulate(proj, points):
 
     return point_3d
 
-def get_depth(oncm, values, multicam_val=0.75):
+def get_depth(oncm, values, multicam_val=0.75, joints=None):
     num_views = len(oncm)
     num_keypoints = len(values[0][1])
+    if joints is None:
+        joints = range(num_keypoints)
 
     proj = np.array([oncm[i][5] for i in range(len(oncm))])
     points_2d = np.array([values[i][1] for i in range(len(values))]).transpose(1, 0, 2)
 
+    # Keypoints which aren't in joints are left at the origin
     points = np.zeros((num_keypoints, 4))
-    for i in range(num_keypoints):
+    points[:, 3] = 1
+    for i in joints:
         idx = np.arange(num_views)
         if num_views > 2:
             if multicam_val > 1:
                 # Get the best of N cameras
-                idx = np.argsort(points_2d[i, :, 3])[:multicam_val]
+                idx = np.argsort(points_2d[i, :, 3])[::-1][:int(multicam_val)]
             else:
                 # Get the cameras with confidence above a threshold
                 idx = np.where(points_2d[i, :, 3] > multicam_val)[0]
@@ -74,4 +104,83 @@ def get_depth(oncm, values, multicam_val=0.75):
             points[i] = triangulate(proj, points_2d[i])
 
     points3d = cv2.convertPointsFromHomogeneous(points)
-    return points3d
\ No newline at end of file
+    return points3d
+
+# Confidence weighted triangulation which scales to many cameras
+# The rows of the linear system only depend on the projection matrices, so they get split up once per camera
+# Every keypoint then gets solved at once using a batched SVD, with each camera weighted by the keypoint visibility
+# Cameras with a reprojection error above max_error (in pixels) are rejected one by one, and the keypoint gets solved again
+# pixel_scale is the size of the frames of every camera relative to 640x480, errors are measured in pixels at 640x480
+# so max_error means the same for cameras running at a lower resolution
+class Triangulator:
+    def __init__(self, oncm, max_error=20, min_views=2, pixel_scale=None):
+        self.proj = np.array([oncm[i][5] for i in range(len(oncm))]) # (views, 3, 4)
+        self.rows_xy = self.proj[:, :2, :] # (views, 2, 4)
+        self.rows_z = self.proj[:, 2:3, :] # (views, 1, 4)
+        self.max_error = max_error
+        self.min_views = min(min_views, len(oncm))
+        self.pixel_scale = np.ones(len(oncm)) if pixel_scale is None else np.asarray(pixel_scale, dtype=float)
+
+    def solve(self, points_2d, weights):
+        # points_2d: (keypoints, views, 2), weights: (keypoints, views)
+        A = points_2d[:, :, :, None] * self.rows_z[None] - self.rows_xy[None] # (keypoints, views, 2, 4)
+        # Rows get normalized so that the visibility is the only thing deciding how much a camera counts
+        A = A * (weights[:, :, None, None] / np.linalg.norm(A, axis=3, keepdims=True))
+        A = A.reshape(len(points_2d), -1, 4)
+
+        u, s, vh = np.linalg.svd(A, full_matrices=False)
+        return vh[:, 3, :]
+
+    def reprojection_error(self, points_4d, points_2d):
+        projected = np.einsum("vij,kj->kvi", self.proj, points_4d)
+        projected = projected[:, :, :2] / projected[:, :, 2:]
+        return np.linalg.norm(projected - points_2d, axis=2) / self.pixel_scale # (keypoints, views)
+
+    def residuals(self, values, points3d, joints=None):
+        # Visibility weighted reprojection error of every camera, for points3d (keypoints, 3) triangulated by get_depth()
+        # of this module instead of the triangulator. Keypoints which aren't in joints get 0
+        points_2d = np.array([values[i][1] for i in range(len(values))]).transpose(1, 0, 2) # (keypoints, views, 4)
+        if joints is None:
+            joints = np.arange(len(points_2d))
+        weights = np.maximum(points_2d[joints, :, 3], 1e-3)
+        points_4d = np.hstack([points3d[joints], np.ones((len(joints), 1))])
+        error = self.reprojection_error(points_4d, points_2d[joints, :, :2])
+
+        residuals = np.zeros(len(points_2d))
+        residuals[joints] = np.sum(error * weights, axis=1) / np.sum(weights, axis=1)
+        return residuals
+
+    def get_depth(self, values, joints=None):
+        points_2d = np.array([values[i][1] for i in range(len(values))]).transpose(1, 0, 2) # (keypoints, views, 4)
+        num_keypoints = len(points_2d)
+        if joints is not None:
+            points_2d = points_2d[joints]
+        xy = points_2d[:, :, :2]
+        weights = np.maximum(points_2d[:, :, 3], 1e-3)
+
+        points = self.solve(xy, weights)
+        error = self.reprojection_error(points, xy)
+
+        # Reject the cameras which don't agree with the others, one at a time starting with the worst one
+        # At least min_views cameras are always kept
+        for _ in range(len(self.proj) - self.min_views):
+            worst = np.argmax(np.where(weights > 0, error, -1), axis=1)
+            reject = (error[np.arange(len(error)), worst] > self.max_error) & ((weights > 0).sum(axis=1) > self.min_views)
+            if not reject.any():
+                break
+
+            weights[reject, worst[reject]] = 0
+            points[reject] = self.solve(xy[reject], weights[reject])
+            error[reject] = self.reprojection_error(points[reject], xy[reject])
+
+        # Residual per joint, the visibility weighted reprojection error of the cameras which were used
+        residuals = np.sum(error * weights, axis=1) / np.sum(weights, axis=1)
+
+        points3d = points[:, None, :3] / points[:, None, 3:]
+        if joints is None:
+            return points3d, residuals
+
+        # Keypoints which aren't in joints are left at the origin
+        all_points3d, all_residuals = np.zeros((num_keypoints, 1, 3)), np.zeros(num_keypoints)
+        all_points3d[joints], all_residuals[joints] = points3d, residuals
+        return all_points3d, all_residuals
\ No newline at end of file